@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Compare the tarfile and the system tar backends of ``--extractor``.
+
+Usage: python benchmarks/extract.py [--node VERSION] [--archive-format gz|xz]
+       [--repeat N] [ARCHIVE]
+
+Without ARCHIVE the prebuilt archive of ``--node`` for this host is
+fetched through the download cache of nodeenv first.
+"""
+import argparse
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nodeenv  # noqa: E402
+
+
+def extract_python(path, keep):
+    dest = tempfile.mkdtemp(prefix='nodeenv-bench-')
+    with open(path, 'rb') as f:
+        nodeenv._extract_tar(f, dest, lambda archive: (
+            member for member in archive if keep(member.name)))
+    return dest
+
+
+def extract_system(path, keep):
+    decompress = nodeenv._system_decompressor(path, 'system')
+    if decompress is None:
+        raise SystemExit('tar or the decompressor for %s is missing' % path)
+    dest = tempfile.mkdtemp(prefix='nodeenv-bench-')
+    with open(path, 'rb') as f:
+        nodeenv._system_extract(f, dest, keep, decompress)
+    return dest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('archive', nargs='?')
+    parser.add_argument('--node', default='lts')
+    parser.add_argument('--archive-format', choices=['gz', 'xz'],
+                        default='gz')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    path = args.archive
+    if path is None:
+        nodeenv.mirrors[:] = nodeenv.get_mirror_urls('nodejs.org')
+        nodeenv.src_base_url = nodeenv.mirrors[0]
+        version = nodeenv.resolve_node_version(args.node)
+        url = nodeenv.get_node_bin_url(version, args.archive_format)
+        with nodeenv._fetch_node_archive(url) as f:
+            path = f.name
+    else:
+        version = re.search(r'node-v([^-]+)-', path).group(1)
+    keep = nodeenv._member_filter(argparse.Namespace(
+        node=version, prebuilt=True, profile_extract='full'))
+
+    print('%s, best of %d' % (path, args.repeat))
+    for name, extract in (('python', extract_python),
+                          ('system', extract_system)):
+        times = []
+        for _ in range(args.repeat):
+            start = time.time()
+            dest = extract(path, keep)
+            times.append(time.time() - start)
+            shutil.rmtree(dest)
+        print('%-8s %.3fs' % (name, min(times)))
+
+
+if __name__ == '__main__':
+    main()
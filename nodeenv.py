@@ -11,6 +11,8 @@
 """
 
 import contextlib
+import errno
+import hashlib
 import io
 import json
 import sys
@@ -23,6 +25,10 @@ import operator
 import argparse
 import subprocess
 import tarfile
+import tempfile
+import time
+import threading
+import zlib
 if sys.version_info < (3, 3):
     from pipes import quote as _quote
 else:
@@ -30,8 +36,10 @@ else:
 import platform
 import zipfile
 import shutil
+import socket
 import sysconfig
 import glob
+from concurrent.futures import ThreadPoolExecutor
 
 try:  # pragma: no cover (py2 only)
     from ConfigParser import SafeConfigParser as ConfigParser  # pyright: ignore[reportMissingImports]  # noqa: E501
@@ -40,16 +48,96 @@ try:  # pragma: no cover (py2 only)
     iteritems = operator.methodcaller('iteritems')
     import httplib  # pyright: ignore[reportMissingImports]
     IncompleteRead = httplib.IncompleteRead
+    from urlparse import urljoin, urlsplit  # pyright: ignore[reportMissingImports]  # noqa: E501
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # pyright: ignore[reportMissingImports]  # noqa: E501
+    from SocketServer import ThreadingMixIn  # pyright: ignore[reportMissingImports]  # noqa: E501
+    import Queue as queue  # pyright: ignore[reportMissingImports]
 except ImportError:  # pragma: no cover (py3 only)
     from configparser import ConfigParser
     # noinspection PyUnresolvedReferences
     import urllib.request as urllib2
     iteritems = operator.methodcaller('items')
-    import http
-    IncompleteRead = http.client.IncompleteRead
+    import http.client as httplib
+    IncompleteRead = httplib.IncompleteRead
+    from urllib.parse import urljoin, urlsplit
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    import queue
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover (windows)
+    fcntl = None
+
+try:
+    import lzma
+    has_lzma = True
+except ImportError:  # pragma: no cover (python built without liblzma)
+    has_lzma = False
 
 nodeenv_version = '1.10.0'
 
+CHUNK_SIZE = 64 * 1024
+SEGMENT_MIN_SIZE = 1 << 20
+# archives downloaded at once by --prefetch
+PREFETCH_JOBS = 4
+# files copied at once by copytree(); copies wait on the disk more
+# than on the CPU, so there are more of them than cores
+COPY_JOBS = min(32, (os.cpu_count() or 1) + 4)
+# errors of copy_file_range() and sendfile() meaning "not for these
+# files", rather than a failed copy
+_NO_KERNEL_COPY = (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                   errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF)
+# archive members each --profile-extract leaves out of prebuilt
+# installs, relative to the top directory of the archive
+# (the directory members too, tar names them without a trailing slash)
+_RUNTIME_SKIPPED = [
+    r'include(/|$)',
+    r'share/(doc|man)(/|$)',
+    r'(lib/)?node_modules/npm/(docs|man)(/|$)',
+]
+_MINIMAL_SKIPPED = _RUNTIME_SKIPPED + [
+    r'(lib/)?node_modules/(npm|corepack)(/|$)',
+    r'(bin/)?(npm|npx|corepack)(\.cmd|\.ps1)?$',
+]
+EXTRACT_PROFILES = {
+    'full': [],
+    'runtime': _RUNTIME_SKIPPED,
+    'minimal': _MINIMAL_SKIPPED,
+}
+# files up to this size are read from the archive into memory and
+# written by the pool of writers, larger ones are written while reading
+EXTRACT_BUFFER_SIZE = 8 << 20
+# most bytes of such files held in memory at once, whatever COPY_JOBS is
+EXTRACT_BUFFER_LIMIT = 16 << 20
+# multithreaded decompressors --extractor=system pipes tar archives
+# through; nodejs.org publishes no other compressions
+SYSTEM_DECOMPRESSORS = {
+    '.tar.gz': ['pigz', '-dc'],
+    '.tar.xz': ['xz', '-dc', '-T0'],
+}
+# write bits taken from the files of the store of extracted trees
+STORE_WRITE_BITS = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+# ioctl cloning a file on btrfs and xfs
+FICLONE = 0x40049409 if sys.platform.startswith('linux') else None
+# directories environments write into: --install-method=symlink creates
+# them in the environment and links only their entries into the store
+STORE_ENV_DIRS = ('bin', 'lib', os.path.join('lib', 'node_modules'))
+# files --serve-cache refetches once they are older than --index-ttl
+SERVE_CACHE_MUTABLE = ('index.json', 'index.tab')
+# release files copied by --mirror-sync
+MIRROR_EXTENSIONS = ('.tar.gz', '.tar.xz', '.zip')
+# errors after which a partial download is worth resuming
+NETWORK_ERRORS = (IncompleteRead, urllib2.URLError, ConnectionError,
+                  socket.timeout)
+
+
+class OfflineError(OSError):
+    """
+    Raised when ``--offline`` needs something that is not cached
+    """
+
+
 join = os.path.join
 abspath = os.path.abspath
 src_base_url = None
@@ -59,6 +147,27 @@ is_WIN = platform.system() == 'Windows'
 is_CYGWIN = platform.system().startswith(('CYGWIN', 'MSYS'))
 
 ignore_ssl_certs = False
+cache_dir = None
+cache_size = 2048 << 20
+index_ttl = 600
+offline = False
+# called as progress_callback(stage, files, nbytes, total) while an
+# archive is downloaded ('download'), extracted ('extract') and copied
+# into the environment ('copy'); ``total`` is the expected number of
+# bytes or None. Reporting costs nothing while this is None.
+progress_callback = None
+# ordered base URLs of the mirrors, the one in use first
+mirrors = []
+_mirrors_lock = threading.Lock()
+
+# seconds without data after which a download counts as stalled
+STALL_TIMEOUT = 30
+# mirror rankings are reused for this many seconds
+MIRROR_RANK_TTL = 300
+# a mirror is measured by fetching this much of its index.json
+MIRROR_PROBE_SIZE = 64 * 1024
+# mirrors are ranked by the time an archive this big takes to download
+MIRROR_ARCHIVE_SIZE = 30 << 20
 
 # ---------------------------------------------------------
 # Utils
@@ -102,6 +211,16 @@ class Config(object):
     prebuilt = True
     ignore_ssl_certs = False
     mirror = None
+    cache_dir = None
+    cache_size = '2048'
+    download_segments = '1'
+    archive_format = 'auto'
+    index_ttl = '600'
+    offline = False
+    progress = False
+    profile_extract = 'full'
+    install_method = 'copy'
+    extractor = 'auto'
 
     @classmethod
     def _load(cls, configfiles, verbose=False):
@@ -228,6 +347,87 @@ def create_logger():
 logger = create_logger()
 
 
+class ProgressPrinter(object):
+    """
+    ``progress_callback`` drawing the figures of all stages on a single
+    updating line on a terminal, or printing them as a plain line every
+    ``interval`` seconds otherwise
+    """
+    labels = {
+        'download': 'Downloading',
+        'extract': 'Extracting',
+        'copy': 'Copying',
+    }
+
+    def __init__(self, stream=None, interval=5.0):
+        self.stream = stream or sys.stderr
+        self.tty = getattr(self.stream, 'isatty', lambda: False)()
+        self.interval = 0.1 if self.tty else interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.shown = None
+        # stage -> [first event time and bytes, last event time,
+        # files, bytes, total], in the order the stages started
+        self.stages = {}
+        self.order = []
+
+    def __call__(self, stage, files, nbytes, total):
+        now = time.time()
+        with self._lock:
+            state = self.stages.get(stage)
+            if state is None:
+                state = self.stages[stage] = [now, nbytes, now, 0, 0, None]
+                self.order.append(stage)
+            state[2:] = now, files, nbytes, total
+            if self.shown is None:
+                if self.tty:
+                    # leave the line of the dots alone
+                    self.stream.write('\n')
+                self.shown = now
+            elif now - self.shown >= self.interval:
+                self.shown = now
+                self._show()
+
+    def finish(self):
+        """
+        Print the final figures of the stages once the install is done
+        """
+        with self._lock:
+            if self.order:
+                self._show()
+                if self.tty:
+                    self.stream.write('\n')
+            self._reset()
+
+    def _stage_line(self, stage):
+        started, start_bytes, updated, files, nbytes, total = \
+            self.stages[stage]
+        line = '%s ' % self.labels.get(stage, stage)
+        if files:
+            line += '%d files, ' % files
+        if total:
+            line += '%.1f/%.1f MB' % (nbytes / 1e6, total / 1e6)
+        else:
+            line += '%.1f MB' % (nbytes / 1e6)
+        if updated > started:
+            rate = (nbytes - start_bytes) / (updated - started)
+            line += ', %.1f MB/s' % (rate / 1e6)
+            if total and rate > 0 and nbytes < total:
+                line += ', %.0fs left' % ((total - nbytes) / rate)
+        return line
+
+    def _show(self):
+        line = '   ' + ' | '.join(
+            self._stage_line(stage) for stage in self.order)
+        if self.tty:
+            self.stream.write('\r%s\x1b[K' % line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
 def make_parser():
     """
     Make a command line argument parser.
@@ -250,7 +450,91 @@ def make_parser():
     parser.add_argument(
         '--mirror',
         action="store", dest='mirror', default=Config.mirror,
-        help='Set mirror server of nodejs.org to download from.')
+        help='Set mirror server of nodejs.org to download from. '
+        'A comma separated list of mirrors is probed and the fastest '
+        'one is used, falling back to the others when it fails.')
+
+    parser.add_argument(
+        '--cache-dir', dest='cache_dir', metavar='CACHE_DIR',
+        default=Config.cache_dir,
+        help='Directory to keep downloaded node.js archives in. '
+        'The default is ~/.cache/nodeenv. '
+        'Pass an empty string to disable the cache.')
+
+    parser.add_argument(
+        '--cache-size', dest='cache_size', metavar='MB',
+        default=Config.cache_size,
+        help='Maximum size of the download cache in megabytes. '
+        'Least recently used archives are evicted first. '
+        'The default is 2048.')
+
+    parser.add_argument(
+        '--download-segments', dest='download_segments', metavar='N',
+        default=Config.download_segments,
+        help='Download archives as N byte ranges in parallel when the '
+        'server supports range requests. The default is 1, a single '
+        'stream which is extracted while it downloads.')
+
+    parser.add_argument(
+        '--archive-format', dest='archive_format',
+        choices=['auto', 'gz', 'xz'], default=Config.archive_format,
+        help='Compression of the node.js tar archives to download. '
+        '`auto` (the default) picks xz when the release has it '
+        'and python supports it, gzip otherwise.')
+
+    parser.add_argument(
+        '--index-ttl', dest='index_ttl', metavar='SECONDS',
+        default=Config.index_ttl,
+        help='How long the cached list of node.js releases is used '
+        'without asking the server whether it changed. '
+        'The default is 600 seconds.')
+
+    parser.add_argument(
+        '--prefetch', dest='prefetch', metavar='SPECS',
+        help='Download the node.js archives of a comma separated list of '
+        'versions into the cache and exit, without creating an '
+        'environment. A version can be latest, lts, a full version or a '
+        'major version such as 18. Example: --prefetch=18,20,lts,latest')
+
+    parser.add_argument(
+        '--mirror-sync', dest='mirror_sync', metavar='DIR',
+        help='Copy node.js releases into DIR, laid out like nodejs.org, '
+        'and exit. DIR can then be used with --mirror=file:///DIR or '
+        'served by any web server. Runs again only fetch what changed.')
+
+    parser.add_argument(
+        '--sync-versions', dest='sync_versions', metavar='SPECS',
+        default='latest,lts',
+        help='Comma separated versions for --mirror-sync, '
+        'like --prefetch. The default is latest,lts.')
+
+    parser.add_argument(
+        '--sync-platforms', dest='sync_platforms', metavar='PLATFORMS',
+        help='Comma separated platforms for --mirror-sync as in the '
+        'archive names, like linux-x64,darwin-arm64,win-x64, and src '
+        'for the sources. The default is the platform of this host.')
+
+    parser.add_argument(
+        '--serve-cache', dest='serve_cache', action='store_true',
+        help='Serve the release tree of the mirror over HTTP from the '
+        'download cache, fetching missing files once, and do not create '
+        'an environment. Other hosts use it with --mirror=http://HOST:PORT')
+
+    parser.add_argument(
+        '--port', dest='port', default='8080',
+        help='Port for --serve-cache. The default is 8080.')
+
+    parser.add_argument(
+        '--offline', dest='offline',
+        action='store_true', default=Config.offline,
+        help='Never access the network: resolve versions from the cached '
+        'list of releases and install only from cached archives.')
+
+    parser.add_argument(
+        '--progress', dest='progress',
+        action='store_true', default=Config.progress,
+        help='Report the progress of downloading, extracting and copying '
+        'node.js: bytes, MB/s and the time left.')
 
     if not is_WIN:
         parser.add_argument(
@@ -363,6 +647,33 @@ def make_parser():
         action='store_true', default=Config.prebuilt,
         help='Install node.js from prebuilt package (default)')
 
+    parser.add_argument(
+        '--profile-extract', dest='profile_extract',
+        choices=sorted(EXTRACT_PROFILES), default=Config.profile_extract,
+        help='Parts of a prebuilt node.js to install: full (the default), '
+        'runtime without C headers and documentation, or minimal, '
+        'which also leaves out npm and corepack.')
+
+    parser.add_argument(
+        '--install-method', dest='install_method',
+        choices=['copy', 'direct', 'link', 'symlink'],
+        default=Config.install_method,
+        help='How a prebuilt node.js gets into the environment: copy '
+        '(the default) copies the tree extracted into src/, direct moves '
+        'it, so every file is written once, link extracts it once into a '
+        'store next to the download cache and links it into each '
+        'environment with reflinks or hard links, symlink points the '
+        'environment at the store with symbolic links.')
+
+    parser.add_argument(
+        '--extractor', dest='extractor',
+        choices=['auto', 'python', 'system'], default=Config.extractor,
+        help='How tar archives are extracted: python uses tarfile, system '
+        'pipes them through pigz or xz -T0 into tar, to decompress on '
+        'several cores, downloading them to disk first. auto (the '
+        'default) uses the system tools for archives already in the '
+        'download cache and tarfile otherwise.')
+
     parser.add_argument(
         '--ignore_ssl_certs', dest='ignore_ssl_certs',
         action='store_true', default=Config.ignore_ssl_certs,
@@ -398,7 +709,62 @@ def parse_args(check=True):
     if not check:
         return args
 
-    if not args.list:
+    if not str(args.cache_size).isdigit():
+        parser.error('--cache-size must be a number of megabytes, '
+                     'got %r' % args.cache_size)
+
+    if not str(args.download_segments).isdigit() or \
+            int(args.download_segments) < 1:
+        parser.error('--download-segments must be a whole number of at '
+                     'least 1, got %r' % args.download_segments)
+
+    if args.mirror is not None and not get_mirror_urls(args.mirror):
+        parser.error('--mirror must name at least one server')
+
+    if not str(args.index_ttl).isdigit():
+        parser.error('--index-ttl must be a number of seconds, '
+                     'got %r' % args.index_ttl)
+
+    if args.offline and args.with_npm:
+        parser.error('--with-npm downloads npm, it can not be '
+                     'combined with --offline')
+
+    if args.offline and args.cache_dir == '':
+        parser.error('--offline needs the download cache, '
+                     'it can not be disabled')
+
+    if args.archive_format == 'xz' and not has_lzma:
+        parser.error('--archive-format=xz requires python with lzma support')
+
+    if args.prefetch and (args.offline or args.cache_dir == ''):
+        parser.error('--prefetch needs the download cache and the network')
+
+    if args.mirror_sync and args.offline:
+        parser.error('--mirror-sync needs the network')
+
+    if args.profile_extract == 'minimal' and (args.requirements or
+                                              args.with_npm):
+        parser.error('--profile-extract=minimal leaves out npm, which is '
+                     'needed for --requirements and --with-npm; use '
+                     '--profile-extract=runtime')
+
+    if args.install_method == 'symlink' and (is_WIN or is_CYGWIN):
+        parser.error('--install-method=symlink is not supported on '
+                     'Windows, use --install-method=link')
+
+    if args.serve_cache and args.cache_dir == '':
+        parser.error('--serve-cache needs the download cache')
+
+    if args.serve_cache and args.mirror and any(
+            url.startswith('file:') for url in get_mirror_urls(args.mirror)):
+        parser.error('--serve-cache needs a remote mirror, files of a '
+                     'file:// mirror are not cached')
+
+    if not str(args.port).isdigit() or not 0 < int(args.port) < 65536:
+        parser.error('--port must be a port number, got %r' % args.port)
+
+    if not (args.list or args.prefetch or args.mirror_sync or
+            args.serve_cache):
         if not args.python_virtualenv and not args.env_dir:
             parser.error('You must provide a DEST_DIR or '
                          'use current python virtualenv')
@@ -412,7 +778,12 @@ def mkdir(path):
     """
     if not os.path.exists(path):
         logger.debug(' * Creating: %s ... ', path, extra=dict(continued=True))
-        os.makedirs(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            # another thread or process got there first
+            if not os.path.isdir(path):
+                raise
         logger.debug('done.')
     else:
         logger.debug(' * Directory %s already exists', path)
@@ -546,7 +917,17 @@ def is_riscv64():
     return platform.machine() == 'riscv64'
 
 
-def get_node_bin_url(version):
+_host_platforms = []
+
+
+def get_host_platforms():
+    """
+    Return the platform parts of the names of the archives this host
+    can run, best first, like ``['darwin-arm64', 'darwin-x64']``. The
+    host is probed once per process.
+    """
+    if _host_platforms:
+        return _host_platforms
     archmap = {
         'x86':    'x86',  # Windows Vista 32
         'i686':   'x86',
@@ -566,25 +947,146 @@ def get_node_bin_url(version):
         's390x': 's390x',       # IBM S390x
         'riscv64': 'riscv64',   # RISCV 64
     }
-    sysinfo = {
-        'system': platform.system().lower(),
-        'arch': archmap[platform.machine().lower()],
-    }
+    arch = archmap[platform.machine().lower()]
     if is_WIN or is_CYGWIN:
-        postfix = '-win-%(arch)s.zip' % sysinfo
+        system = 'win'
     elif is_x86_64_musl():
-        postfix = '-linux-x64-musl.tar.gz'
+        system, arch = 'linux', 'x64-musl'
     else:
-        postfix = '-%(system)s-%(arch)s.tar.gz' % sysinfo
-    filename = 'node-v%s%s' % (version, postfix)
-    return get_root_url(version) + filename
+        system = platform.system().lower()
+    _host_platforms.append('%s-%s' % (system, arch))
+    if arch == 'arm64' and system in ('darwin', 'win'):
+        # Rosetta 2 and Windows on Arm run x64 binaries too
+        _host_platforms.append('%s-x64' % system)
+    return _host_platforms
+
+
+def _bin_filename(version, platform_name, archive_format):
+    if is_WIN or is_CYGWIN:
+        return 'node-v%s-%s.zip' % (version, platform_name)
+    return 'node-v%s-%s.tar.%s' % (version, platform_name, archive_format)
+
+
+def get_node_bin_url(version, archive_format='gz'):
+    """
+    Return the url of the prebuilt archive of ``version`` for this host.
+    If the host can run the builds of several platforms, the best one
+    index.json lists for the release is picked.
+    """
+    platforms = get_host_platforms()
+    name = platforms[0]
+    if len(platforms) > 1:
+        name = _available_platform(version, platforms, archive_format)
+    return get_root_url(version) + _bin_filename(version, name,
+                                                 archive_format)
 
 
-def get_node_src_url(version):
-    tar_name = 'node-v%s.tar.gz' % version
+def _available_platform(version, platforms, archive_format):
+    """
+    Return the first of ``platforms`` with a build of ``version`` in
+    index.json, or the first one if the index can't tell
+    """
+    try:
+        catalog = get_version_catalog()
+    except NETWORK_ERRORS + (OfflineError, ValueError) as e:
+        logger.debug(' * No index.json to pick a build from: %s', e)
+        return platforms[0]
+    for name in platforms:
+        filename = _bin_filename(version, name, archive_format)
+        if catalog.has_file(version, _index_files_key(filename, version)):
+            return name
+    return platforms[0]
+
+
+def get_node_src_url(version, archive_format='gz'):
+    tar_name = 'node-v%s.tar.%s' % (version, archive_format)
     return get_root_url(version) + tar_name
 
 
+def get_node_archive_url(version, prebuilt=True, archive_format='auto'):
+    """
+    Return the url of the prebuilt or source archive for ``version``.
+
+    With ``archive_format`` set to ``auto``, the smaller xz archive is
+    picked if SHASUMS256.txt of the release lists it and python can
+    decompress it, gzip otherwise.
+    """
+    get_url = get_node_bin_url if prebuilt else get_node_src_url
+    if archive_format != 'auto':
+        return get_url(version, archive_format)
+    if offline and has_lzma and not (is_WIN or is_CYGWIN):
+        # checksums may not be cached, take whichever archive is
+        xz_url = get_url(version, 'xz')
+        if cache_lookup(xz_url):
+            return xz_url
+    if has_lzma and not (is_WIN or is_CYGWIN):
+        xz_url = get_url(version, 'xz')
+        if xz_url.rsplit('/', 1)[-1] in get_node_shasums(version):
+            return xz_url
+    return get_url(version, 'gz')
+
+
+_shasums = {}
+
+
+def get_node_shasums(version):
+    """
+    Return a ``{filename: sha256}`` dict of all the files of a release,
+    read from its SHASUMS256.txt. Releases without one give an empty dict.
+    """
+    return _get_shasums(get_root_url(version))
+
+
+def get_expected_sha256(node_url):
+    """
+    Return the published SHA-256 of the archive at ``node_url`` or None
+    """
+    root_url, filename = node_url.rsplit('/', 1)
+    return _get_shasums(root_url + '/').get(filename)
+
+
+def _get_shasums(root_url):
+    url = root_url + 'SHASUMS256.txt'
+    if url in _shasums:
+        return _shasums[url]
+
+    cached = cache_lookup(url)
+    if cached:
+        with open(cached, 'rb') as f:
+            data = f.read()
+    elif offline and not url.startswith('file:'):
+        logger.debug(' * No cached checksums for %s', root_url)
+        data = b''
+    else:
+        try:
+            with contextlib.closing(urlopen(url)) as response:
+                data = response.read()
+        except urllib2.HTTPError as e:
+            logger.debug(' * No checksums in %s: %s', root_url, e)
+            data = b''
+        else:
+            cache_store(url, io.BytesIO(data))
+
+    shasums = _parse_shasums(data)
+    _shasums[url] = shasums
+    return shasums
+
+
+def _parse_shasums(data):
+    shasums = {}
+    for line in data.decode('utf-8', 'replace').splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            shasums[parts[1].lstrip('*')] = parts[0]
+    return shasums
+
+
+def _check_sha256(url, expected, actual):
+    if expected is not None and expected != actual:
+        raise OSError('Checksum mismatch for %s: SHASUMS256.txt says %s, '
+                      'downloaded data has %s' % (url, expected, actual))
+
+
 @contextlib.contextmanager
 def tarfile_open(*args, **kwargs):
     """Compatibility layer because py26."""
@@ -595,219 +1097,1993 @@ def tarfile_open(*args, **kwargs):
         tf.close()
 
 
-def _download_node_file(node_url, n_attempt=3):
-    """Do multiple attempts to avoid incomplete data in case
-    of unstable network"""
-    while n_attempt > 0:
-        try:
-            return io.BytesIO(urlopen(node_url).read())
-        except IncompleteRead as e:
-            logger.warning(
-                'Incomplete read while reading '
-                'from {} - {}'.format(node_url, e)
-            )
-            n_attempt -= 1
-            if n_attempt == 0:
-                raise e
+def _download_node_file(node_url, n_attempt=3, fileobj=None, segments=1):
+    """Download ``node_url`` into ``fileobj`` (a temporary file by default)
+    in chunks of CHUNK_SIZE, so memory use is bounded by the chunk size
+    and not by the size of the archive.
 
+    If ``fileobj`` already holds the beginning of the archive, only the
+    rest of it is requested. With ``segments`` > 1 the archive is fetched
+    as that many byte ranges at once if the server supports range
+    requests.
 
-def download_node_src(node_url, src_dir, args):
+    Do multiple attempts to avoid incomplete data in case
+    of unstable network; a dropped connection is resumed from
+    the last byte received.
+
+    Returns the file object rewound to the start and the SHA-256 hex
+    digest of the downloaded data.
     """
-    Download source code
+    if fileobj is None:
+        fileobj = tempfile.TemporaryFile()
+    fileobj.seek(0, os.SEEK_END)
+    offset = fileobj.tell()
+
+    if segments > 1 and offset == 0:
+        size = _probe_range_support(node_url)
+        segments = min(segments, (size or 0) // SEGMENT_MIN_SIZE)
+        if segments > 1:
+            _download_segmented(node_url, fileobj, size, segments, n_attempt)
+            offset = size
+
+    # the data already on disk is hashed once, the rest on the fly
+    digest = hashlib.sha256()
+    fileobj.seek(0)
+    for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+
+    if segments <= 1:
+        reader = _ResumableReader(node_url, offset, n_attempt)
+        with contextlib.closing(reader):
+            for chunk in iter(lambda: reader.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                fileobj.write(chunk)
+    fileobj.flush()
+    fileobj.seek(0)
+    return fileobj, digest.hexdigest()
+
+
+class _ResumableReader(object):
+    """
+    File-like view of ``url`` starting at ``offset``, which survives
+    dropped connections by requesting the rest of the data with
+    a range request
     """
-    logger.info('.', extra=dict(continued=True))
-    dl_contents = _download_node_file(node_url)
-    logger.info('.', extra=dict(continued=True))
 
-    if is_WIN or is_CYGWIN:
-        ctx = zipfile.ZipFile(dl_contents)
-        members = operator.methodcaller('namelist')
-        member_name = lambda s: s  # noqa: E731
-    else:
-        ctx = tarfile_open(fileobj=dl_contents)
-        members = operator.methodcaller('getmembers')
-        member_name = operator.attrgetter('name')
-
-    with ctx as archive:
-        node_ver = re.escape(args.node)
-        rexp_string = r"node-v%s[^/]*/(README\.md|CHANGELOG\.md|LICENSE)"\
-            % node_ver
-        extract_list = [
-            member
-            for member in members(archive)
-            if re.match(rexp_string, member_name(member)) is None
-        ]
-        if sys.version_info >= (3, 12):
-            archive.extractall(src_dir, extract_list, filter="data")
+    def __init__(self, url, offset=0, n_attempt=3):
+        self.url = url
+        self.offset = offset
+        self.n_attempt = n_attempt
+        self.attempts = n_attempt
+        self.size = None
+        self.response = None
+        self._connected_at = offset
+        self._mirror = None
+        self._connect()
+
+    def _connect(self):
+        while self.response is None:
+            try:
+                self.response = self._open()
+                self._connected_at = self.offset
+                # failed mirrors have been demoted, the first one answered
+                self._mirror = mirrors[0] if _mirror_of(self.url) else None
+            except NETWORK_ERRORS as e:
+                if not _is_resumable_error(e):
+                    raise
+                self._fail(e)
+
+    def _open(self):
+        if not self.offset:
+            response = urlopen(self.url)
         else:
-            archive.extractall(src_dir, extract_list)
-
+            try:
+                response = urlopen(
+                    self.url, {'Range': 'bytes=%d-' % self.offset})
+            except urllib2.HTTPError as e:
+                content_range = _response_header(e, 'Content-Range') or ''
+                if e.code != 416 or \
+                        content_range != 'bytes */%d' % self.offset:
+                    raise
+                # everything has been downloaded already
+                self.size = self.offset
+                return io.BytesIO(b'')
+        length = _response_header(response, 'Content-Length')
+        if self.offset and response.getcode() != 206:
+            # the server ignored the range, skip what we already have
+            skip = self.offset
+            while skip:
+                chunk = response.read(min(skip, CHUNK_SIZE))
+                if not chunk:
+                    raise IncompleteRead(b'', skip)
+                skip -= len(chunk)
+            if length and length.isdigit():
+                self.size = int(length)
+        elif length and length.isdigit():
+            self.size = self.offset + int(length)
+        return response
+
+    def _fail(self, error):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+        # carry on from another mirror, if there is one
+        _demote_mirror(self._mirror)
+        self._mirror = None
+        if self.offset > self._connected_at:
+            # the connection made progress, only count failures in a row
+            self.attempts = self.n_attempt
+            self._connected_at = self.offset
+        self.attempts -= 1
+        logger.warning(
+            'Interrupted while reading '
+            'from {} - {}'.format(self.url, error)
+        )
+        if self.attempts <= 0:
+            raise error
+
+    def read(self, size=-1):
+        while True:
+            self._connect()
+            try:
+                if size is None or size < 0:
+                    chunk = self.response.read()
+                else:
+                    chunk = self.response.read(size)
+            except NETWORK_ERRORS as e:
+                chunk = getattr(e, 'partial', None) or b''
+                self.offset += len(chunk)
+                self._fail(e)
+            else:
+                self.offset += len(chunk)
+                if progress_callback is not None:
+                    progress_callback('download', 0, self.offset, self.size)
+                if not chunk and self.size is not None and \
+                        self.offset < self.size:
+                    # read(n) reports a dropped connection as plain EOF
+                    self._fail(
+                        IncompleteRead(b'', self.size - self.offset))
+            if chunk or self.response is not None:
+                return chunk
+
+    def close(self):
+        if self.response is not None:
+            self.response.close()
+            self.response = None
+
+
+def _is_resumable_error(error):
+    """
+    Whether a download that failed with ``error`` may be continued later.
+    HTTP errors are answers from the server and won't go away by retrying.
+    """
+    return isinstance(error, NETWORK_ERRORS) and \
+        not isinstance(error, urllib2.HTTPError)
 
-def urlopen(url):
-    home_url = "https://github.com/ekalinin/nodeenv/"
-    headers = {'User-Agent': 'nodeenv/%s (%s)' % (nodeenv_version, home_url)}
-    req = urllib2.Request(url, None, headers)
-    if ignore_ssl_certs:
-        # py27: protocol required, py3: optional
-        # https://github.com/ekalinin/nodeenv/issues/296
-        context = ssl.SSLContext(ssl.PROTOCOL_TLS)
-        context.verify_mode = ssl.CERT_NONE
-        return urllib2.urlopen(req, context=context)
-    return urllib2.urlopen(req)
 
-# ---------------------------------------------------------
-# Virtual environment functions
+def _response_header(response, name):
+    headers = getattr(response, 'headers', None)
+    return headers.get(name) if headers is not None else None
 
 
-def copytree(src, dst, symlinks=False, ignore=None):
-    for item in os.listdir(src):
-        s = os.path.join(src, item)
-        d = os.path.join(dst, item)
-        if os.path.isdir(s):
+def _probe_range_support(url):
+    """
+    Return the size of ``url`` if the server answers range requests
+    for it, otherwise None
+    """
+    with contextlib.closing(urlopen(url, {'Range': 'bytes=0-0'})) as resp:
+        # a server ignoring the range sends the whole body with a 200,
+        # which is dropped unread when the response is closed
+        content_range = _response_header(resp, 'Content-Range') or ''
+        if resp.getcode() != 206 or \
+                _response_header(resp, 'Accept-Ranges') == 'none':
+            return None
+        resp.read()
+    total = content_range.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _download_segmented(url, fileobj, size, segments, n_attempt=3):
+    """
+    Fetch ``url`` as ``segments`` byte ranges on a thread pool and
+    write each of them at its offset in ``fileobj``
+    """
+    logger.debug(' * Downloading %s in %d segments', url, segments)
+    fileobj.truncate(size)
+    lock = threading.Lock()
+    step = -(-size // segments)
+    done = [0]
+
+    def fetch(start, end):
+        attempts = n_attempt
+        while start <= end:
+            headers = {'Range': 'bytes=%d-%d' % (start, end)}
             try:
-                shutil.copytree(s, d, symlinks, ignore)
-            except OSError:
-                copytree(s, d, symlinks, ignore)
-        else:
-            if os.path.islink(s):
-                # copy link only if it not exists. #189
-                if not os.path.islink(d):
-                    os.symlink(os.readlink(s), d)
-            else:
-                shutil.copy2(s, d)
+                with contextlib.closing(urlopen(url, headers)) as response:
+                    if response.getcode() != 206:
+                        raise IOError('%s does not honour range requests'
+                                      % url)
+                    for chunk in iter(
+                            lambda: response.read(CHUNK_SIZE), b''):
+                        with lock:
+                            fileobj.seek(start)
+                            fileobj.write(chunk)
+                            done[0] += len(chunk)
+                            if progress_callback is not None:
+                                progress_callback(
+                                    'download', 0, done[0], size)
+                        start += len(chunk)
+                if start <= end:
+                    raise IncompleteRead(b'', end - start + 1)
+            except NETWORK_ERRORS as e:
+                if not _is_resumable_error(e):
+                    raise
+                # carry on from the last byte written
+                attempts -= 1
+                logger.warning(
+                    'Interrupted while reading '
+                    'from {} - {}'.format(url, e)
+                )
+                if attempts == 0:
+                    raise
+
+    with ThreadPoolExecutor(max_workers=segments) as pool:
+        futures = [
+            pool.submit(fetch, start, min(start + step, size) - 1)
+            for start in range(0, size, step)
+        ]
+        for future in futures:
+            future.result()
+    fileobj.flush()
 
 
-def copy_node_from_prebuilt(env_dir, src_dir, node_version):
+def download_node_src(node_url, src_dir, args):
     """
-    Copy prebuilt binaries into environment
+    Download source code
     """
     logger.info('.', extra=dict(continued=True))
-    if is_WIN:
-        dest = join(env_dir, 'Scripts')
-        mkdir(dest)
-    elif is_CYGWIN:
-        dest = join(env_dir, 'bin')
-        mkdir(dest)
-        # write here to avoid https://bugs.python.org/issue35650
-        writefile(join(env_dir, 'bin', 'node'), CYGWIN_NODE)
+    keep = _member_filter(args)
+    decompress = _system_decompressor(node_url, args.extractor)
+
+    segments = int(args.download_segments)
+    sha256 = get_expected_sha256(node_url)
+    if sha256 is None:
+        logger.debug(' * No published checksum for %s', node_url)
+
+    # a cache entry is only used if its recorded digest matches
+    cached = cache_lookup(node_url, sha256)
+    if cached:
+        logger.debug(' * Using cached %s', cached)
+        dl_contents = open(cached, 'rb')
+    elif offline and not node_url.startswith('file:'):
+        raise OfflineError(
+            '%s is not in the download cache, run nodeenv once '
+            'without --offline to fetch it' % node_url)
+    elif is_WIN or is_CYGWIN or segments > 1 or \
+            decompress and args.extractor == 'system':
+        # zip archives need random access, segmented downloads are
+        # assembled on disk and the system tar reads a file, so they
+        # are downloaded first
+        dl_contents = _fetch_node_archive(node_url, segments, sha256)
     else:
-        dest = env_dir
+        _stream_node_archive(node_url, src_dir, keep, sha256)
+        logger.info('.', extra=dict(continued=True))
+        return
 
-    src_folder_tpl = src_dir + to_utf8('/node-v%s*' % node_version)
-    src_folder, = glob.glob(src_folder_tpl)
-    copytree(src_folder, dest, True)
+    with dl_contents:
+        logger.info('.', extra=dict(continued=True))
 
-    if is_CYGWIN:
-        for filename in ('npm', 'npx', 'node.exe'):
-            filename = join(env_dir, 'bin', filename)
-            if os.path.exists(filename):
-                make_executable(filename)
+        if decompress is not None:
+            _system_extract(dl_contents, src_dir, keep, decompress)
+            return
 
-    logger.info('.', extra=dict(continued=True))
+        if is_WIN or is_CYGWIN:
+            with zipfile.ZipFile(dl_contents) as archive:
+                extract_list = [
+                    name for name in archive.namelist() if keep(name)
+                ]
+                _extractall(archive, src_dir, extract_list)
+        else:
+            _extract_tar(dl_contents, src_dir, lambda archive: (
+                member for member in archive if keep(member.name)))
 
 
-def build_node_from_src(env_dir, src_dir, node_src_dir, args):
-    env = {}
-    make_param_names = ['load-average', 'jobs']
-    make_param_values = map(
-        lambda x: getattr(args, x.replace('-', '_')),
-        make_param_names)
-    make_opts = [
-        '--{0}={1}'.format(name, value)
-        if len(value) > 0 else '--{0}'.format(name)
-        for name, value in zip(make_param_names, make_param_values)
-        if value is not None
-    ]
+def _member_filter(args):
+    """
+    Return a predicate telling which archive members to extract
+    """
+    node_ver = re.escape(args.node)
+    skipped = ['README\\.md', 'CHANGELOG\\.md', 'LICENSE']
+    if args.prebuilt:
+        # the sources are needed in full to build node.js
+        skipped += EXTRACT_PROFILES[args.profile_extract]
+    rexp = re.compile(
+        r"node-v%s[^/]*/(%s)" % (node_ver, '|'.join(skipped)))
+    return lambda name: rexp.match(name) is None
+
+
+def _extractall(archive, path, members):
+    if progress_callback is not None:
+        members = _extract_progress(members)
+    if isinstance(archive, tarfile.TarFile):
+        _extract_members(archive, path, members)
+    elif sys.version_info >= (3, 12):
+        archive.extractall(path, members, filter="data")
+    else:
+        archive.extractall(path, members)
 
-    if getattr(sys.version_info, 'major', sys.version_info[0]) > 2:
-        # Currently, the node.js build scripts are using python2.*,
-        # therefore we need to temporarily point python exec to the
-        # python 2.* version in this case.
-        python2_path = shutil.which('python2')
-        if not python2_path:
-            raise OSError(
-                'Python >=3.0 virtualenv detected, but no python2 '
-                'command (required for building node.js) was found'
-            )
-        logger.debug(' * Temporarily pointing python to %s', python2_path)
-        node_tmpbin_dir = join(src_dir, 'tmpbin')
-        node_tmpbin_link = join(node_tmpbin_dir, 'python')
-        mkdir(node_tmpbin_dir)
-        if not os.path.exists(node_tmpbin_link):
-            callit(['ln', '-s', python2_path, node_tmpbin_link])
-        env['PATH'] = '{}:{}'.format(node_tmpbin_dir,
-                                     os.environ.get('PATH', ''))
 
-    conf_cmd = [
-        './configure',
-        '--prefix=%s' % _quote(env_dir)
-    ]
-    if args.without_ssl:
-        conf_cmd.append('--without-ssl')
-    if args.debug:
-        conf_cmd.append('--debug')
-    if args.profile:
-        conf_cmd.append('--profile')
+def _extract_tar(fileobj, path, select):
+    """
+    Extract the tar archive read from ``fileobj`` into ``path`` with
+    three stages running at once: a thread decompresses the stream,
+    the calling thread parses the members ``select`` yields from the
+    archive and a pool of threads writes the files.
+    """
+    with contextlib.closing(_InflateReader(fileobj)) as raw:
+        with tarfile_open(fileobj=raw, mode='r|',
+                          bufsize=CHUNK_SIZE) as archive:
+            _extractall(archive, path, select(archive))
 
-    make_cmd = args.make_path
 
-    callit(conf_cmd, args.verbose, True, node_src_dir, env)
-    logger.info('.', extra=dict(continued=True))
-    callit([make_cmd] + make_opts, args.verbose, True, node_src_dir, env)
-    logger.info('.', extra=dict(continued=True))
-    callit([make_cmd + ' install'], args.verbose, True, node_src_dir, env)
+def _extract_members(archive, path, members):
+    """
+    Extract ``members`` of the tar ``archive``, read as a stream, like
+    ``archive.extractall()`` does. Directories are created as they come
+    and small files are handed to COPY_JOBS writer threads; links are
+    made once all files are in place and the attributes of directories
+    are set last, so the writes don't change them.
+    """
+    data_filter = sys.version_info >= (3, 12)
+    made = set()
+
+    def makedirs(directory):
+        if directory not in made:
+            os.makedirs(directory, exist_ok=True)
+            made.add(directory)
+
+    directories = []
+    links = []
+    pending = _ByteBudget(EXTRACT_BUFFER_LIMIT)
+    futures = []
+    with ThreadPoolExecutor(COPY_JOBS) as pool:
+        for member in members:
+            if data_filter:
+                member = tarfile.data_filter(member, path)
+            target = join(path, member.name)
+            if member.isdir():
+                makedirs(target)
+                directories.append((member, target))
+            elif not member.isfile():
+                links.append(member)
+            elif member.size > EXTRACT_BUFFER_SIZE:
+                makedirs(os.path.dirname(target))
+                with open(target, 'wb') as f:
+                    shutil.copyfileobj(
+                        archive.extractfile(member), f, CHUNK_SIZE)
+                _set_member_attrs(archive, member, target)
+            else:
+                makedirs(os.path.dirname(target))
+                # bounds the data waiting for a writer
+                pending.take(member.size)
+                data = archive.extractfile(member).read()
+                future = pool.submit(
+                    _write_member, archive, member, target, data)
+                future.add_done_callback(
+                    lambda _, size=member.size: pending.give(size))
+                futures.append(future)
+        for future in futures:
+            future.result()
+
+    for member in links:
+        if data_filter:
+            archive.extract(member, path, filter='data')
+        else:
+            archive.extract(member, path)
+    for member, target in sorted(directories, key=lambda d: d[0].name,
+                                 reverse=True):
+        _set_member_attrs(archive, member, target)
 
 
-def install_node(env_dir, src_dir, args):
+class _ByteBudget(object):
     """
-    Download source code for node.js, unpack it
-    and install it in virtual environment.
+    Counts the bytes in flight; taking more than ``limit`` waits until
+    enough are given back. One taker is let through alone even if it
+    is over the limit.
     """
-    try:
-        install_node_wrapped(env_dir, src_dir, args)
-    except BaseException:
-        # this restores the newline suppressed by continued=True
-        logger.info('')
-        raise
 
+    def __init__(self, limit):
+        self._limit = limit
+        self._used = 0
+        self._cond = threading.Condition()
 
-def install_node_wrapped(env_dir, src_dir, args):
-    env_dir = abspath(env_dir)
-    node_src_dir = join(src_dir, to_utf8('node-v%s' % args.node))
-    src_type = "prebuilt" if args.prebuilt else "source"
+    def take(self, size):
+        with self._cond:
+            while self._used and self._used + size > self._limit:
+                self._cond.wait()
+            self._used += size
 
-    logger.info(' * Install %s node (%s) ' % (src_type, args.node),
-                extra=dict(continued=True))
+    def give(self, size):
+        with self._cond:
+            self._used -= size
+            self._cond.notify_all()
 
-    if args.prebuilt:
-        node_url = get_node_bin_url(args.node)
-    else:
-        node_url = get_node_src_url(args.node)
 
-    # get src if not downloaded yet
-    if not os.path.exists(node_src_dir):
+def _write_member(archive, member, target, data):
+    with open(target, 'wb') as f:
+        f.write(data)
+    _set_member_attrs(archive, member, target)
+
+
+def _set_member_attrs(archive, member, target):
+    archive.chown(member, target, False)
+    archive.chmod(member, target)
+    archive.utime(member, target)
+
+
+class _InflateReader(object):
+    """
+    File-like reader of the decompressed contents of a gzip or xz
+    stream. A thread reads and decompresses ahead, so zlib and lzma,
+    which release the GIL, run alongside the tar parser.
+    """
+    depth = 16
+
+    def __init__(self, fileobj):
+        self._queue = queue.Queue(self.depth)
+        self._closed = threading.Event()
+        self._buf = bytearray()
+        self._error = None
+        self._eof = False
+        self._thread = threading.Thread(target=self._run, args=(fileobj,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    @staticmethod
+    def _decompressor(head):
+        if head.startswith(b'\x1f\x8b'):
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if head.startswith(b'\xfd7zXZ\x00') and has_lzma:
+            return lzma.LZMADecompressor()
+        # uncompressed, or left for tarfile to reject
+        return None
+
+    def _run(self, fileobj):
         try:
-            download_node_src(node_url, src_dir, args)
-        except urllib2.HTTPError:
-            if "arm64" in node_url:
-                # if arm64 not found, try x64
-                download_node_src(node_url.replace('arm64', 'x64'),
-                                  src_dir, args)
+            chunk = fileobj.read(CHUNK_SIZE)
+            decompressor = self._decompressor(chunk)
+            while chunk and not self._closed.is_set():
+                if decompressor is None:
+                    data = chunk
+                elif decompressor.eof:
+                    # data after the end of the stream is ignored,
+                    # like tarfile does
+                    data = None
+                else:
+                    data = decompressor.decompress(chunk)
+                if data:
+                    self._queue.put(data)
+                chunk = fileobj.read(CHUNK_SIZE)
+            self._queue.put(None)
+        except BaseException as e:
+            self._queue.put(e)
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or len(self._buf) < size):
+            item = self._queue.get()
+            if item is None:
+                self._eof = True
+            elif isinstance(item, BaseException):
+                self._error = item
+                self._eof = True
             else:
-                logger.warning('Failed to download from %s' % node_url)
-                raise
+                self._buf.extend(item)
+        if self._error is not None and not self._buf:
+            raise self._error
+        if size < 0:
+            size = len(self._buf)
+        data = bytes(self._buf[:size])
+        del self._buf[:size]
+        return data
+
+    def close(self):
+        """Stop the thread, once it is done with ``fileobj``"""
+        self._closed.set()
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
 
-    logger.info('.', extra=dict(continued=True))
 
-    if args.prebuilt:
-        copy_node_from_prebuilt(env_dir, src_dir, args.node)
+def _system_decompressor(node_url, extractor):
+    """
+    Return the command decompressing the archive at ``node_url`` for
+    the system tar, or None to extract it with tarfile
+    """
+    if extractor == 'python' or is_WIN or is_CYGWIN:
+        return None
+    for ext, cmd in SYSTEM_DECOMPRESSORS.items():
+        if node_url.endswith(ext):
+            break
     else:
-        build_node_from_src(env_dir, src_dir, node_src_dir, args)
+        return None
+    if shutil.which('tar') is None or shutil.which(cmd[0]) is None:
+        logger.debug(' * No tar or %s, extracting with tarfile', cmd[0])
+        return None
+    return cmd
 
-    logger.info(' done.')
 
+def _system_extract(fileobj, src_dir, keep, decompress):
+    """
+    Extract the tar archive ``fileobj`` into ``src_dir`` by piping it
+    through ``decompress`` into the system tar.
 
-def install_npm(env_dir, _src_dir, args):
+    Everything is extracted into a temporary directory first. The
+    members ``keep`` rejects are removed from it, and links leading out
+    of it or special files fail the extraction, as with the "data"
+    filter of tarfile, before the rest is moved into ``src_dir``.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='.extract-', dir=src_dir)
+    try:
+        fileobj.seek(0)
+        unpack = subprocess.Popen(decompress, stdin=fileobj,
+                                  stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE)
+        untar = subprocess.Popen(
+            ['tar', '-xf', '-', '-C', tmp_dir,
+             '--no-same-owner', '--no-same-permissions'],
+            stdin=unpack.stdout, stderr=subprocess.PIPE)
+        # tar gets EOF when the decompressor exits
+        unpack.stdout.close()
+        errors = [(untar,) + untar.communicate()]
+        errors.insert(0, (unpack,) + unpack.communicate())
+        for proc, _, err in errors:
+            if proc.returncode:
+                raise OSError('%s failed: %s' % (
+                    proc.args[0], err.decode('utf-8', 'replace').strip()))
+        _check_extracted(tmp_dir, keep)
+        movetree(tmp_dir, src_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _check_extracted(path, keep):
+    """
+    Remove what ``keep`` rejects from the tree the system tar extracted
+    into ``path`` and fail on what the "data" filter would refuse
+    """
+    real_path = os.path.realpath(path)
+    for root, dirs, files in os.walk(path):
+        rel = os.path.relpath(root, path).replace(os.sep, '/')
+        rel = '' if rel == '.' else rel + '/'
+        for name in list(dirs):
+            if not keep(rel + name + '/'):
+                dirs.remove(name)
+                if os.path.islink(join(root, name)):
+                    os.remove(join(root, name))
+                else:
+                    shutil.rmtree(join(root, name))
+        for name in files + dirs:
+            filename = join(root, name)
+            if name in files and not keep(rel + name):
+                os.remove(filename)
+                continue
+            mode = os.lstat(filename).st_mode
+            if stat.S_ISLNK(mode):
+                target = os.path.realpath(filename)
+                if not (target + os.sep).startswith(real_path + os.sep):
+                    raise OSError('%s links outside the archive: %s' % (
+                        rel + name, os.readlink(filename)))
+            elif not (stat.S_ISREG(mode) or stat.S_ISDIR(mode)):
+                raise OSError('%s is a special file' % (rel + name))
+
+
+def _extract_progress(members):
+    files = nbytes = 0
+    for member in members:
+        yield member
+        # zip members are plain names
+        files += 1
+        nbytes += getattr(member, 'size', 0)
+        progress_callback('extract', files, nbytes, None)
+
+
+def _fetch_node_archive(node_url, segments=1, sha256=None):
+    """
+    Return a seekable file object with the contents of ``node_url``.
+    The archive is streamed to disk, straight into the cache when
+    it is enabled, and checked against the expected ``sha256``.
+    """
+    path = _cache_entry(node_url)
+    if path is None:
+        dl_contents, actual = _download_node_file(
+            node_url, segments=segments)
+        _check_sha256(node_url, sha256, actual)
+        return dl_contents
+
+    part_path = _claim_part(path)
+    # a segmented download fills the file out of order, so what it
+    # leaves behind has holes and is no prefix to resume from
+    resumable = segments <= 1 or os.path.getsize(part_path) > 0
+    try:
+        with open(part_path, 'r+b') as f:
+            _, actual = _download_node_file(
+                node_url, fileobj=f, segments=segments)
+        _check_sha256(node_url, sha256, actual)
+    except NETWORK_ERRORS as e:
+        if resumable and _is_resumable_error(e):
+            _release_part(path, part_path)
+        else:
+            os.remove(part_path)
+        raise
+    except BaseException:
+        os.remove(part_path)
+        raise
+    return open(_cache_commit(node_url, part_path, actual), 'rb')
+
+
+def _claim_part(path):
+    """
+    Return a private ``.part`` file for the cache entry at ``path``.
+    A partial download left behind by an earlier run is taken over,
+    so that only the missing bytes are downloaded.
+    """
+    mkdir(os.path.dirname(path))
+    part_path = '%s.%d.part' % (path, os.getpid())
+    try:
+        # renaming is atomic, so only one process resumes it
+        os.rename(path + '.part', part_path)
+        logger.debug(' * Resuming partial download %s', part_path)
+    except OSError:
+        open(part_path, 'wb').close()
+    return part_path
+
+
+def _release_part(path, part_path):
+    """
+    Leave what was downloaded so far for the next run to resume
+    """
+    if os.path.getsize(part_path):
+        os.replace(part_path, path + '.part')
+    else:
+        os.remove(part_path)
+
+
+class _TeeReader(object):
+    """
+    File-like wrapper which hashes everything read from ``fileobj``
+    and copies it into ``sink``. The contents of ``prefix`` are read
+    (and hashed) first, but not copied.
+    """
+
+    def __init__(self, fileobj, sink=None, prefix=None):
+        self.fileobj = fileobj
+        self.sink = sink
+        self.prefix = prefix
+        self.digest = hashlib.sha256()
+
+    def read(self, size=-1):
+        if self.prefix is not None:
+            chunk = self.prefix.read(size)
+            if chunk:
+                self.digest.update(chunk)
+                return chunk
+            self.prefix.close()
+            self.prefix = None
+        chunk = self.fileobj.read(size)
+        self.digest.update(chunk)
+        if self.sink is not None:
+            self.sink.write(chunk)
+        return chunk
+
+    def drain(self):
+        """Consume whatever the reader of the stream left behind"""
+        for _ in iter(lambda: self.read(CHUNK_SIZE), b''):
+            pass
+
+
+def _stream_node_archive(node_url, src_dir, keep, sha256=None):
+    """
+    Download, decompress and extract a tar archive in a single pass,
+    so network transfer, decompression and file writes overlap.
+    The archive is hashed and saved into the cache on the way; on a
+    checksum mismatch the extracted files are removed again.
+    """
+    path = _cache_entry(node_url)
+    part_path = path and _claim_part(path)
+    offset = os.path.getsize(part_path) if part_path else 0
+    extracted = set()
+
+    def members(archive):
+        for member in archive:
+            if keep(member.name):
+                top = member.name.split('/', 1)[0]
+                if top not in ('', '.', '..'):
+                    extracted.add(top)
+                yield member
+
+    sink = open(part_path, 'ab') if part_path else None
+    prefix = open(part_path, 'rb') if offset else None
+    try:
+        with contextlib.closing(
+                _ResumableReader(node_url, offset)) as response:
+            tee = _TeeReader(response, sink, prefix)
+            _extract_tar(tee, src_dir, members)
+            tee.drain()
+        _check_sha256(node_url, sha256, tee.digest.hexdigest())
+    except BaseException as e:
+        for name in extracted:
+            shutil.rmtree(join(src_dir, name), ignore_errors=True)
+        if sink is not None:
+            sink.close()
+            if _is_resumable_error(e):
+                _release_part(path, part_path)
+            else:
+                os.remove(part_path)
+        raise
+    finally:
+        if prefix is not None:
+            prefix.close()
+        if sink is not None:
+            sink.close()
+
+    if part_path:
+        _cache_commit(node_url, part_path, tee.digest.hexdigest())
+
+
+def urlopen(url, headers=None):
+    """
+    Open ``url``, trying the same file on the other mirrors when
+    the mirror it belongs to fails
+    """
+    candidates = _mirror_candidates(url)
+    for candidate in candidates:
+        try:
+            return _urlopen(candidate, headers)
+        except NETWORK_ERRORS as e:
+            if candidate == candidates[-1] or not _is_failover_error(e):
+                raise
+            logger.warning(' * Failed to fetch %s - %s', candidate, e)
+            if not isinstance(e, urllib2.HTTPError) or e.code >= 500:
+                _demote_mirror(_mirror_of(candidate))
+
+
+def _urlopen(url, headers=None):
+    if url.startswith('file:'):
+        return _open_file_url(url, headers or {})
+    if offline:
+        raise OfflineError('Can not fetch %s in offline mode' % url)
+    home_url = "https://github.com/ekalinin/nodeenv/"
+    headers = dict(headers or {})
+    headers['User-Agent'] = 'nodeenv/%s (%s)' % (nodeenv_version, home_url)
+    if _is_poolable(url):
+        return _pool.request(url, headers)
+    req = urllib2.Request(url, None, headers)
+    if ignore_ssl_certs:
+        return urllib2.urlopen(
+            req, timeout=STALL_TIMEOUT, context=_ssl_context())
+    return urllib2.urlopen(req, timeout=STALL_TIMEOUT)
+
+
+class _FileResponse(io.BufferedReader):
+    """
+    Local file opened by ``urlopen`` with the bits of an HTTP response
+    the download code looks at
+    """
+
+    def __init__(self, raw, url, code, headers):
+        io.BufferedReader.__init__(self, raw, CHUNK_SIZE)
+        self.url = url
+        self.code = code
+        self.headers = headers
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+
+def _open_file_url(url, headers):
+    """
+    Open a ``file://`` url straight from disk, answering range
+    requests like a web server would
+    """
+    path = urllib2.url2pathname(urlsplit(url).path)
+    try:
+        raw = io.FileIO(path, 'rb')
+    except (IOError, OSError) as e:
+        raise urllib2.HTTPError(url, 404, str(e), {}, None)
+    size = os.fstat(raw.fileno()).st_size
+    byte_range = _byte_range(headers.get('Range'), size)
+    if byte_range is None:
+        return _FileResponse(raw, url, 200, {'Content-Length': str(size)})
+    start, end = byte_range
+    if start > end:
+        raw.close()
+        raise urllib2.HTTPError(url, 416, 'Range Not Satisfiable',
+                                {'Content-Range': 'bytes */%d' % size},
+                                None)
+    raw.seek(start)
+    # reads may run past ``end``; callers stop at Content-Length
+    return _FileResponse(raw, url, 206, {
+        'Content-Length': str(end - start + 1),
+        'Content-Range': 'bytes %d-%d/%d' % (start, end, size),
+    })
+
+
+def _byte_range(header, size):
+    """
+    Return the first and last byte the ``Range`` header asks for out
+    of ``size`` bytes, or None to send everything. The first byte is
+    past the last one if the range can not be satisfied.
+    """
+    match = re.match(r'bytes=(\d+)-(\d*)$', header or '')
+    if not match:
+        return None
+    start = int(match.group(1))
+    return start, min(int(match.group(2) or size - 1), size - 1)
+
+
+_ssl_contexts = {}
+
+
+def _ssl_context():
+    """
+    Return the SSL context for downloads, created once per process
+    """
+    if ignore_ssl_certs not in _ssl_contexts:
+        if ignore_ssl_certs:
+            # py27: protocol required, py3: optional
+            # https://github.com/ekalinin/nodeenv/issues/296
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS)
+            context.verify_mode = ssl.CERT_NONE
+        else:
+            context = ssl.create_default_context()
+        _ssl_contexts[ignore_ssl_certs] = context
+    return _ssl_contexts[ignore_ssl_certs]
+
+
+def _is_poolable(url):
+    """
+    Plain HTTP(S) requests go through the connection pool; proxied
+    ones and other schemes are left to urllib
+    """
+    parts = urlsplit(url)
+    if not is_PY3 or parts.scheme not in ('http', 'https'):
+        return False
+    return parts.scheme not in urllib2.getproxies() or \
+        bool(urllib2.proxy_bypass(parts.hostname))
+
+
+class _HTTPSConnection(httplib.HTTPSConnection):
+    """
+    HTTPS connection which resumes ``tls_session`` when it connects,
+    saving a full TLS handshake
+    """
+    tls_session = None
+
+    def connect(self):
+        httplib.HTTPConnection.connect(self)
+        self.sock = self._context.wrap_socket(
+            self.sock, server_hostname=self.host, session=self.tls_session)
+        self.tls_session = self.sock.session
+
+
+class _PooledResponse(object):
+    """
+    Response read from a pooled connection. The connection goes back
+    to the pool as soon as the body has been read completely.
+    """
+
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = self.code = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+
+    def getcode(self):
+        return self.status
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self, amt=None):
+        if amt is not None and amt < 0:
+            amt = None
+        data = self._response.read(amt)
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def _release(self):
+        if self._conn is not None:
+            self._pool.checkin(self._key, self._conn)
+            self._conn = None
+
+    def close(self):
+        if self._response.isclosed():
+            self._release()
+        elif self._conn is not None:
+            # unread data left on the wire, the connection can't be reused
+            self._response.close()
+            self._conn.close()
+            self._conn = None
+
+
+class _ConnectionPool(object):
+    """
+    Persistent HTTP(S) connections per host, so that repeated requests
+    to nodejs.org or a mirror skip the DNS, TCP and TLS handshakes
+    """
+    max_idle = 4
+    max_redirects = 5
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._tls_sessions = {}
+
+    def checkout(self, key):
+        """
+        Return an idle connection to ``key`` or a new one, and whether
+        it was used before
+        """
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = _HTTPSConnection(host, port, timeout=STALL_TIMEOUT,
+                                    context=_ssl_context())
+            conn.tls_session = self._tls_sessions.get(key)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=STALL_TIMEOUT)
+        return conn, False
+
+    def checkin(self, key, conn):
+        if isinstance(conn, _HTTPSConnection) and conn.sock is not None:
+            # TLS 1.3 servers send the session ticket after the
+            # handshake, it has come in with the response
+            conn.tls_session = conn.sock.session
+        if getattr(conn, 'tls_session', None) is not None:
+            self._tls_sessions[key] = conn.tls_session
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def _send(self, key, path, headers):
+        while True:
+            conn, reused = self.checkout(key)
+            try:
+                conn.request('GET', path, headers=headers)
+                return conn, conn.getresponse()
+            except (httplib.HTTPException, socket.error) as e:
+                conn.close()
+                if not reused:
+                    raise urllib2.URLError(e)
+                # the server dropped the idle connection, try a new one
+
+    def request(self, url, headers):
+        for _ in range(self.max_redirects + 1):
+            parts = urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            conn, response = self._send(key, path, headers)
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                self.checkin(key, conn)
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                body = response.read()
+                self.checkin(key, conn)
+                raise urllib2.HTTPError(url, response.status, response.reason,
+                                        response.msg, io.BytesIO(body))
+            return _PooledResponse(self, key, conn, response, url)
+        raise urllib2.HTTPError(url, response.status, 'Too many redirects',
+                                response.msg, None)
+
+
+_pool = _ConnectionPool()
+
+# ---------------------------------------------------------
+# Mirrors
+
+
+def get_mirror_urls(mirror):
+    """
+    Return the base URLs of the comma separated ``mirror`` list.
+    Plain host names stand for the layout of nodejs.org.
+    """
+    urls = []
+    for name in mirror.split(','):
+        name = name.strip().rstrip('/')
+        if not name:
+            continue
+        if '://' not in name:
+            name = 'https://%s/download/release' % name
+        urls.append(name)
+    return urls
+
+
+def _probe_mirror(url):
+    """
+    Return the estimated number of seconds a node.js archive takes to
+    download from the mirror at ``url``, or None if it failed
+    """
+    start = time.time()
+    try:
+        response = _urlopen(
+            url + '/index.json',
+            {'Range': 'bytes=0-%d' % (MIRROR_PROBE_SIZE - 1)})
+        with contextlib.closing(response):
+            latency = time.time() - start
+            size = len(response.read(MIRROR_PROBE_SIZE))
+    except NETWORK_ERRORS as e:
+        logger.debug(' * Mirror %s failed: %s', url, e)
+        return None
+    throughput = size / max(time.time() - start - latency, 0.001)
+    return latency + MIRROR_ARCHIVE_SIZE / max(throughput, 1)
+
+
+def rank_mirrors(urls):
+    """
+    Return ``urls`` ordered from the fastest mirror to the slowest.
+    All mirrors are probed at once, unless they were ranked less than
+    ``MIRROR_RANK_TTL`` seconds ago.
+    """
+    if len(urls) < 2:
+        return list(urls)
+    root = get_cache_dir()
+    path = join(root, 'mirrors.json') if root else None
+    rankings = (_read_json(path) if path else None) or {}
+    key = ','.join(urls)
+    cached = rankings.get(key)
+    if cached and time.time() - cached['ranked'] < MIRROR_RANK_TTL:
+        return cached['ranking']
+
+    with ThreadPoolExecutor(len(urls)) as pool:
+        scores = list(pool.map(_probe_mirror, urls))
+    order = sorted(range(len(urls)),
+                   key=lambda i: (scores[i] is None, scores[i] or 0))
+    ranking = [urls[i] for i in order]
+    logger.debug(' * Mirrors ranked: %s', ', '.join(ranking))
+
+    if path and any(score is not None for score in scores):
+        rankings[key] = {'ranking': ranking, 'ranked': time.time()}
+        try:
+            mkdir(root)
+            _write_json(path, rankings)
+        except (IOError, OSError) as e:
+            logger.warning(' * Failed to cache %s: %s', path, e)
+    return ranking
+
+
+def _mirror_of(url):
+    for base in mirrors:
+        if url.startswith(base + '/'):
+            return base
+    return None
+
+
+def _mirror_candidates(url):
+    """
+    Return ``url`` followed by the same file on the other mirrors,
+    in the order they should be tried
+    """
+    base = _mirror_of(url)
+    if base is None or len(mirrors) < 2:
+        return [url]
+    path = url[len(base):]
+    return [mirror + path for mirror in list(mirrors)]
+
+
+def _canonical_url(url):
+    """
+    Return ``url`` as served by the same mirror whichever one is
+    ranked first, so that cache entries outlive the ranking
+    """
+    base = _mirror_of(url)
+    if base is None:
+        return url
+    return min(mirrors) + url[len(base):]
+
+
+def _demote_mirror(base):
+    """
+    Move the failing mirror ``base`` behind the others
+    """
+    with _mirrors_lock:
+        if base is None or len(mirrors) < 2 or mirrors[0] != base:
+            return
+        mirrors.append(mirrors.pop(0))
+        logger.warning(' * Switching from mirror %s to %s',
+                       base, mirrors[0])
+
+
+def _is_failover_error(error):
+    """
+    Whether another mirror may succeed where one failed with ``error``
+    """
+    if isinstance(error, urllib2.HTTPError):
+        # a 404 is tried elsewhere too, mirrors can lag behind
+        return error.code == 404 or error.code >= 500
+    return True
+
+# ---------------------------------------------------------
+# Download cache
+
+
+def get_cache_dir():
+    """
+    Return the root of the download cache or None if it is disabled
+    """
+    if cache_dir is not None:
+        return os.path.expanduser(cache_dir) or None
+    if is_WIN:
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or \
+            join(os.path.expanduser('~'), '.cache')
+    return join(base, 'nodeenv')
+
+
+def _cache_entry(url):
+    """
+    Return the path under which ``url`` is cached or None
+    """
+    root = get_cache_dir()
+    if not root or url.startswith('file:'):
+        # local mirrors are as fast as the cache
+        return None
+    url = _canonical_url(url)
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    filename = url.rstrip('/').rsplit('/', 1)[-1]
+    return join(root, 'dist', '%s-%s' % (key, filename))
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _write_json(path, data):
+    """
+    Atomically replace ``path`` with ``data`` serialized as JSON
+    """
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def cache_lookup(url, sha256=None):
+    """
+    Return the path of the cached copy of ``url`` or None.
+
+    If ``sha256`` is given, the cached copy must have that digest.
+    """
+    path = _cache_entry(url)
+    if path is None or not os.path.isfile(path):
+        return None
+    meta = _read_json(path + '.json')
+    if not meta or meta.get('url') != _canonical_url(url) or \
+            meta.get('size') != os.path.getsize(path):
+        return None
+    if sha256 is not None and meta.get('sha256') != sha256:
+        return None
+    # mtime is the LRU clock
+    os.utime(path, None)
+    return path
+
+
+def cache_store(url, fileobj):
+    """
+    Copy ``fileobj`` into the cache as the archive for ``url``.
+    Returns the path of the cache entry or None if caching is disabled.
+    """
+    path = _cache_entry(url)
+    if path is None:
+        return None
+    mkdir(os.path.dirname(path))
+
+    part_path = '%s.%d.part' % (path, os.getpid())
+    digest = hashlib.sha256()
+    try:
+        with open(part_path, 'wb') as f:
+            for chunk in iter(lambda: fileobj.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                f.write(chunk)
+    except (IOError, OSError) as e:
+        logger.warning(' * Failed to cache %s: %s', url, e)
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        return None
+    return _cache_commit(url, part_path, digest.hexdigest())
+
+
+def _cache_commit(url, part_path, sha256):
+    """
+    Move a fully downloaded ``part_path`` into place as the cache entry
+    for ``url`` and return the path of the entry
+    """
+    path = _cache_entry(url)
+    os.replace(part_path, path)
+    _write_json(path + '.json', {
+        'url': _canonical_url(url),
+        'sha256': sha256,
+        'size': os.path.getsize(path),
+    })
+    _cache_evict(keep=path)
+    return path
+
+
+def _cache_evict(keep=None):
+    """
+    Remove least recently used archives until the cache fits
+    into ``cache_size``
+    """
+    dist_dir = join(get_cache_dir(), 'dist')
+    entries = []
+    for name in os.listdir(dist_dir):
+        path = join(dist_dir, name)
+        if name.endswith(('.json', '.tmp')) or path == keep or \
+                re.search(r'\.\d+\.part$', name):
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            # removed by a concurrent run
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    if keep is not None:
+        total += os.path.getsize(keep)
+    for _, size, path in sorted(entries):
+        if total <= cache_size:
+            break
+        logger.debug(' * Evicting %s from cache', path)
+        for victim in (path, path + '.json'):
+            try:
+                os.remove(victim)
+            except OSError:
+                pass
+        total -= size
+
+# ---------------------------------------------------------
+# Caching proxy
+
+
+class _CacheServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the release tree of the mirror in use from the download
+    cache, filling the cache from the mirror on a miss
+    """
+    daemon_threads = True
+
+    def __init__(self, address):
+        HTTPServer.__init__(self, address, _CacheHandler)
+        self._lock = threading.Lock()
+        self._filling = {}
+
+    def fill(self, url):
+        """
+        Make sure ``url`` is cached and return its path. Concurrent
+        misses for the same url wait for a single download.
+        """
+        with self._lock:
+            path = self._lookup(url)
+            if path:
+                return path
+            event = self._filling.get(url)
+            owner = event is None
+            if owner:
+                event = self._filling[url] = threading.Event()
+        if not owner:
+            event.wait()
+            path = self._lookup(url)
+            if path is None:
+                raise IOError('Failed to fetch %s' % url)
+            return path
+        try:
+            sha256 = None
+            if not url.endswith('.txt') and not url.endswith('.json'):
+                sha256 = get_expected_sha256(url)
+            _fetch_node_archive(url, sha256=sha256).close()
+            # served from the cache entry, not the temporary file a
+            # failed cache write leaves
+            path = cache_lookup(url)
+            if path is None:
+                raise IOError('Failed to cache %s' % url)
+            return path
+        finally:
+            with self._lock:
+                del self._filling[url]
+            event.set()
+
+    @staticmethod
+    def _lookup(url):
+        path = cache_lookup(url)
+        # release archives never change, the listings do
+        if path and url.rsplit('/', 1)[-1] in SERVE_CACHE_MUTABLE and \
+                time.time() - os.path.getmtime(path + '.json') > index_ttl:
+            return None
+        return path
+
+
+class _CacheHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger.debug(' * %s %s', self.address_string(), format % args)
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        path = urlsplit(self.path).path
+        if not path.startswith('/') or '..' in path.split('/'):
+            self.send_error(404)
+            return
+        url = src_base_url + path
+        try:
+            cached = self.server.fill(url)
+        except urllib2.HTTPError as e:
+            self.send_error(404 if e.code == 404 else 502)
+            return
+        except NETWORK_ERRORS + (IOError, OSError) as e:
+            logger.warning(' * Failed to fetch %s: %s', url, e)
+            self.send_error(502)
+            return
+
+        with open(cached, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            byte_range = _byte_range(self.headers.get('Range'), size)
+            if byte_range is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = byte_range
+                if start > end:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % size)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 'bytes %d-%d/%d' % (start, end, size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Content-Type', 'application/json'
+                             if path.endswith('.json')
+                             else 'application/octet-stream')
+            self.end_headers()
+            if body and end >= start:
+                self.wfile.flush()
+                # hits go from the page cache to the socket in the kernel
+                self.connection.sendfile(f, start, end - start + 1)
+
+
+def serve_cache(port, address=''):
+    """
+    Run the caching proxy on ``port`` until interrupted
+    """
+    server = _CacheServer((address, port))
+    logger.info(' * Serving %s from %s on port %d',
+                src_base_url, get_cache_dir(), server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+# ---------------------------------------------------------
+# Virtual environment functions
+
+
+def copytree(src, dst, symlinks=False, ignore=None,
+             copy_function=shutil.copy2):
+    """
+    Copy the contents of ``src`` into ``dst``, merging them with the
+    directories already there. Directories are created while ``src`` is
+    walked and the files are copied by a pool of COPY_JOBS threads, so
+    ``copy_function`` must be thread safe. With ``symlinks`` links are
+    copied as links, except where ``dst`` already has one (#189).
+    """
+    if copy_function is shutil.copy2:
+        copy_function = _copy_file
+    mkdir(dst)
+    created = []
+    with ThreadPoolExecutor(COPY_JOBS) as pool:
+        futures = []
+        _copytree_walk(src, dst, symlinks, ignore,
+                       lambda s, d: futures.append(
+                           pool.submit(copy_function, s, d)),
+                       created)
+        for future in futures:
+            future.result()
+    # after the files, which change the mtime of their directory
+    for s, d in reversed(created):
+        shutil.copystat(s, d)
+
+
+def _copytree_walk(src, dst, symlinks, ignore, copy, created):
+    with os.scandir(src) as it:
+        entries = list(it)
+    ignored = ignore(src, [e.name for e in entries]) if ignore else ()
+    for entry in entries:
+        if entry.name in ignored:
+            continue
+        d = join(dst, entry.name)
+        if symlinks and entry.is_symlink():
+            # copy link only if it not exists. #189
+            if not os.path.islink(d):
+                os.symlink(os.readlink(entry.path), d)
+        elif entry.is_dir():
+            if not os.path.isdir(d):
+                os.mkdir(d)
+                created.append((entry.path, d))
+            _copytree_walk(entry.path, d, symlinks, ignore, copy, created)
+        else:
+            copy(entry.path, d)
+
+
+def _copy_file(src, dst):
+    """
+    Copy ``src`` to ``dst`` like shutil.copy2(). On Linux the data is
+    copied by the kernel, without passing through user space.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            if not sys.platform.startswith('linux'):
+                raise OSError(errno.ENOTSUP, 'no kernel copy')
+            _kernel_copy(fsrc.fileno(), fdst.fileno(),
+                         os.fstat(fsrc.fileno()).st_size)
+        except OSError as e:
+            if e.errno not in _NO_KERNEL_COPY:
+                raise
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+            shutil.copyfileobj(fsrc, fdst, CHUNK_SIZE)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def _kernel_copy(fd_in, fd_out, size):
+    """
+    Copy ``size`` bytes with copy_file_range(), which lets filesystems
+    share or clone the blocks, or with sendfile() where that is missing
+    """
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    offset = 0
+    while offset < size:
+        if copy_file_range is not None:
+            try:
+                n = copy_file_range(fd_in, fd_out, size - offset)
+            except OSError as e:
+                if offset or e.errno not in _NO_KERNEL_COPY:
+                    raise
+                copy_file_range = None
+                continue
+        else:
+            n = os.sendfile(fd_out, fd_in, offset, size - offset)
+        if not n:
+            # the file was truncated while being copied
+            break
+        offset += n
+
+
+def _copy_progress():
+    """
+    Return a copy function for copytree() reporting the files copied
+    """
+    lock = threading.Lock()
+    done = [0, 0]
+
+    def copy(src, dst):
+        dst = _copy_file(src, dst)
+        size = os.path.getsize(dst)
+        with lock:
+            done[0] += 1
+            done[1] += size
+            progress_callback('copy', done[0], done[1], None)
+        return dst
+    return copy
+
+
+def movetree(src, dst):
+    """
+    Move the contents of ``src`` into ``dst``, merging them with the
+    directories already there. Files are renamed, not copied; links
+    already in ``dst`` are kept, like copytree() does (#189).
+    """
+    for item in os.listdir(src):
+        s = os.path.join(src, item)
+        d = os.path.join(dst, item)
+        if os.path.islink(s):
+            if not os.path.islink(d):
+                os.rename(s, d)
+        elif os.path.isdir(s) and os.path.isdir(d):
+            movetree(s, d)
+        else:
+            try:
+                os.replace(s, d)
+            except OSError:
+                # the target is on another device
+                if os.path.isdir(s):
+                    copytree(s, d, True)
+                else:
+                    shutil.copy2(s, d)
+
+
+def _prebuilt_dest(env_dir):
+    """
+    Return the directory of ``env_dir`` the prebuilt tree goes into
+    """
+    if is_WIN:
+        dest = join(env_dir, 'Scripts')
+        mkdir(dest)
+    elif is_CYGWIN:
+        dest = join(env_dir, 'bin')
+        mkdir(dest)
+        # write here to avoid https://bugs.python.org/issue35650
+        writefile(join(env_dir, 'bin', 'node'), CYGWIN_NODE)
+    else:
+        dest = env_dir
+    return dest
+
+
+def _prebuilt_done(env_dir):
+    if is_CYGWIN:
+        for filename in ('npm', 'npx', 'node.exe'):
+            filename = join(env_dir, 'bin', filename)
+            if os.path.exists(filename):
+                make_executable(filename)
+
+
+def copy_node_from_prebuilt(env_dir, src_dir, node_version):
+    """
+    Copy prebuilt binaries into environment
+    """
+    logger.info('.', extra=dict(continued=True))
+    dest = _prebuilt_dest(env_dir)
+
+    src_folder_tpl = src_dir + to_utf8('/node-v%s*' % node_version)
+    src_folder, = glob.glob(src_folder_tpl)
+    if progress_callback is not None:
+        copytree(src_folder, dest, True, copy_function=_copy_progress())
+    else:
+        copytree(src_folder, dest, True)
+
+    _prebuilt_done(env_dir)
+    logger.info('.', extra=dict(continued=True))
+
+
+def move_node_from_prebuilt(env_dir, src_dir, node_version):
+    """
+    Move the prebuilt binaries extracted into ``src_dir`` into the
+    environment, so every file is written once
+    """
+    logger.info('.', extra=dict(continued=True))
+    dest = _prebuilt_dest(env_dir)
+
+    src_folder_tpl = src_dir + to_utf8('/node-v%s*' % node_version)
+    src_folder, = glob.glob(src_folder_tpl)
+    movetree(src_folder, dest)
+    shutil.rmtree(src_folder)
+
+    _prebuilt_done(env_dir)
+    logger.info('.', extra=dict(continued=True))
+
+
+def get_store_dir(node_url, profile):
+    """
+    Return where the store keeps the tree of the prebuilt archive at
+    ``node_url`` extracted with ``profile``, or None without a cache.
+
+    Entries are keyed by the published SHA-256 of the archive, so all
+    mirrors of a release share one entry and an archive that changes
+    upstream gets a new one. Releases without SHASUMS256.txt are keyed
+    by their URL.
+    """
+    root = get_cache_dir()
+    if not root:
+        return None
+    top = _archive_top(node_url)
+    digest = get_expected_sha256(node_url) or hashlib.sha256(
+        _canonical_url(node_url).encode('utf-8')).hexdigest()
+    return join(root, 'store', profile, '%s-%s' % (digest[:16], top))
+
+
+def _archive_top(node_url):
+    """
+    Return the name of the directory the archive at ``node_url``
+    extracts into
+    """
+    top = node_url.rstrip('/').rsplit('/', 1)[-1]
+    for ext in MIRROR_EXTENSIONS:
+        if top.endswith(ext):
+            top = top[:-len(ext)]
+    return top
+
+
+def _src_manifest_key(args):
+    """
+    Return what tells the archives extracted into src/ apart. The
+    compression of the archive makes no difference.
+    """
+    if args.prebuilt:
+        return {'node': args.node, 'platform': get_host_platform(),
+                'profile': args.profile_extract}
+    return {'node': args.node, 'platform': 'src', 'profile': 'full'}
+
+
+def src_manifest_lookup(src_dir, args):
+    """
+    Return the directory an earlier run extracted the archive ``args``
+    ask for into, or None. Only the manifest of ``src_dir`` is read,
+    so this is answered without the network.
+    """
+    manifest = _read_json(join(src_dir, 'manifest.json'))
+    if not manifest:
+        return None
+    key = _src_manifest_key(args)
+    for entry in manifest:
+        if all(entry.get(name) == value for name, value in key.items()):
+            path = join(src_dir, entry['dir'])
+            if os.path.isdir(path):
+                return path
+    return None
+
+
+def _src_manifest_record(src_dir, args, node_url):
+    """
+    Add the archive at ``node_url``, just extracted into ``src_dir``,
+    to the manifest of ``src_dir``
+    """
+    top = _archive_top(node_url)
+    if not os.path.isdir(join(src_dir, top)):
+        # extracted from another archive than asked for
+        return
+    path = join(src_dir, 'manifest.json')
+    manifest = [entry for entry in _read_json(path) or []
+                if entry.get('dir') != top]
+    entry = _src_manifest_key(args)
+    entry.update(url=node_url, sha256=get_expected_sha256(node_url),
+                 dir=top)
+    manifest.append(entry)
+    _write_json(path, manifest)
+
+
+def _fill_store(node_url, store_dir, args):
+    """
+    Extract the archive at ``node_url`` into ``store_dir``. Its files
+    are made read-only, so that hard links to them can't change it.
+    """
+    parent = os.path.dirname(store_dir)
+    mkdir(parent)
+    tmp_dir = tempfile.mkdtemp(prefix='.fill-', dir=parent)
+    try:
+        _download_node_archive(node_url, tmp_dir, args)
+        top, = os.listdir(tmp_dir)
+        for root, _, files in os.walk(join(tmp_dir, top)):
+            for name in files:
+                path = join(root, name)
+                if not os.path.islink(path):
+                    mode = os.stat(path).st_mode
+                    os.chmod(path, mode & ~STORE_WRITE_BITS)
+        try:
+            os.rename(join(tmp_dir, top), store_dir)
+        except OSError:
+            # another nodeenv filled it in the meantime
+            if not os.path.isdir(store_dir):
+                raise
+    finally:
+        shutil.rmtree(tmp_dir, onerror=_remove_read_only)
+
+
+def _remove_read_only(func, path, _):
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+def _reflink(src, dst):
+    """
+    Make ``dst`` a copy-on-write clone of ``src``
+    """
+    if FICLONE is None:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+class _StoreLinker(object):
+    """
+    ``copy_function`` for copytree() putting the files of the store
+    into an environment: a reflink shares the data until either copy
+    changes, a hard link shares the read-only file itself, and a plain
+    copy is the last resort. A method that fails once is not tried
+    again.
+    """
+
+    def __init__(self):
+        self.reflink = FICLONE is not None
+        self.hardlink = hasattr(os, 'link')
+
+    def __call__(self, src, dst):
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if self.reflink:
+            try:
+                _reflink(src, dst)
+            except (IOError, OSError) as e:
+                logger.debug(' * No reflinks for %s: %s', dst, e)
+                self.reflink = False
+                if os.path.lexists(dst):
+                    os.remove(dst)
+            else:
+                shutil.copystat(src, dst)
+                os.chmod(dst, os.stat(src).st_mode | stat.S_IWUSR)
+                return dst
+        if self.hardlink:
+            try:
+                os.link(src, dst)
+                return dst
+            except OSError as e:
+                logger.debug(' * No hard links for %s: %s', dst, e)
+                self.hardlink = False
+        shutil.copy2(src, dst)
+        os.chmod(dst, os.stat(src).st_mode | stat.S_IWUSR)
+        return dst
+
+
+def link_node_from_store(env_dir, store_dir):
+    """
+    Link the prebuilt tree in ``store_dir`` into the environment
+    """
+    logger.info('.', extra=dict(continued=True))
+    dest = _prebuilt_dest(env_dir)
+    copytree(store_dir, dest, True, copy_function=_StoreLinker())
+    _prebuilt_done(env_dir)
+    logger.info('.', extra=dict(continued=True))
+
+
+def _symlink_tree(src, dst, rel=''):
+    for item in os.listdir(src):
+        s = join(src, item)
+        d = join(dst, item)
+        if join(rel, item) in STORE_ENV_DIRS and os.path.isdir(s):
+            if os.path.islink(d):
+                os.remove(d)
+            mkdir(d)
+            _symlink_tree(s, d, join(rel, item))
+        elif os.path.isdir(d) and not os.path.islink(d):
+            logger.debug(' * Not replacing directory %s', d)
+        else:
+            if os.path.lexists(d):
+                # a link to another entry of the store or a stale file
+                os.remove(d)
+            os.symlink(s, d)
+
+
+def symlink_node_from_store(env_dir, store_dir):
+    """
+    Point the environment at the prebuilt tree in ``store_dir`` with
+    symbolic links. ``bin``, ``lib`` and ``lib/node_modules`` stay
+    directories of the environment, for the activation scripts and
+    the packages installed into it.
+    """
+    logger.info('.', extra=dict(continued=True))
+    store_dir = abspath(store_dir)
+    _symlink_tree(store_dir, env_dir)
+    _store_add_ref(store_dir, env_dir)
+    logger.info('.', extra=dict(continued=True))
+
+
+def _store_add_ref(store_dir, env_dir):
+    """
+    Record that ``env_dir`` links into ``store_dir``. Every environment
+    has its own file in ``<entry>.refs``, so no lock is needed.
+    """
+    refs_dir = store_dir + '.refs'
+    mkdir(refs_dir)
+    key = hashlib.sha256(env_dir.encode('utf-8')).hexdigest()[:16]
+    _write_json(join(refs_dir, key + '.json'), {'env_dir': env_dir})
+
+
+def get_store_refs(store_dir):
+    """
+    Return the environments that link into ``store_dir``. References of
+    environments which were removed or now link elsewhere are dropped,
+    so an entry without references can be removed safely.
+    """
+    refs_dir = store_dir + '.refs'
+    if not os.path.isdir(refs_dir):
+        return []
+    env_dirs = []
+    for name in sorted(os.listdir(refs_dir)):
+        path = join(refs_dir, name)
+        ref = _read_json(path) if name.endswith('.json') else None
+        if ref is None:
+            # partially written by a concurrent run
+            continue
+        node = os.path.realpath(join(ref['env_dir'], 'bin', 'node'))
+        if node.startswith(os.path.realpath(store_dir) + os.sep):
+            env_dirs.append(ref['env_dir'])
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    return env_dirs
+
+
+def build_node_from_src(env_dir, src_dir, node_src_dir, args):
+    env = {}
+    make_param_names = ['load-average', 'jobs']
+    make_param_values = map(
+        lambda x: getattr(args, x.replace('-', '_')),
+        make_param_names)
+    make_opts = [
+        '--{0}={1}'.format(name, value)
+        if len(value) > 0 else '--{0}'.format(name)
+        for name, value in zip(make_param_names, make_param_values)
+        if value is not None
+    ]
+
+    if getattr(sys.version_info, 'major', sys.version_info[0]) > 2:
+        # Currently, the node.js build scripts are using python2.*,
+        # therefore we need to temporarily point python exec to the
+        # python 2.* version in this case.
+        python2_path = shutil.which('python2')
+        if not python2_path:
+            raise OSError(
+                'Python >=3.0 virtualenv detected, but no python2 '
+                'command (required for building node.js) was found'
+            )
+        logger.debug(' * Temporarily pointing python to %s', python2_path)
+        node_tmpbin_dir = join(src_dir, 'tmpbin')
+        node_tmpbin_link = join(node_tmpbin_dir, 'python')
+        mkdir(node_tmpbin_dir)
+        if not os.path.exists(node_tmpbin_link):
+            callit(['ln', '-s', python2_path, node_tmpbin_link])
+        env['PATH'] = '{}:{}'.format(node_tmpbin_dir,
+                                     os.environ.get('PATH', ''))
+
+    conf_cmd = [
+        './configure',
+        '--prefix=%s' % _quote(env_dir)
+    ]
+    if args.without_ssl:
+        conf_cmd.append('--without-ssl')
+    if args.debug:
+        conf_cmd.append('--debug')
+    if args.profile:
+        conf_cmd.append('--profile')
+
+    make_cmd = args.make_path
+
+    callit(conf_cmd, args.verbose, True, node_src_dir, env)
+    logger.info('.', extra=dict(continued=True))
+    callit([make_cmd] + make_opts, args.verbose, True, node_src_dir, env)
+    logger.info('.', extra=dict(continued=True))
+    callit([make_cmd + ' install'], args.verbose, True, node_src_dir, env)
+
+
+def install_node(env_dir, src_dir, args):
+    """
+    Download source code for node.js, unpack it
+    and install it in virtual environment.
+    """
+    try:
+        install_node_wrapped(env_dir, src_dir, args)
+    except BaseException:
+        # this restores the newline suppressed by continued=True
+        logger.info('')
+        raise
+
+
+def check_offline_archive(args):
+    """
+    Raise OfflineError unless the archive of ``args.node`` is cached,
+    before anything is created
+    """
+    node_url = get_node_archive_url(
+        args.node, args.prebuilt, args.archive_format)
+    if node_url.startswith('file:'):
+        return
+    if not cache_lookup(node_url):
+        raise OfflineError(
+            '%s is not in the download cache, run nodeenv once '
+            'without --offline to fetch it' % node_url)
+
+
+def _download_node_archive(node_url, src_dir, args):
+    try:
+        download_node_src(node_url, src_dir, args)
+    except urllib2.HTTPError:
+        logger.warning('Failed to download from %s' % node_url)
+        raise
+
+
+def install_node_wrapped(env_dir, src_dir, args):
+    env_dir = abspath(env_dir)
+    node_src_dir = join(src_dir, to_utf8('node-v%s' % args.node))
+    src_type = "prebuilt" if args.prebuilt else "source"
+
+    logger.info(' * Install %s node (%s) ' % (src_type, args.node),
+                extra=dict(continued=True))
+
+    store_dir = None
+    if args.prebuilt and args.install_method in ('link', 'symlink'):
+        node_url = get_node_archive_url(
+            args.node, args.prebuilt, args.archive_format)
+        store_dir = get_store_dir(node_url, args.profile_extract)
+        if store_dir is None:
+            logger.debug(' * The download cache is disabled, copying')
+
+    # get src if not downloaded yet
+    if store_dir is not None:
+        if not os.path.isdir(store_dir):
+            _fill_store(node_url, store_dir, args)
+    elif os.path.exists(node_src_dir):
+        pass
+    elif src_manifest_lookup(src_dir, args) is not None:
+        logger.debug(' * Using the archive extracted into %s', src_dir)
+    else:
+        node_url = get_node_archive_url(
+            args.node, args.prebuilt, args.archive_format)
+        stale_dir = join(src_dir, _archive_top(node_url))
+        if os.path.isdir(stale_dir):
+            # interrupted, or extracted with another profile
+            shutil.rmtree(stale_dir)
+        _download_node_archive(node_url, src_dir, args)
+        if not (args.prebuilt and args.install_method == 'direct'):
+            # direct installs move the tree out of src/
+            _src_manifest_record(src_dir, args, node_url)
+
+    logger.info('.', extra=dict(continued=True))
+
+    if store_dir is not None and args.install_method == 'symlink':
+        symlink_node_from_store(env_dir, store_dir)
+    elif store_dir is not None:
+        link_node_from_store(env_dir, store_dir)
+    elif args.prebuilt and args.install_method == 'direct':
+        move_node_from_prebuilt(env_dir, src_dir, args.node)
+    elif args.prebuilt:
+        copy_node_from_prebuilt(env_dir, src_dir, args.node)
+    else:
+        build_node_from_src(env_dir, src_dir, node_src_dir, args)
+
+    finish = getattr(progress_callback, 'finish', None)
+    if finish is not None:
+        finish()
+    logger.info(' done.')
+
+
+def install_npm(env_dir, _src_dir, args):
     """
     Download source code for npm, unpack it
     and install it in virtual environment.
@@ -1033,13 +3309,186 @@ def create_environment(env_dir, args):
         shutil.rmtree(src_dir)
 
 
+_versions_json = {}
+
+
 def _get_versions_json():
-    response = urlopen('%s/index.json' % src_base_url)
-    return json.loads(response.read().decode('UTF-8'))
+    """
+    Return the parsed index.json of the mirror. It is fetched at most
+    once per process and kept on disk: an entry younger than
+    ``index_ttl`` is used as is, an older one is revalidated with
+    its ETag/Last-Modified, which usually costs a 304 reply.
+    """
+    url = '%s/index.json' % src_base_url
+    if url in _versions_json:
+        return _versions_json[url]
+
+    path = _index_cache_entry(url)
+    entry = _read_json(path) if path else None
+    if entry and entry.get('url') != _canonical_url(url):
+        entry = None
+    if entry and (offline or time.time() - entry['fetched'] < index_ttl):
+        _versions_json[url] = entry['data']
+        return entry['data']
+
+    if offline and not url.startswith('file:'):
+        raise OfflineError(
+            'The list of node.js releases (%s) is not cached, '
+            'run nodeenv once without --offline to fetch it' % url)
+
+    headers = {}
+    if entry and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    try:
+        response = urlopen(url, headers) if headers else urlopen(url)
+    except urllib2.HTTPError as e:
+        if e.code != 304 or not entry:
+            raise
+        response = None
+    if (headers and response is not None and
+            getattr(response, 'getcode', lambda: None)() == 304):
+        response.read()
+        response = None
+
+    if response is None:
+        logger.debug(' * %s has not changed', url)
+    else:
+        entry = {
+            'url': _canonical_url(url),
+            'etag': _response_header(response, 'ETag'),
+            'last_modified': _response_header(response, 'Last-Modified'),
+            'data': json.loads(response.read().decode('UTF-8')),
+        }
+    entry['fetched'] = time.time()
+    if path:
+        try:
+            mkdir(os.path.dirname(path))
+            _write_json(path, entry)
+        except (IOError, OSError) as e:
+            logger.warning(' * Failed to cache %s: %s', url, e)
+    _versions_json[url] = entry['data']
+    return entry['data']
+
+
+def _index_cache_entry(url):
+    root = get_cache_dir()
+    if not root or url.startswith('file:'):
+        return None
+    url = _canonical_url(url)
+    key = hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    return join(root, 'index', '%s.json' % key)
+
+
+class NodeRelease(object):
+    """
+    A node.js release listed in index.json
+    """
+    __slots__ = ('version', 'key', 'lts', 'files')
+
+    def __init__(self, version, key, lts, files):
+        self.version = version
+        self.key = key
+        # LTS codename in lower case, or None
+        self.lts = lts
+        # bitset of the index.json ``files`` of the release
+        self.files = files
+
+
+class VersionCatalog(object):
+    """
+    The releases of index.json, newest first, indexed by the queries
+    nodeenv makes: the latest release overall, of a major or minor
+    line, and of all or one LTS line. The same queries restricted to
+    the releases with a given build are indexed on first use.
+    """
+
+    def __init__(self, releases):
+        self._bits = {}
+        self.releases = []
+        for release in releases:
+            version = release['version'].lstrip('v')
+            files = 0
+            for name in release.get('files', ()):
+                files |= 1 << self._bits.setdefault(name, len(self._bits))
+            lts = release.get('lts') or None
+            self.releases.append(NodeRelease(
+                version, parse_version(version), lts and lts.lower(), files))
+        self.releases.sort(key=operator.attrgetter('key'), reverse=True)
+        self._by_version = dict((r.version, r) for r in self.releases)
+        self._latest = {}
+
+    def _index(self, build):
+        mask = 1 << self._bits[build] if build in self._bits else 0
+        latest = {}
+        for release in self.releases:
+            if build and not release.files & mask:
+                continue
+            names = ['', '%d' % release.key[0], '%d.%d' % release.key[:2]]
+            if release.lts:
+                names += ['lts', 'lts/' + release.lts]
+            for name in names:
+                latest.setdefault(name, release.version)
+        self._latest[build] = latest
+        return latest
+
+    def latest(self, name='', build=None):
+        """
+        Return the last version of ``name``: '' for any release, a
+        major or minor version like ``18`` or ``18.2``, ``lts`` or
+        ``lts/<codename>``. With ``build`` only the releases that have
+        it in index.json count. Returns None if nothing matches.
+        """
+        latest = self._latest.get(build)
+        if latest is None:
+            latest = self._index(build)
+        return latest.get(name.lower())
+
+    def has_file(self, version, name):
+        """
+        Return True if index.json lists ``name`` in the files of
+        ``version``
+        """
+        release = self._by_version.get(version)
+        bit = self._bits.get(name)
+        return bool(release and bit is not None and release.files >> bit & 1)
+
+    def versions(self):
+        """
+        Return all the versions, oldest first
+        """
+        return [release.version for release in reversed(self.releases)]
+
+
+_version_catalogs = {}
+
+
+def get_version_catalog():
+    """
+    Return the VersionCatalog of the mirror's index.json, built once
+    per process
+    """
+    url = '%s/index.json' % src_base_url
+    if url not in _version_catalogs:
+        _version_catalogs[url] = VersionCatalog(_get_versions_json())
+    return _version_catalogs[url]
+
+
+def _required_build():
+    """
+    Return the index.json build a release needs to be installable on
+    this host, or None if any release will do
+    """
+    if is_x86_64_musl():
+        return 'linux-x64-musl'
+    if is_riscv64():
+        return 'linux-riscv64'
+    return None
 
 
 def get_node_versions():
-    return [dct['version'].lstrip('v') for dct in _get_versions_json()][::-1]
+    return get_version_catalog().versions()
 
 
 def print_node_versions():
@@ -1054,39 +3503,206 @@ def print_node_versions():
         logger.info('\t'.join(chunk))
 
 
-def _get_last_node_version(lts=False):
+def get_last_stable_node_version():
     """
-    Return last node.js version matching the filter
+    Return last stable node.js version
     """
-    print({"x86": is_x86_64_musl(), "risc": is_riscv64(), "lts": lts})
+    return get_version_catalog().latest('', _required_build())
 
-    def version_filter(v):
-        if lts and not v['lts']:
-            return False
 
-        if is_x86_64_musl() and "linux-x64-musl" not in v['files']:
-            return False
-        elif is_riscv64() and "linux-riscv64" not in v['files']:
+def get_last_lts_node_version():
+    """
+    Return the last node.js version marked as LTS
+    """
+    return get_version_catalog().latest('lts', _required_build())
+
+
+def resolve_node_version(spec):
+    """
+    Return the node.js version ``spec`` stands for: ``latest``, ``lts``,
+    ``lts/<codename>``, a full version or the major (and minor) version
+    of the last release of a line, like ``18`` or ``18.2``
+    """
+    spec = spec.lower()
+    if spec == 'latest':
+        return get_last_stable_node_version()
+    spec = spec.lstrip('v')
+    if spec.count('.') >= 2:
+        return spec
+    return get_version_catalog().latest(spec, _required_build())
+
+
+def prefetch_node_versions(specs, args):
+    """
+    Download the archives of the comma separated node.js version
+    ``specs`` into the cache, all at once. Returns False if any of
+    them failed.
+    """
+    urls = []
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        version = resolve_node_version(spec.strip())
+        if version is None:
+            logger.error(' * No node.js release matches %s', spec)
             return False
+        url = get_node_archive_url(
+            version, args.prebuilt, args.archive_format)
+        if url not in urls:
+            urls.append(url)
+
+    segments = int(args.download_segments)
+    ok = True
+    with ThreadPoolExecutor(min(len(urls), PREFETCH_JOBS) or 1) as pool:
+        futures = [pool.submit(_prefetch_node_archive, url, segments)
+                   for url in urls]
+        for url, future in zip(urls, futures):
+            try:
+                future.result()
+            except NETWORK_ERRORS + (IOError, OSError) as e:
+                logger.error(' * Failed to prefetch %s: %s', url, e)
+                ok = False
+    return ok
 
-        return True
 
-    return next((v['version'].lstrip('v')
-                 for v in _get_versions_json() if version_filter(v)), None)
+def _prefetch_node_archive(node_url, segments):
+    sha256 = get_expected_sha256(node_url)
+    if cache_lookup(node_url, sha256):
+        logger.info(' * Already cached: %s', node_url)
+        return
+    _fetch_node_archive(node_url, segments, sha256).close()
+    logger.info(' * Prefetched %s', node_url)
 
 
-def get_last_stable_node_version():
+def get_host_platform():
     """
-    Return last stable node.js version
+    Return the platform part of the archive names for this host,
+    like ``linux-x64`` or ``win-x64``
     """
-    return _get_last_node_version()
+    return get_host_platforms()[0]
 
 
-def get_last_lts_node_version():
+def _release_platform(filename, version):
     """
-    Return the last node.js version marked as LTS
+    Return the platform of the release archive ``filename``, ``src``
+    for the sources, or None if it is no archive
+    """
+    prefix = 'node-v%s' % version
+    for ext in MIRROR_EXTENSIONS:
+        if filename.startswith(prefix) and filename.endswith(ext):
+            rest = filename[len(prefix):-len(ext)]
+            if not rest:
+                return 'src'
+            if rest.startswith('-'):
+                return rest[1:]
+    return None
+
+
+def _index_files_key(filename, version):
+    """
+    Return the name index.json lists the archive ``filename`` under
+    """
+    name = _release_platform(filename, version)
+    if name.startswith('darwin-'):
+        return 'osx-%s-tar' % name[len('darwin-'):]
+    if name.startswith('win-'):
+        return '%s-%s' % (name, filename.rsplit('.', 1)[-1])
+    return name
+
+
+def sync_mirror(dest, specs, platforms):
+    """
+    Copy the releases of the comma separated version ``specs`` from
+    the mirror in use into ``dest``, laid out like nodejs.org: the
+    archives for ``platforms``, SHASUMS256.txt and an index.json listing
+    the releases present. Files already there with the published
+    checksum are kept. Returns False if anything failed.
     """
-    return _get_last_node_version(lts=True)
+    releases = dict((v['version'].lstrip('v'), v)
+                    for v in _get_versions_json())
+    files = []
+    shasums_files = {}
+    index_files = {}
+    for spec in specs.split(','):
+        if not spec.strip():
+            continue
+        version = resolve_node_version(spec.strip())
+        if version not in releases:
+            logger.error(' * No node.js release matches %s', spec)
+            return False
+        root_url = get_root_url(version)
+        release_dir = join(dest, root_url[len(src_base_url):].strip('/'))
+        with contextlib.closing(urlopen(root_url + 'SHASUMS256.txt')) as r:
+            data = r.read()
+        shasums_files[join(release_dir, 'SHASUMS256.txt')] = data
+        mkdir(release_dir)
+        index_files[version] = set()
+        for filename, sha256 in sorted(iteritems(_parse_shasums(data))):
+            if _release_platform(filename, version) in platforms:
+                files.append((root_url + filename,
+                              join(release_dir, filename), sha256))
+                index_files[version].add(_index_files_key(filename, version))
+
+    ok = True
+    fetched = 0
+    with ThreadPoolExecutor(PREFETCH_JOBS) as pool:
+        futures = [pool.submit(_sync_file, *f) for f in files]
+        for (url, _, _), future in zip(files, futures):
+            try:
+                fetched += future.result()
+            except NETWORK_ERRORS + (IOError, OSError) as e:
+                logger.error(' * Failed to sync %s: %s', url, e)
+                ok = False
+    if not ok:
+        return False
+
+    for path, data in iteritems(shasums_files):
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    # releases synced before stay listed
+    index_path = join(dest, 'index.json')
+    index = dict((v['version'].lstrip('v'), v)
+                 for v in _read_json(index_path) or [])
+    for version, keys in iteritems(index_files):
+        entry = dict(releases[version])
+        entry['files'] = [key for key in entry.get('files', [])
+                          if key in keys]
+        index[version] = entry
+    _write_json(index_path, [
+        index[v] for v in sorted(index, key=parse_version, reverse=True)
+    ])
+    logger.info(' * Synced %d releases into %s: %d files fetched, '
+                '%d up to date', len(index_files), dest, fetched,
+                len(files) - fetched)
+    return True
+
+
+def _sync_file(url, path, sha256):
+    """
+    Download ``url`` to ``path`` unless it already has ``sha256``.
+    Returns True if the file was downloaded.
+    """
+    if os.path.isfile(path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        if digest.hexdigest() == sha256:
+            logger.debug(' * Up to date: %s', path)
+            return False
+    part_path = path + '.part'
+    try:
+        with open(part_path, 'w+b') as f:
+            _, actual = _download_node_file(url, fileobj=f)
+        _check_sha256(url, sha256, actual)
+    except BaseException:
+        os.remove(part_path)
+        raise
+    os.replace(part_path, path)
+    logger.info(' * Synced %s', url)
+    return True
 
 
 def get_env_dir(args):
@@ -1129,36 +3745,60 @@ def main():
 
     global src_base_url
     global ignore_ssl_certs
+    global cache_dir
+    global cache_size
+    global index_ttl
+    global offline
+    global progress_callback
 
     ignore_ssl_certs = args.ignore_ssl_certs
-
-    src_domain = None
-    if args.mirror:
-        if '://' in args.mirror:
-            src_base_url = args.mirror
-        else:
-            src_domain = args.mirror
+    cache_dir = args.cache_dir
+    cache_size = int(args.cache_size) << 20
+    index_ttl = int(args.index_ttl)
+    offline = args.offline
+    if args.progress:
+        progress_callback = ProgressPrinter()
+
+    if args.mirror and offline:
+        mirrors[:] = get_mirror_urls(args.mirror)
+    elif args.mirror:
+        mirrors[:] = rank_mirrors(get_mirror_urls(args.mirror))
     # use unofficial builds only if musl and no explicitly chosen mirror
     elif is_x86_64_musl() or is_riscv64():
-        src_domain = 'unofficial-builds.nodejs.org'
-    else:
-        src_domain = 'nodejs.org'
-    if src_base_url is None:
-        src_base_url = 'https://%s/download/release' % src_domain
-
-    if not args.node or args.node.lower() == 'latest':
-        args.node = get_last_stable_node_version()
-    elif args.node.lower() == 'lts':
-        args.node = get_last_lts_node_version()
-
-    if args.list:
-        print_node_versions()
-    elif args.update:
-        env_dir = get_env_dir(args)
-        install_packages(env_dir, args)
+        mirrors[:] = get_mirror_urls('unofficial-builds.nodejs.org')
     else:
-        env_dir = get_env_dir(args)
-        create_environment(env_dir, args)
+        mirrors[:] = get_mirror_urls('nodejs.org')
+    src_base_url = mirrors[0]
+
+    try:
+        if not args.node or args.node.lower() == 'latest':
+            args.node = get_last_stable_node_version()
+        elif args.node.lower() == 'lts':
+            args.node = get_last_lts_node_version()
+
+        if args.list:
+            print_node_versions()
+        elif args.serve_cache:
+            serve_cache(int(args.port))
+        elif args.mirror_sync:
+            platforms = (args.sync_platforms or get_host_platform())
+            if not sync_mirror(args.mirror_sync, args.sync_versions,
+                               set(platforms.split(','))):
+                sys.exit(2)
+        elif args.prefetch:
+            if not prefetch_node_versions(args.prefetch, args):
+                sys.exit(2)
+        elif args.update:
+            env_dir = get_env_dir(args)
+            install_packages(env_dir, args)
+        else:
+            if offline and args.node != 'system':
+                check_offline_archive(args)
+            env_dir = get_env_dir(args)
+            create_environment(env_dir, args)
+    except OfflineError as e:
+        logger.error(' * %s', e)
+        sys.exit(2)
 
 
 # ---------------------------------------------------------
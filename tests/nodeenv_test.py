@@ -6,11 +6,31 @@ if sys.version_info < (3, 3):
     from pipes import quote as _quote
 else:
     from shlex import quote as _quote
+import contextlib
+import errno
+import glob
+import hashlib
+import io
+import json
 import os.path
+import socket
+import ssl
 import subprocess
+import tarfile
+import tempfile
 import sys
 import sysconfig
 import platform
+import shutil
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover (py2 only)
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
 
 try:
     from unittest import mock
@@ -54,6 +74,126 @@ def test_smoke_n_system_special_chars(tmpdir):
     ])
 
 
+@pytest.fixture(autouse=True)
+def isolated_cache(tmpdir, monkeypatch):
+    cache_home = tmpdir.join('cache-home').strpath
+    monkeypatch.setenv('XDG_CACHE_HOME', cache_home)
+    monkeypatch.setenv('LOCALAPPDATA', cache_home)
+    monkeypatch.setattr(nodeenv, 'cache_dir', None)
+    monkeypatch.setattr(nodeenv, '_shasums', {})
+    monkeypatch.setattr(nodeenv, '_versions_json', {})
+    monkeypatch.setattr(nodeenv, '_version_catalogs', {})
+    monkeypatch.setattr(nodeenv, 'mirrors', [])
+    monkeypatch.setattr(nodeenv, 'offline', False)
+    monkeypatch.setattr(nodeenv, 'progress_callback', None)
+    monkeypatch.setattr(nodeenv, '_host_platforms', [])
+    yield os.path.join(cache_home, 'nodeenv')
+
+
+def make_node_tarball(version='18.0.0', platform_name='linux-x64'):
+    """Build a tiny gzipped tarball laid out like a node.js release"""
+    top = 'node-v%s-%s' % (version, platform_name)
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+        for name, data in (('bin/node', b'#!/bin/sh\n'),
+                           ('README.md', b'readme'),
+                           ('include/node/node.h', b'/* header */')):
+            info = tarfile.TarInfo('%s/%s' % (top, name))
+            info.size = len(data)
+            info.mode = 0o755
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+class FakeResponse(io.BytesIO):
+    """In-memory stand-in for an HTTP response"""
+
+    def __init__(self, data, code=200, headers=None):
+        io.BytesIO.__init__(self, data)
+        self.code = code
+        self.headers = headers or {}
+
+    def getcode(self):
+        return self.code
+
+
+def range_urlopen(data, ranges=True, drop_after=None):
+    """
+    Return an ``urlopen`` replacement serving ``data``.
+    The connection of the first response is dropped after
+    ``drop_after`` bytes.
+    """
+    drops = [drop_after] if drop_after is not None else []
+
+    def urlopen(url, headers=None):
+        range_header = (headers or {}).get('Range')
+        if not ranges or not range_header:
+            start, end, code = 0, len(data) - 1, 200
+            response_headers = {'Content-Length': str(len(data))}
+        else:
+            start, end = range_header.split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            code = 206
+            response_headers = {
+                'Content-Length': str(end - start + 1),
+                'Content-Range': 'bytes %d-%d/%d' % (start, end, len(data)),
+            }
+        body = data[start:end + 1]
+        if drops:
+            body = body[:drops.pop()]
+        return FakeResponse(body, code, response_headers)
+    return urlopen
+
+
+class LocalHandler(BaseHTTPRequestHandler):
+    """Serves ``server.files`` over keep-alive connections"""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.client_address))
+        self.server.headers.append(dict(self.headers.items()))
+        if self.path in self.server.redirects:
+            self.send_response(302)
+            self.send_header('Location', self.server.redirects[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class LocalServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def local_server(monkeypatch):
+    """A keep-alive HTTP server on localhost"""
+    monkeypatch.setenv('no_proxy', '*')
+    server = LocalServer(('127.0.0.1', 0), LocalHandler)
+    server.files = {}
+    server.redirects = {}
+    server.requests = []
+    server.headers = []
+    server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
 @pytest.fixture
 def mock_index_json():
     # retrieved 2019-12-31
@@ -109,6 +249,105 @@ def test_print_node_versions(cap_logging_info):
     assert tabs_per_line == [7] * 60 + [4]
 
 
+INDEX_URL = 'https://nodejs.org/download/release/index.json'
+INDEX_DATA = [{'version': 'v13.5.0', 'lts': False}]
+
+
+def index_response(etag='"v1"'):
+    return FakeResponse(json.dumps(INDEX_DATA).encode('UTF-8'),
+                        headers={'ETag': etag})
+
+
+def expire_index_cache(isolated_cache):
+    index_dir = os.path.join(isolated_cache, 'index')
+    for name in os.listdir(index_dir):
+        path = os.path.join(index_dir, name)
+        with open(path) as f:
+            entry = json.load(f)
+        entry['fetched'] -= nodeenv.index_ttl + 1
+        with open(path, 'w') as f:
+            json.dump(entry, f)
+
+
+@pytest.fixture
+def index_url():
+    with mock.patch.object(nodeenv, 'src_base_url',
+                           'https://nodejs.org/download/release'):
+        yield INDEX_URL
+
+
+def test_versions_json_fetched_once(index_url):
+    with mock.patch.object(nodeenv, 'urlopen',
+                           return_value=index_response()) as m_urlopen:
+        assert nodeenv._get_versions_json() == INDEX_DATA
+        assert nodeenv._get_versions_json() == INDEX_DATA
+    m_urlopen.assert_called_once_with(index_url)
+
+
+def test_versions_json_fresh_disk_cache(index_url):
+    with mock.patch.object(nodeenv, 'urlopen',
+                           return_value=index_response()):
+        nodeenv._get_versions_json()
+    nodeenv._versions_json.clear()
+    with mock.patch.object(nodeenv, 'urlopen') as m_urlopen:
+        assert nodeenv._get_versions_json() == INDEX_DATA
+    m_urlopen.assert_not_called()
+
+
+def not_modified_response(url, headers):
+    return FakeResponse(b'', code=304)
+
+
+def not_modified_error(url, headers):
+    raise nodeenv.urllib2.HTTPError(url, 304, 'Not Modified', {}, None)
+
+
+@pytest.mark.parametrize('not_modified', [
+    not_modified_response, not_modified_error,
+])
+def test_versions_json_revalidated(index_url, isolated_cache, not_modified):
+    with mock.patch.object(nodeenv, 'urlopen',
+                           return_value=index_response()):
+        nodeenv._get_versions_json()
+    nodeenv._versions_json.clear()
+    expire_index_cache(isolated_cache)
+
+    with mock.patch.object(nodeenv, 'urlopen',
+                           side_effect=not_modified) as m_urlopen:
+        assert nodeenv._get_versions_json() == INDEX_DATA
+    m_urlopen.assert_called_once_with(index_url, {'If-None-Match': '"v1"'})
+
+    # the revalidated entry is fresh again
+    nodeenv._versions_json.clear()
+    with mock.patch.object(nodeenv, 'urlopen') as m_urlopen:
+        nodeenv._get_versions_json()
+    m_urlopen.assert_not_called()
+
+
+def test_versions_json_changed(index_url, isolated_cache):
+    with mock.patch.object(nodeenv, 'urlopen',
+                           return_value=index_response()):
+        nodeenv._get_versions_json()
+    nodeenv._versions_json.clear()
+    expire_index_cache(isolated_cache)
+
+    changed = [{'version': 'v13.6.0', 'lts': False}]
+    response = FakeResponse(json.dumps(changed).encode('UTF-8'),
+                            headers={'ETag': '"v2"'})
+    with mock.patch.object(nodeenv, 'urlopen', return_value=response):
+        assert nodeenv._get_versions_json() == changed
+
+
+def test_list_fetches_index_once(index_url):
+    with mock.patch.object(sys, 'argv', [__file__, '--list']), \
+            mock.patch.object(nodeenv.logger, 'info'), \
+            mock.patch.object(nodeenv, 'urlopen',
+                              return_value=index_response()) as m_urlopen:
+        nodeenv.src_base_url = None
+        nodeenv.main()
+    assert m_urlopen.call_count == 1
+
+
 def test_predeactivate_hook(tmpdir):
     # Throw error if the environment directory is not a string
     with pytest.raises((TypeError, AttributeError)):
@@ -201,6 +440,152 @@ def test__download_node_file():
         assert m_urlopen.call_count == 5
 
 
+def test__download_node_file_streams_in_chunks():
+    data = b'x' * (nodeenv.CHUNK_SIZE * 2 + 10)
+    response = io.BytesIO(data)
+    with mock.patch.object(response, 'read', wraps=response.read) as m_read, \
+            mock.patch.object(nodeenv, 'urlopen', return_value=response):
+        fileobj, sha256 = nodeenv._download_node_file(
+            'https://dummy/nodejs.tar.gz')
+    assert all(call[0] == (nodeenv.CHUNK_SIZE,)
+               for call in m_read.call_args_list)
+    assert fileobj.tell() == 0
+    assert fileobj.read() == data
+    assert sha256 == hashlib.sha256(data).hexdigest()
+
+
+def test__download_node_file_resumes():
+    data = os.urandom(1000)
+    urlopen = range_urlopen(data, drop_after=600)
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=urlopen) as m_urlopen, \
+            mock.patch.object(nodeenv.logger, 'warning'):
+        fileobj, _ = nodeenv._download_node_file('https://dummy/node.tgz')
+    assert fileobj.read() == data
+    assert m_urlopen.call_count == 2
+    assert m_urlopen.call_args[0][1] == {'Range': 'bytes=600-'}
+
+
+def test__download_node_file_resume_without_range_support():
+    data = os.urandom(1000)
+    urlopen = range_urlopen(data, ranges=False, drop_after=600)
+    with mock.patch.object(nodeenv, 'urlopen', side_effect=urlopen), \
+            mock.patch.object(nodeenv.logger, 'warning'):
+        fileobj, _ = nodeenv._download_node_file('https://dummy/node.tgz')
+    assert fileobj.read() == data
+
+
+def test__download_node_file_retries_connection_errors():
+    data = os.urandom(1000)
+    serve = range_urlopen(data, drop_after=600)
+    errors = [nodeenv.urllib2.URLError('reset'), socket.timeout('timed out')]
+
+    def flaky(url, headers=None):
+        if headers and errors:
+            raise errors.pop(0)
+        return serve(url, headers)
+
+    with mock.patch.object(nodeenv, 'urlopen', side_effect=flaky), \
+            mock.patch.object(nodeenv.logger, 'warning'):
+        fileobj, _ = nodeenv._download_node_file(
+            'https://dummy/node.tgz', n_attempt=4)
+    assert fileobj.read() == data
+    assert errors == []
+
+
+def test__download_node_file_does_not_retry_http_errors():
+    error = nodeenv.urllib2.HTTPError(
+        'https://dummy/node.tgz', 404, 'Not Found', {}, None)
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=error) as m_urlopen, \
+            pytest.raises(nodeenv.urllib2.HTTPError):
+        nodeenv._download_node_file('https://dummy/node.tgz')
+    m_urlopen.assert_called_once()
+
+
+def range_not_satisfiable(size):
+    def urlopen(url, headers=None):
+        raise nodeenv.urllib2.HTTPError(
+            url, 416, 'Range Not Satisfiable',
+            {'Content-Range': 'bytes */%d' % size}, None)
+    return urlopen
+
+
+def test__download_node_file_complete_part():
+    data = os.urandom(1000)
+    fileobj = io.BytesIO(data)
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=range_not_satisfiable(1000)):
+        _, sha256 = nodeenv._download_node_file(
+            'https://dummy/node.tgz', fileobj=fileobj)
+    assert fileobj.getvalue() == data
+    assert sha256 == hashlib.sha256(data).hexdigest()
+
+
+def test__download_node_file_continues_existing_data():
+    data = os.urandom(1000)
+    fileobj = io.BytesIO(data[:400])
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=range_urlopen(data)
+    ) as m_urlopen:
+        _, sha256 = nodeenv._download_node_file(
+            'https://dummy/node.tgz', fileobj=fileobj)
+    m_urlopen.assert_called_once_with(
+        'https://dummy/node.tgz', {'Range': 'bytes=400-'})
+    assert fileobj.getvalue() == data
+    assert sha256 == hashlib.sha256(data).hexdigest()
+
+
+def test__download_node_file_segmented():
+    data = os.urandom(nodeenv.SEGMENT_MIN_SIZE * 4 + 123)
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=range_urlopen(data)
+    ) as m_urlopen:
+        fileobj, sha256 = nodeenv._download_node_file(
+            'https://dummy/node.tar.gz', segments=4)
+    # one probe plus one request per segment
+    assert m_urlopen.call_count == 5
+    assert fileobj.read() == data
+    assert sha256 == hashlib.sha256(data).hexdigest()
+
+
+def test__download_node_file_segmented_without_ranges():
+    data = b'x' * (nodeenv.SEGMENT_MIN_SIZE * 4)
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=range_urlopen(data, False)
+    ) as m_urlopen:
+        fileobj, _ = nodeenv._download_node_file(
+            'https://dummy/node.tar.gz', segments=4)
+    # the probe is answered with a 200, so a single stream is used
+    assert m_urlopen.call_count == 2
+    assert fileobj.read() == data
+
+
+def test__download_node_file_segmented_small_file():
+    data = b'x' * 100
+    with mock.patch.object(
+            nodeenv, 'urlopen', side_effect=range_urlopen(data)
+    ) as m_urlopen:
+        fileobj, _ = nodeenv._download_node_file(
+            'https://dummy/node.tar.gz', segments=4)
+    assert m_urlopen.call_count == 2
+    assert fileobj.read() == data
+
+
+def test_get_expected_sha256():
+    shasums = (b'abcd  node-v18.0.0-linux-x64.tar.gz\n'
+               b'ef01  node-v18.0.0.tar.gz\n')
+    root_url = 'https://nodejs.org/download/release/v18.0.0/'
+    with mock.patch.object(
+            nodeenv, 'urlopen', return_value=io.BytesIO(shasums)
+    ) as m_urlopen:
+        assert nodeenv.get_expected_sha256(
+            root_url + 'node-v18.0.0-linux-x64.tar.gz') == 'abcd'
+        assert nodeenv.get_expected_sha256(
+            root_url + 'node-v18.0.0.tar.xz') is None
+    m_urlopen.assert_called_once_with(root_url + 'SHASUMS256.txt')
+
+
 def test_parse_version():
     assert nodeenv.parse_version("v21.7") == (21, 7)
     assert nodeenv.parse_version("v21.7.3") == (21, 7, 3)
@@ -347,6 +732,10 @@ class TestGetNodeBinUrl:
              mock.patch.object(nodeenv, 'is_CYGWIN', False), \
              mock.patch.object(
                  nodeenv, 'is_x86_64_musl', return_value=False), \
+             mock.patch.object(
+                 nodeenv, '_get_versions_json', return_value=[{
+                     'version': 'v18.0.0',
+                     'files': ['osx-arm64-tar', 'osx-x64-tar']}]), \
              mock.patch.object(
                  nodeenv, 'get_root_url', return_value=root_url):
             url = nodeenv.get_node_bin_url('18.0.0')
@@ -509,6 +898,133 @@ class TestGetNodeBinUrl:
             )
             assert url == expected
 
+    def patch_host(self, system, machine, versions_json=None, **kwargs):
+        root_url = 'https://nodejs.org/download/release/v15.0.0/'
+        return (
+            mock.patch.object(platform, 'system', return_value=system),
+            mock.patch.object(platform, 'machine', return_value=machine),
+            mock.patch.object(nodeenv, 'is_WIN', system == 'Windows'),
+            mock.patch.object(nodeenv, 'is_CYGWIN', False),
+            mock.patch.object(nodeenv, 'is_x86_64_musl', return_value=False),
+            mock.patch.object(nodeenv, 'get_root_url', return_value=root_url),
+            mock.patch.object(nodeenv, '_get_versions_json',
+                              return_value=versions_json, **kwargs),
+        )
+
+    @pytest.mark.parametrize('system,files,expected', [
+        ('Darwin', ['osx-x64-tar'], 'node-v15.0.0-darwin-x64.tar.gz'),
+        ('Darwin', ['osx-arm64-tar', 'osx-x64-tar'],
+         'node-v15.0.0-darwin-arm64.tar.gz'),
+        ('Windows', ['win-x64-zip', 'win-x64-msi'],
+         'node-v15.0.0-win-x64.zip'),
+        # not in the index at all
+        ('Darwin', None, 'node-v15.0.0-darwin-arm64.tar.gz'),
+    ])
+    def test_arm64_picks_from_index(self, system, files, expected):
+        versions_json = [{'version': 'v15.0.1', 'files': ['osx-x64-tar']}]
+        if files is not None:
+            versions_json.append({'version': 'v15.0.0', 'files': files})
+        patches = self.patch_host(system, 'arm64', versions_json)
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            url = nodeenv.get_node_bin_url('15.0.0')
+        assert url.rsplit('/', 1)[-1] == expected
+
+    def test_arm64_without_index(self):
+        error = nodeenv.urllib2.URLError('offline')
+        patches = self.patch_host('Darwin', 'arm64', side_effect=error)
+        with contextlib.ExitStack() as stack:
+            for patch in patches:
+                stack.enter_context(patch)
+            url = nodeenv.get_node_bin_url('15.0.0')
+        assert url.endswith('node-v15.0.0-darwin-arm64.tar.gz')
+
+    def test_host_probed_once(self):
+        patches = self.patch_host('Linux', 'aarch64')
+        with contextlib.ExitStack() as stack:
+            mocks = [stack.enter_context(patch) for patch in patches]
+            assert nodeenv.get_host_platforms() == ['linux-arm64']
+            nodeenv.get_node_bin_url('15.0.0')
+            nodeenv.get_node_bin_url('15.0.0', 'xz')
+            # x64 builds don't run on arm64 linux
+            nodeenv._get_versions_json.assert_not_called()
+        # platform.machine
+        assert mocks[1].call_count == 1
+
+
+class TestArchiveFormat:
+    """Tests for picking between gzip and xz archives"""
+
+    shasums = (
+        b'aaaa  node-v18.0.0-linux-x64.tar.gz\n'
+        b'bbbb  node-v18.0.0-linux-x64.tar.xz\n'
+        b'cccc  node-v18.0.0.tar.gz\n'
+    )
+    root_url = 'https://nodejs.org/download/release/v18.0.0/'
+
+    @pytest.fixture(autouse=True)
+    def linux_x64(self):
+        with mock.patch.object(platform, 'system', return_value='Linux'), \
+             mock.patch.object(platform, 'machine', return_value='x86_64'), \
+             mock.patch.object(nodeenv, 'is_WIN', False), \
+             mock.patch.object(nodeenv, 'is_CYGWIN', False), \
+             mock.patch.object(
+                 nodeenv, 'is_x86_64_musl', return_value=False), \
+             mock.patch.object(
+                 nodeenv, 'get_root_url', return_value=self.root_url):
+            yield
+
+    def test_explicit_formats(self):
+        assert nodeenv.get_node_bin_url('18.0.0', 'xz') == (
+            self.root_url + 'node-v18.0.0-linux-x64.tar.xz')
+        assert nodeenv.get_node_src_url('18.0.0', 'xz') == (
+            self.root_url + 'node-v18.0.0.tar.xz')
+        with mock.patch.object(nodeenv, 'urlopen') as m_urlopen:
+            url = nodeenv.get_node_archive_url('18.0.0', True, 'gz')
+        assert url == self.root_url + 'node-v18.0.0-linux-x64.tar.gz'
+        m_urlopen.assert_not_called()
+
+    def test_get_node_shasums(self):
+        with mock.patch.object(
+                nodeenv, 'urlopen', return_value=io.BytesIO(self.shasums)
+        ) as m_urlopen:
+            shasums = nodeenv.get_node_shasums('18.0.0')
+            assert nodeenv.get_node_shasums('18.0.0') is shasums
+        m_urlopen.assert_called_once_with(self.root_url + 'SHASUMS256.txt')
+        assert shasums['node-v18.0.0-linux-x64.tar.xz'] == 'bbbb'
+        # a later run reads them from the cache
+        nodeenv._shasums.clear()
+        with mock.patch.object(nodeenv, 'urlopen') as m_urlopen:
+            assert nodeenv.get_node_shasums('18.0.0') == shasums
+        m_urlopen.assert_not_called()
+
+    def test_get_node_shasums_missing(self):
+        error = nodeenv.urllib2.HTTPError(
+            self.root_url, 404, 'Not Found', {}, None)
+        with mock.patch.object(nodeenv, 'urlopen', side_effect=error):
+            assert nodeenv.get_node_shasums('18.0.0') == {}
+
+    @pytest.mark.parametrize('prebuilt,has_lzma,expected', [
+        (True, True, 'node-v18.0.0-linux-x64.tar.xz'),
+        (True, False, 'node-v18.0.0-linux-x64.tar.gz'),
+        # no xz source tarball listed
+        (False, True, 'node-v18.0.0.tar.gz'),
+    ])
+    def test_auto(self, prebuilt, has_lzma, expected):
+        with mock.patch.object(nodeenv, 'has_lzma', has_lzma), \
+             mock.patch.object(
+                 nodeenv, 'urlopen', return_value=io.BytesIO(self.shasums)):
+            url = nodeenv.get_node_archive_url('18.0.0', prebuilt, 'auto')
+        assert url == self.root_url + expected
+
+    def test_xz_requires_lzma(self):
+        argv = ['nodeenv', '--archive-format=xz', 'env']
+        with mock.patch.object(sys, 'argv', argv), \
+             mock.patch.object(nodeenv, 'has_lzma', False), \
+             pytest.raises(SystemExit):
+            nodeenv.parse_args()
+
 
 class TestInstallNode:
     """Tests for install_node and install_node_wrapped functions"""
@@ -595,56 +1111,6 @@ class TestInstallNode:
                 env_dir, src_dir, node_src_dir, args
             )
 
-    def test_install_node_wrapped_arm64_fallback_to_x64(self, tmpdir):
-        """Test arm64 fallback to x64 when arm64 is not available"""
-        args = mock.Mock()
-        args.node = '16.0.0'
-        args.prebuilt = True
-        args.verbose = False
-
-        env_dir = tmpdir.join('env').strpath
-        src_dir = tmpdir.join('src').strpath
-        os.makedirs(src_dir)
-
-        arm64_url = (
-            'https://nodejs.org/download/release/v16.0.0/'
-            'node-v16.0.0-darwin-arm64.tar.gz'
-        )
-
-        # Mock HTTPError for arm64 URL
-        def download_side_effect(url, src_dir, args):
-            if 'arm64' in url:
-                raise nodeenv.urllib2.HTTPError(
-                    url, 404, 'Not Found', {}, None
-                )
-            # x64 download succeeds
-            return None
-
-        with mock.patch.object(
-                nodeenv, 'get_node_bin_url',
-                return_value=arm64_url
-        ), \
-             mock.patch.object(
-                 nodeenv, 'download_node_src',
-                 side_effect=download_side_effect
-             ) as mock_download, \
-             mock.patch.object(
-                 nodeenv, 'copy_node_from_prebuilt'
-             ) as mock_copy, \
-             mock.patch('os.path.exists', return_value=False), \
-             mock.patch.object(nodeenv.logger, 'info'), \
-             mock.patch.object(nodeenv.logger, 'warning'):
-            nodeenv.install_node_wrapped(env_dir, src_dir, args)
-
-            # Verify download was called twice: first with arm64, then with x64
-            assert mock_download.call_count == 2
-            calls = mock_download.call_args_list
-            assert 'arm64' in calls[0][0][0]
-            assert 'x64' in calls[1][0][0]
-
-            # Verify copy was called after successful x64 download
-            mock_copy.assert_called_once()
-
     def test_install_node_wrapped_http_error_non_arm64(self, tmpdir):
         """Test that HTTPError is re-raised for non-arm64 URLs"""
         args = mock.Mock()
@@ -800,8 +1266,8 @@ class TestInstallNode:
             mock_src_url.assert_called_once()
             mock_bin_url.assert_not_called()
 
-    def test_install_node_wrapped_arm64_fallback_both_fail(self, tmpdir):
-        """Test that both arm64 and x64 failures raise exception"""
+    def test_install_node_wrapped_no_platform_retry(self, tmpdir):
+        """Test that a missing arm64 build is not retried as x64"""
         args = mock.Mock()
         args.node = '16.0.0'
         args.prebuilt = True
@@ -816,7 +1282,6 @@ class TestInstallNode:
             'node-v16.0.0-darwin-arm64.tar.gz'
         )
 
-        # Both arm64 and x64 downloads fail
         def download_side_effect(url, src_dir, args):
             raise nodeenv.urllib2.HTTPError(
                 url, 404, 'Not Found', {}, None
@@ -830,13 +1295,17 @@ class TestInstallNode:
                  nodeenv, 'download_node_src',
                  side_effect=download_side_effect
              ) as mock_download, \
+             mock.patch.object(
+                 nodeenv, 'copy_node_from_prebuilt'
+             ) as mock_copy, \
              mock.patch('os.path.exists', return_value=False), \
              mock.patch.object(nodeenv.logger, 'info'), \
+             mock.patch.object(nodeenv.logger, 'warning'), \
              pytest.raises(nodeenv.urllib2.HTTPError):
             nodeenv.install_node_wrapped(env_dir, src_dir, args)
 
-            # Both arm64 and x64 should have been tried
-            assert mock_download.call_count == 2
+        mock_download.assert_called_once()
+        mock_copy.assert_not_called()
 
     def test_install_node_wrapped_no_copy_after_download_failure(
         self, tmpdir
@@ -926,52 +1395,6 @@ class TestInstallNode:
             # Verify build was NOT called after download failure
             mock_build.assert_not_called()
 
-    def test_install_node_wrapped_no_copy_after_arm64_fallback_failure(
-        self, tmpdir
-    ):
-        """Test copy not called when both arm64 and x64 fail"""
-        args = mock.Mock()
-        args.node = '16.0.0'
-        args.prebuilt = True
-        args.verbose = False
-
-        env_dir = tmpdir.join('env').strpath
-        src_dir = tmpdir.join('src').strpath
-        os.makedirs(src_dir)
-
-        arm64_url = (
-            'https://nodejs.org/download/release/v16.0.0/'
-            'node-v16.0.0-darwin-arm64.tar.gz'
-        )
-
-        # Both arm64 and x64 downloads fail
-        def download_side_effect(url, src_dir, args):
-            raise nodeenv.urllib2.HTTPError(
-                url, 404, 'Not Found', {}, None
-            )
-
-        with mock.patch.object(
-                nodeenv, 'get_node_bin_url',
-                return_value=arm64_url
-        ), \
-             mock.patch.object(
-                 nodeenv, 'download_node_src',
-                 side_effect=download_side_effect
-             ) as mock_download, \
-             mock.patch.object(
-                 nodeenv, 'copy_node_from_prebuilt'
-             ) as mock_copy, \
-             mock.patch('os.path.exists', return_value=False), \
-             mock.patch.object(nodeenv.logger, 'info'), \
-             pytest.raises(nodeenv.urllib2.HTTPError):
-            nodeenv.install_node_wrapped(env_dir, src_dir, args)
-
-            # Verify both attempts were made
-            assert mock_download.call_count == 2
-
-            # Verify copy was NOT called after both download failures
-            mock_copy.assert_not_called()
-
 
 class TestGetEnvDir:
     """Tests for get_env_dir function"""
@@ -1556,3 +1979,1892 @@ class TestInstallNpmWin:
 
             # Verify extraction
             mock_zip.extractall.assert_called_once_with(src_dir)
+
+
+class TestDownloadCache:
+    """Tests for the persistent download cache"""
+
+    url = (
+        'https://nodejs.org/download/release/v18.0.0/'
+        'node-v18.0.0-linux-x64.tar.gz'
+    )
+
+    @pytest.fixture(autouse=True)
+    def no_shasums(self):
+        with mock.patch.object(
+                nodeenv, 'get_expected_sha256', return_value=None):
+            yield
+
+    def _args(self, segments='1'):
+        args = mock.Mock()
+        args.node = '18.0.0'
+        args.download_segments = segments
+        args.profile_extract = 'full'
+        return args
+
+    @pytest.mark.parametrize('value', ['lots', '-1', '1.5'])
+    def test_bad_cache_size(self, value):
+        argv = ['nodeenv', '--cache-size=' + value, 'env']
+        with mock.patch.object(sys, 'argv', argv), \
+             pytest.raises(SystemExit):
+            nodeenv.parse_args()
+
+    def test_get_cache_dir_default(self, isolated_cache):
+        assert nodeenv.get_cache_dir() == isolated_cache
+
+    def test_get_cache_dir_disabled(self):
+        with mock.patch.object(nodeenv, 'cache_dir', ''):
+            assert nodeenv.get_cache_dir() is None
+            assert nodeenv.cache_store(self.url, io.BytesIO(b'x')) is None
+            assert nodeenv.cache_lookup(self.url) is None
+
+    def test_store_and_lookup(self):
+        assert nodeenv.cache_lookup(self.url) is None
+        path = nodeenv.cache_store(self.url, io.BytesIO(b'archive'))
+        assert nodeenv.cache_lookup(self.url) == path
+        with open(path, 'rb') as f:
+            assert f.read() == b'archive'
+        other = self.url.replace('18.0.0', '20.0.0')
+        assert nodeenv.cache_lookup(other) is None
+
+    def test_lookup_checks_sha256(self):
+        nodeenv.cache_store(self.url, io.BytesIO(b'archive'))
+        digest = hashlib.sha256(b'archive').hexdigest()
+        assert nodeenv.cache_lookup(self.url, sha256=digest)
+        assert nodeenv.cache_lookup(self.url, sha256='0' * 64) is None
+
+    def test_lookup_ignores_truncated_entry(self):
+        path = nodeenv.cache_store(self.url, io.BytesIO(b'archive'))
+        with open(path, 'wb') as f:
+            f.write(b'arch')
+        assert nodeenv.cache_lookup(self.url) is None
+
+    def test_lru_eviction(self):
+        urls = [self.url.replace('18.0.0', v)
+                for v in ('16.0.0', '18.0.0', '20.0.0')]
+        with mock.patch.object(nodeenv, 'cache_size', 10):
+            paths = []
+            for i, url in enumerate(urls):
+                paths.append(nodeenv.cache_store(url, io.BytesIO(b'x' * 4)))
+                # make the access order deterministic
+                os.utime(paths[-1], (1000 + i, 1000 + i))
+            assert not os.path.exists(paths[0])
+            assert os.path.exists(paths[1])
+            assert os.path.exists(paths[2])
+
+    def test_eviction_ignores_vanished_entries(self):
+        nodeenv.cache_store(self.url, io.BytesIO(b'x' * 4))
+        real_stat = os.stat
+
+        def racy_stat(path, *args, **kwargs):
+            if path == nodeenv._cache_entry(self.url):
+                raise OSError(2, 'No such file or directory')
+            return real_stat(path, *args, **kwargs)
+
+        other = self.url.replace('18.0.0', '20.0.0')
+        with mock.patch.object(nodeenv, 'cache_size', 1), \
+             mock.patch.object(nodeenv.os, 'stat', side_effect=racy_stat):
+            path = nodeenv.cache_store(other, io.BytesIO(b'y' * 4))
+        assert nodeenv.cache_lookup(other) == path
+
+    def test_download_node_src_warm_cache(self, tmpdir):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        with mock.patch.object(
+                nodeenv, 'urlopen',
+                side_effect=lambda url: io.BytesIO(archive)
+        ) as m_urlopen, \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+            assert m_urlopen.call_count == 1
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+            assert m_urlopen.call_count == 1
+
+        node = os.path.join(src_dir, 'node-v18.0.0-linux-x64', 'bin', 'node')
+        readme = os.path.join(src_dir, 'node-v18.0.0-linux-x64', 'README.md')
+        assert os.path.exists(node)
+        assert not os.path.exists(readme)
+
+    def test_download_node_src_stream_resumes(self, tmpdir):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        urlopen = range_urlopen(archive, drop_after=len(archive) // 2)
+        with mock.patch.object(nodeenv, 'urlopen', side_effect=urlopen), \
+             mock.patch.object(nodeenv.logger, 'info'), \
+             mock.patch.object(nodeenv.logger, 'warning') as m_warning:
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+        m_warning.assert_called_once()
+        assert os.path.exists(
+            os.path.join(src_dir, 'node-v18.0.0-linux-x64', 'bin', 'node'))
+        with open(nodeenv.cache_lookup(self.url), 'rb') as f:
+            assert f.read() == archive
+
+    def test_partial_download_is_resumed_by_next_run(self, tmpdir):
+        archive = make_node_tarball()
+        half = len(archive) // 2
+        urlopen = range_urlopen(archive, drop_after=half)
+
+        # first run: the link dies after half of the archive
+        calls = []
+
+        def first_run(url, headers=None):
+            calls.append(headers)
+            if len(calls) == 1:
+                return urlopen(url, headers)
+            raise nodeenv.urllib2.URLError('connection reset')
+
+        with mock.patch.object(nodeenv, 'urlopen', side_effect=first_run), \
+             mock.patch.object(nodeenv.logger, 'info'), \
+             mock.patch.object(nodeenv.logger, 'warning'), \
+             pytest.raises(nodeenv.urllib2.URLError):
+            nodeenv.download_node_src(
+                self.url, tmpdir.join('src1').strpath, self._args())
+        part = nodeenv._cache_entry(self.url) + '.part'
+        assert os.path.getsize(part) == half
+
+        # second run only asks for the missing bytes
+        with mock.patch.object(
+                nodeenv, 'urlopen', side_effect=range_urlopen(archive)
+        ) as m_urlopen, \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(
+                self.url, tmpdir.join('src2').strpath, self._args())
+        m_urlopen.assert_called_once_with(
+            self.url, {'Range': 'bytes=%d-' % half})
+        assert not os.path.exists(part)
+        with open(nodeenv.cache_lookup(self.url), 'rb') as f:
+            assert f.read() == archive
+        assert os.path.exists(tmpdir.join(
+            'src2', 'node-v18.0.0-linux-x64', 'bin', 'node').strpath)
+
+    def test_download_node_src_stream_failure_cleans_up(self, tmpdir):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        os.makedirs(src_dir)
+        corrupt = archive[:-40] + b'\xff' * 40
+        with mock.patch.object(
+                nodeenv, 'urlopen', return_value=io.BytesIO(corrupt)), \
+             mock.patch.object(nodeenv.logger, 'info'), \
+             pytest.raises(Exception):
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+        assert os.listdir(src_dir) == []
+        assert nodeenv.cache_lookup(self.url) is None
+
+    def test_download_node_src_segmented(self, tmpdir):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        with mock.patch.object(nodeenv, 'SEGMENT_MIN_SIZE', 64), \
+             mock.patch.object(
+                 nodeenv, 'urlopen', side_effect=range_urlopen(archive)
+        ) as m_urlopen, \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, src_dir, self._args('2'))
+        assert m_urlopen.call_count == 3
+        assert os.path.exists(
+            os.path.join(src_dir, 'node-v18.0.0-linux-x64', 'bin', 'node'))
+        with open(nodeenv.cache_lookup(self.url), 'rb') as f:
+            assert f.read() == archive
+
+    @pytest.mark.parametrize('segments', ['1', '2'])
+    def test_download_node_src_verifies_sha256(self, tmpdir, segments):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        with mock.patch.object(
+                nodeenv, 'get_expected_sha256',
+                return_value=hashlib.sha256(archive).hexdigest()), \
+             mock.patch.object(nodeenv, 'SEGMENT_MIN_SIZE', 64), \
+             mock.patch.object(
+                 nodeenv, 'urlopen', side_effect=range_urlopen(archive)
+        ) as m_urlopen, \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, src_dir, self._args(segments))
+            calls = m_urlopen.call_count
+            # the cached archive is trusted by its recorded digest
+            with mock.patch.object(nodeenv, '_TeeReader') as m_tee, \
+                 mock.patch.object(
+                     nodeenv, '_download_node_file') as m_download:
+                nodeenv.download_node_src(
+                    self.url, src_dir, self._args(segments))
+            m_tee.assert_not_called()
+            m_download.assert_not_called()
+            assert m_urlopen.call_count == calls
+        assert os.path.exists(
+            os.path.join(src_dir, 'node-v18.0.0-linux-x64', 'bin', 'node'))
+
+    @pytest.mark.parametrize('segments', ['1', '2'])
+    def test_download_node_src_sha256_mismatch(self, tmpdir, segments):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        os.makedirs(src_dir)
+        with mock.patch.object(
+                nodeenv, 'get_expected_sha256', return_value='0' * 64), \
+             mock.patch.object(nodeenv, 'SEGMENT_MIN_SIZE', 64), \
+             mock.patch.object(
+                 nodeenv, 'urlopen', side_effect=range_urlopen(archive)), \
+             mock.patch.object(nodeenv.logger, 'info'), \
+             pytest.raises(OSError, match='Checksum mismatch'):
+            nodeenv.download_node_src(self.url, src_dir, self._args(segments))
+        assert os.listdir(src_dir) == []
+        assert nodeenv.cache_lookup(self.url) is None
+        assert not os.listdir(os.path.dirname(nodeenv._cache_entry(self.url)))
+
+    def test_cached_archive_with_other_digest_is_downloaded(self, tmpdir):
+        archive = make_node_tarball()
+        nodeenv.cache_store(self.url, io.BytesIO(b'stale'))
+        src_dir = tmpdir.join('src').strpath
+        with mock.patch.object(
+                nodeenv, 'get_expected_sha256',
+                return_value=hashlib.sha256(archive).hexdigest()), \
+             mock.patch.object(
+                 nodeenv, 'urlopen', side_effect=range_urlopen(archive)
+        ) as m_urlopen, \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+        m_urlopen.assert_called_once()
+        with open(nodeenv.cache_lookup(self.url), 'rb') as f:
+            assert f.read() == archive
+
+    def test_failed_segment_is_not_resumed(self, tmpdir):
+        archive = make_node_tarball()
+        serve = range_urlopen(archive)
+
+        def one_segment_fails(url, headers=None):
+            range_header = (headers or {}).get('Range', '')
+            if range_header.startswith('bytes=') and \
+                    not range_header.startswith('bytes=0-'):
+                raise nodeenv.urllib2.URLError('connection reset')
+            return serve(url, headers)
+
+        with mock.patch.object(nodeenv, 'SEGMENT_MIN_SIZE', 64), \
+             mock.patch.object(
+                 nodeenv, 'urlopen', side_effect=one_segment_fails), \
+             mock.patch.object(nodeenv.logger, 'info'), \
+             pytest.raises(nodeenv.urllib2.URLError):
+            nodeenv.download_node_src(
+                self.url, tmpdir.join('src1').strpath, self._args('2'))
+        assert not os.path.exists(nodeenv._cache_entry(self.url) + '.part')
+
+        with mock.patch.object(nodeenv, 'SEGMENT_MIN_SIZE', 64), \
+             mock.patch.object(nodeenv, 'urlopen', side_effect=serve), \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(
+                self.url, tmpdir.join('src2').strpath, self._args('2'))
+        with open(nodeenv.cache_lookup(self.url), 'rb') as f:
+            assert f.read() == archive
+
+    def test_unsatisfiable_part_is_discarded(self, tmpdir):
+        archive = make_node_tarball()
+        path = nodeenv._cache_entry(self.url)
+        os.makedirs(os.path.dirname(path))
+        with open(path + '.part', 'wb') as f:
+            f.write(b'x' * (len(archive) + 10))
+
+        with mock.patch.object(
+                nodeenv, 'urlopen',
+                side_effect=range_not_satisfiable(len(archive))), \
+             mock.patch.object(nodeenv.logger, 'info'), \
+             pytest.raises(nodeenv.urllib2.HTTPError):
+            nodeenv.download_node_src(
+                self.url, tmpdir.join('src1').strpath, self._args())
+        assert not os.path.exists(path + '.part')
+
+        with mock.patch.object(
+                nodeenv, 'urlopen', side_effect=range_urlopen(archive)), \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(
+                self.url, tmpdir.join('src2').strpath, self._args())
+        with open(nodeenv.cache_lookup(self.url), 'rb') as f:
+            assert f.read() == archive
+
+    @pytest.mark.parametrize('value', ['0', 'many', '-2'])
+    def test_bad_download_segments(self, value):
+        argv = ['nodeenv', '--download-segments=' + value, 'env']
+        with mock.patch.object(sys, 'argv', argv), \
+             pytest.raises(SystemExit):
+            nodeenv.parse_args()
+
+    def test_download_node_src_without_cache(self, tmpdir):
+        archive = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        with mock.patch.object(nodeenv, 'cache_dir', ''), \
+             mock.patch.object(
+                 nodeenv, 'urlopen',
+                 side_effect=lambda url: io.BytesIO(archive)
+        ) as m_urlopen, \
+             mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+            nodeenv.download_node_src(self.url, src_dir, self._args())
+            assert m_urlopen.call_count == 2
+        assert os.path.exists(
+            os.path.join(src_dir, 'node-v18.0.0-linux-x64', 'bin', 'node'))
+
+
+class TestConnectionPool:
+    """Tests for the keep-alive connection pool behind urlopen()"""
+
+    @pytest.fixture(autouse=True)
+    def fresh_pool(self):
+        with mock.patch.object(nodeenv, '_pool', nodeenv._ConnectionPool()):
+            yield
+
+    def test_connection_is_reused(self, local_server):
+        local_server.files['/a'] = b'a' * 1000
+        local_server.files['/b'] = b'b' * 10
+        for path in ('/a', '/b', '/a'):
+            response = nodeenv.urlopen(local_server.url + path)
+            assert response.read() == local_server.files[path]
+            response.close()
+        clients = set(addr for _, addr in local_server.requests)
+        assert len(clients) == 1
+
+    def test_chunked_reads(self, local_server):
+        local_server.files['/a'] = os.urandom(100)
+        response = nodeenv.urlopen(local_server.url + '/a')
+        assert response.getcode() == 200
+        assert response.headers.get('Content-Length') == '100'
+        data = b''.join(iter(lambda: response.read(7), b''))
+        assert data == local_server.files['/a']
+
+    def test_unread_response_is_not_reused(self, local_server):
+        local_server.files['/a'] = b'a' * 100000
+        response = nodeenv.urlopen(local_server.url + '/a')
+        response.read(10)
+        response.close()
+        assert nodeenv.urlopen(local_server.url + '/a').read() == \
+            local_server.files['/a']
+        clients = set(addr for _, addr in local_server.requests)
+        assert len(clients) == 2
+
+    def test_redirect(self, local_server):
+        local_server.files['/b'] = b'target'
+        local_server.redirects['/a'] = '/b'
+        response = nodeenv.urlopen(local_server.url + '/a')
+        assert response.read() == b'target'
+        assert response.geturl() == local_server.url + '/b'
+
+    def test_http_error(self, local_server):
+        with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+            nodeenv.urlopen(local_server.url + '/missing')
+        assert excinfo.value.code == 404
+
+    def test_range_request(self, local_server):
+        local_server.files['/a'] = b'0123456789'
+        response = nodeenv.urlopen(
+            local_server.url + '/a', {'Range': 'bytes=2-'})
+        response.read()
+        # the stand-in server ignores ranges, but must have seen the header
+        assert response.getcode() == 200
+        assert local_server.headers[-1]['Range'] == 'bytes=2-'
+
+    def test_stale_connection_is_replaced(self, local_server):
+        local_server.files['/a'] = b'data'
+        assert nodeenv.urlopen(local_server.url + '/a').read() == b'data'
+        for conns in nodeenv._pool._idle.values():
+            for conn in conns:
+                conn.sock.close()
+        assert nodeenv.urlopen(local_server.url + '/a').read() == b'data'
+
+    @pytest.mark.skipif(shutil.which('openssl') is None,
+                        reason='needs openssl to make a certificate')
+    def test_tls_session_is_resumed(self, local_server, tmpdir):
+        cert = tmpdir.join('cert.pem').strpath
+        key = tmpdir.join('key.pem').strpath
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+             '-keyout', key, '-out', cert, '-days', '1',
+             '-subj', '/CN=127.0.0.1'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.minimum_version = ssl.TLSVersion.TLSv1_3
+        server_context.load_cert_chain(cert, key)
+        local_server.socket = server_context.wrap_socket(
+            local_server.socket, server_side=True)
+        local_server.files['/a'] = b'data'
+        url = local_server.url.replace('http:', 'https:') + '/a'
+        client_context = ssl.create_default_context(cafile=cert)
+        client_context.check_hostname = False
+
+        reused = []
+        with mock.patch.object(nodeenv, '_ssl_context',
+                               return_value=client_context):
+            for _ in range(2):
+                assert nodeenv.urlopen(url).read() == b'data'
+                # the next request needs a new connection
+                idle, = nodeenv._pool._idle.pop(
+                    ('https', '127.0.0.1', local_server.server_port))
+                reused.append(idle.sock.session_reused)
+                idle.close()
+        assert reused == [False, True]
+
+    def test_proxied_urls_use_urllib(self, monkeypatch):
+        monkeypatch.delenv('no_proxy', raising=False)
+        monkeypatch.delenv('NO_PROXY', raising=False)
+        monkeypatch.setenv('https_proxy', 'http://proxy:3128')
+        assert not nodeenv._is_poolable('https://nodejs.org/dist/')
+        assert not nodeenv._is_poolable('file:///tmp/mirror/')
+        monkeypatch.delenv('https_proxy')
+        monkeypatch.delenv('HTTPS_PROXY', raising=False)
+        assert nodeenv._is_poolable('https://nodejs.org/dist/')
+
+
+def closed_port_url():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return 'http://127.0.0.1:%d' % port
+
+
+class TestMirrors:
+    """Tests for ranking mirrors and failing over between them"""
+
+    def test_get_mirror_urls(self):
+        assert nodeenv.get_mirror_urls(
+            'npm.some-mirror.com, https://example.com/node/,') == [
+            'https://npm.some-mirror.com/download/release',
+            'https://example.com/node',
+        ]
+
+    def test_empty_mirror_list_is_rejected(self):
+        with mock.patch.object(sys, 'argv', ['nodeenv', '--mirror=,', 'env']):
+            with pytest.raises(SystemExit):
+                nodeenv.parse_args()
+
+    def test_probe_mirror(self, local_server):
+        local_server.files['/index.json'] = b'[]'
+        assert nodeenv._probe_mirror(local_server.url) > 0
+        assert local_server.headers[-1]['Range'] == 'bytes=0-65535'
+        assert nodeenv._probe_mirror(closed_port_url()) is None
+
+    def test_rank_mirrors(self, isolated_cache):
+        scores = {'https://a': 3.0, 'https://b': None, 'https://c': 1.0}
+        with mock.patch.object(nodeenv, '_probe_mirror',
+                               side_effect=scores.get) as m_probe:
+            ranking = nodeenv.rank_mirrors(
+                ['https://a', 'https://b', 'https://c'])
+            assert ranking == ['https://c', 'https://a', 'https://b']
+            assert m_probe.call_count == 3
+            # a recent ranking is reused
+            assert nodeenv.rank_mirrors(
+                ['https://a', 'https://b', 'https://c']) == ranking
+            assert m_probe.call_count == 3
+
+    def test_rank_mirrors_expires(self, isolated_cache):
+        with mock.patch.object(nodeenv, '_probe_mirror',
+                               return_value=1.0) as m_probe:
+            nodeenv.rank_mirrors(['https://a', 'https://b'])
+            with mock.patch.object(nodeenv, 'MIRROR_RANK_TTL', 0):
+                nodeenv.rank_mirrors(['https://a', 'https://b'])
+        assert m_probe.call_count == 4
+
+    def test_single_mirror_is_not_probed(self):
+        with mock.patch.object(nodeenv, '_probe_mirror') as m_probe:
+            assert nodeenv.rank_mirrors(['https://a']) == ['https://a']
+        m_probe.assert_not_called()
+
+    def test_failover(self, local_server):
+        local_server.files['/v1/a.tar.gz'] = b'data'
+        dead = closed_port_url()
+        nodeenv.mirrors[:] = [dead, local_server.url]
+        response = nodeenv.urlopen(dead + '/v1/a.tar.gz')
+        assert response.read() == b'data'
+        # later requests go to the working mirror first
+        assert nodeenv.mirrors == [local_server.url, dead]
+
+    def test_failover_on_missing_file(self):
+        nodeenv.mirrors[:] = ['https://a', 'https://b']
+
+        def fake_urlopen(url, headers=None):
+            if url.startswith('https://a/'):
+                raise nodeenv.urllib2.HTTPError(url, 404, 'Not Found',
+                                                {}, None)
+            return FakeResponse(b'data')
+
+        with mock.patch.object(nodeenv, '_urlopen',
+                               side_effect=fake_urlopen):
+            assert nodeenv.urlopen('https://a/v1/x').read() == b'data'
+        # a mirror lagging behind is still used for other files
+        assert nodeenv.mirrors == ['https://a', 'https://b']
+
+    def test_no_failover_on_client_errors(self):
+        nodeenv.mirrors[:] = ['https://a', 'https://b']
+        error = nodeenv.urllib2.HTTPError('https://a/x', 416, 'Range',
+                                          {}, None)
+        with mock.patch.object(nodeenv, '_urlopen',
+                               side_effect=error) as m_urlopen:
+            with pytest.raises(nodeenv.urllib2.HTTPError):
+                nodeenv.urlopen('https://a/x')
+        assert m_urlopen.call_count == 1
+
+    def test_stalled_download_fails_over(self):
+        nodeenv.mirrors[:] = ['https://a', 'https://b']
+        data = b'x' * 100
+
+        def fake_urlopen(url, headers=None):
+            start = 0
+            if headers and 'Range' in headers:
+                start = int(headers['Range'][len('bytes='):-1])
+            if url.startswith('https://a/'):
+                response = FakeResponse(
+                    data[:50], headers={'Content-Length': '100'})
+                response.read = mock.Mock(side_effect=[
+                    data[:50], socket.timeout('stalled')])
+                return response
+            return FakeResponse(
+                data[start:], code=206 if start else 200,
+                headers={'Content-Length': str(len(data) - start)})
+
+        with mock.patch.object(nodeenv, '_urlopen',
+                               side_effect=fake_urlopen) as m_urlopen:
+            fileobj, _ = nodeenv._download_node_file('https://a/v1/x')
+        assert fileobj.read() == data
+        assert m_urlopen.call_args_list[-1] == mock.call(
+            'https://b/v1/x', {'Range': 'bytes=50-'})
+        assert nodeenv.mirrors == ['https://b', 'https://a']
+
+    def test_cache_key_ignores_ranking(self, isolated_cache):
+        nodeenv.mirrors[:] = ['https://a', 'https://b']
+        entry = nodeenv._cache_entry('https://a/v1/x.tar.gz')
+        nodeenv.mirrors.reverse()
+        assert nodeenv._cache_entry('https://b/v1/x.tar.gz') == entry
+
+    def test_main_uses_fastest_mirror(self):
+        argv = ['nodeenv', '--list', '--mirror=https://a,https://b']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(nodeenv, 'rank_mirrors',
+                                  return_value=['https://b', 'https://a']), \
+                mock.patch.object(nodeenv, 'print_node_versions'), \
+                mock.patch.object(nodeenv, 'get_last_stable_node_version',
+                                  return_value='18.0.0'):
+            nodeenv.main()
+        assert nodeenv.src_base_url == 'https://b'
+        assert nodeenv.mirrors == ['https://b', 'https://a']
+
+
+class TestOffline:
+    """Tests for --offline"""
+
+    url = (
+        'https://nodejs.org/download/release/v18.0.0/'
+        'node-v18.0.0-linux-x64.tar.gz'
+    )
+
+    @pytest.fixture(autouse=True)
+    def offline(self, isolated_cache):
+        with mock.patch.object(nodeenv, 'offline', True), \
+                mock.patch.object(nodeenv, 'src_base_url',
+                                  'https://nodejs.org/download/release'):
+            yield
+
+    def test_network_is_refused(self):
+        with pytest.raises(nodeenv.OfflineError):
+            nodeenv.urlopen(self.url)
+
+    def test_stale_index_is_used(self, isolated_cache):
+        with mock.patch.object(nodeenv, 'offline', False), \
+                mock.patch.object(nodeenv, 'urlopen',
+                                  return_value=index_response()):
+            nodeenv._get_versions_json()
+        nodeenv._versions_json.clear()
+        expire_index_cache(isolated_cache)
+        with mock.patch.object(nodeenv, '_urlopen') as m_urlopen:
+            assert nodeenv._get_versions_json() == INDEX_DATA
+        m_urlopen.assert_not_called()
+
+    def test_missing_index(self):
+        with pytest.raises(nodeenv.OfflineError) as excinfo:
+            nodeenv._get_versions_json()
+        assert 'index.json' in str(excinfo.value)
+
+    def test_missing_checksums(self):
+        assert nodeenv.get_expected_sha256(self.url) is None
+
+    def test_cached_archive_is_installed(self, tmpdir):
+        nodeenv.cache_store(self.url, io.BytesIO(make_node_tarball()))
+        src_dir = tmpdir.join('src').strpath
+        args = mock.Mock(node='18.0.0', download_segments='1',
+                         profile_extract='full')
+        with mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, src_dir, args)
+        assert os.path.isdir(os.path.join(src_dir, 'node-v18.0.0-linux-x64'))
+
+    def test_missing_archive(self, tmpdir):
+        args = mock.Mock(node='18.0.0', download_segments='1',
+                         profile_extract='full')
+        with mock.patch.object(nodeenv.logger, 'info'), \
+                pytest.raises(nodeenv.OfflineError):
+            nodeenv.download_node_src(self.url, tmpdir.strpath, args)
+
+    @pytest.mark.skipif(not nodeenv.has_lzma, reason='needs lzma')
+    def test_cached_xz_archive_is_picked(self):
+        xz_url = self.url.replace('.tar.gz', '.tar.xz')
+        nodeenv.cache_store(xz_url, io.BytesIO(b'archive'))
+        with mock.patch.object(nodeenv, 'get_node_bin_url',
+                               side_effect=lambda v, fmt: (
+                                   xz_url if fmt == 'xz' else self.url)), \
+                mock.patch.object(nodeenv, 'is_WIN', False), \
+                mock.patch.object(nodeenv, 'is_CYGWIN', False):
+            assert nodeenv.get_node_archive_url('18.0.0') == xz_url
+
+    def test_main_fails_before_creating_env(self, tmpdir):
+        env_dir = tmpdir.join('env').strpath
+        argv = ['nodeenv', '--offline', '--node=18.0.0', env_dir]
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(nodeenv, 'mirrors', []), \
+                mock.patch.object(nodeenv.logger, 'error') as m_error, \
+                pytest.raises(SystemExit) as excinfo:
+            nodeenv.main()
+        assert excinfo.value.code == 2
+        assert 'not in the download cache' in m_error.call_args[0][1].args[0]
+        assert not os.path.exists(env_dir)
+
+    def test_with_npm_is_rejected(self):
+        argv = ['nodeenv', '--offline', '--with-npm', 'env']
+        with mock.patch.object(sys, 'argv', argv), \
+                pytest.raises(SystemExit):
+            nodeenv.parse_args()
+
+
+class TestPrefetch:
+    """Tests for --prefetch"""
+
+    @pytest.fixture
+    def releases(self, isolated_cache):
+        archives = {}
+        for version in ('16.20.0', '18.1.0', '18.0.0'):
+            url = nodeenv.get_node_archive_url(version, archive_format='gz')
+            archives[url] = make_node_tarball(version)
+        serve = dict((url, range_urlopen(data))
+                     for url, data in archives.items())
+
+        def fake_urlopen(url, headers=None):
+            if url not in serve:
+                raise nodeenv.urllib2.HTTPError(url, 404, 'Not Found',
+                                                {}, None)
+            return serve[url](url, headers)
+
+        with mock.patch.object(nodeenv, 'urlopen',
+                               side_effect=fake_urlopen) as m_urlopen, \
+                mock.patch.object(nodeenv.logger, 'info'):
+            m_urlopen.archives = archives
+            yield m_urlopen
+
+    @pytest.fixture
+    def args(self):
+        return mock.Mock(prebuilt=True, archive_format='gz',
+                         download_segments='1')
+
+    @pytest.mark.usefixtures('mock_index_json')
+    def test_resolve_node_version(self):
+        assert nodeenv.resolve_node_version('latest') == '13.5.0'
+        assert nodeenv.resolve_node_version('lts') == '12.14.0'
+        assert nodeenv.resolve_node_version('12') == '12.14.0'
+        assert nodeenv.resolve_node_version('10.16') == '10.16.3'
+        assert nodeenv.resolve_node_version('v8.1.2') == '8.1.2'
+        assert nodeenv.resolve_node_version('99') is None
+
+    def test_prefetch(self, releases, args):
+        specs = '16.20.0,18.0.0,18.1.0,v18.1.0'
+        with mock.patch.object(nodeenv, 'get_expected_sha256',
+                               return_value=None):
+            assert nodeenv.prefetch_node_versions(specs, args)
+        for url, data in releases.archives.items():
+            with open(nodeenv.cache_lookup(url), 'rb') as f:
+                assert f.read() == data
+        assert releases.call_count == 3
+
+        # cached archives are not downloaded again
+        with mock.patch.object(nodeenv, 'get_expected_sha256',
+                               return_value=None):
+            assert nodeenv.prefetch_node_versions(specs, args)
+        assert releases.call_count == 3
+
+    def test_prefetch_checks_sha256(self, releases, args):
+        with mock.patch.object(nodeenv, 'get_expected_sha256',
+                               return_value='0' * 64), \
+                mock.patch.object(nodeenv.logger, 'error') as m_error:
+            assert not nodeenv.prefetch_node_versions('18.0.0', args)
+        assert 'Checksum mismatch' in str(m_error.call_args[0][2])
+        url = nodeenv.get_node_archive_url('18.0.0', archive_format='gz')
+        assert nodeenv.cache_lookup(url) is None
+
+    def test_prefetch_reports_each_failure(self, releases, args):
+        with mock.patch.object(nodeenv, 'get_expected_sha256',
+                               return_value=None), \
+                mock.patch.object(nodeenv.logger, 'error') as m_error:
+            assert not nodeenv.prefetch_node_versions('18.0.0,20.0.0', args)
+        assert m_error.call_count == 1
+        url = nodeenv.get_node_archive_url('18.0.0', archive_format='gz')
+        assert nodeenv.cache_lookup(url)
+
+    def test_main_does_not_create_env(self, tmpdir):
+        argv = ['nodeenv', '--prefetch=18,lts', '--node=18.0.0']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(nodeenv, 'prefetch_node_versions',
+                                  return_value=True) as m_prefetch, \
+                mock.patch.object(nodeenv, 'create_environment') as m_create:
+            nodeenv.main()
+        assert m_prefetch.call_args[0][0] == '18,lts'
+        m_create.assert_not_called()
+
+    def test_offline_is_rejected(self):
+        argv = ['nodeenv', '--prefetch=18', '--offline']
+        with mock.patch.object(sys, 'argv', argv), \
+                pytest.raises(SystemExit):
+            nodeenv.parse_args()
+
+
+def file_url(path):
+    return 'file://' + nodeenv.urllib2.pathname2url(path)
+
+
+class TestFileUrls:
+    """Tests for reading file:// mirrors straight from disk"""
+
+    def test_read(self, tmpdir):
+        tmpdir.join('a').write_binary(b'0123456789')
+        response = nodeenv.urlopen(file_url(tmpdir.join('a').strpath))
+        assert response.getcode() == 200
+        assert response.headers['Content-Length'] == '10'
+        assert response.read() == b'0123456789'
+
+    def test_range(self, tmpdir):
+        tmpdir.join('a').write_binary(b'0123456789')
+        url = file_url(tmpdir.join('a').strpath)
+        response = nodeenv.urlopen(url, {'Range': 'bytes=4-'})
+        assert response.getcode() == 206
+        assert response.headers['Content-Range'] == 'bytes 4-9/10'
+        assert response.read() == b'456789'
+        with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+            nodeenv.urlopen(url, {'Range': 'bytes=10-'})
+        assert excinfo.value.code == 416
+        assert excinfo.value.headers['Content-Range'] == 'bytes */10'
+
+    def test_missing(self, tmpdir):
+        with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+            nodeenv.urlopen(file_url(tmpdir.join('missing').strpath))
+        assert excinfo.value.code == 404
+
+    def test_offline(self, tmpdir):
+        tmpdir.join('a').write_binary(b'data')
+        with mock.patch.object(nodeenv, 'offline', True):
+            response = nodeenv.urlopen(file_url(tmpdir.join('a').strpath))
+            assert response.read() == b'data'
+
+    def test_not_cached(self, tmpdir, isolated_cache):
+        url = file_url(tmpdir.join('a').strpath)
+        assert nodeenv._cache_entry(url) is None
+
+
+class TestMirrorSync:
+    """Tests for --mirror-sync"""
+
+    platforms = ('linux-x64', 'darwin-arm64', 'win-x64')
+
+    @pytest.fixture
+    def upstream(self, tmpdir):
+        """A file:// release tree with two releases"""
+        root = tmpdir.mkdir('upstream')
+        index = []
+        for version in ('18.0.0', '20.0.0'):
+            release = root.mkdir('v%s' % version)
+            lines = []
+            names = ['node-v%s.tar.gz' % version]
+            names += ['node-v%s-%s.tar.gz' % (version, p)
+                      for p in self.platforms if not p.startswith('win')]
+            names += ['node-v%s-win-x64.zip' % version,
+                      'node-v%s-headers.tar.gz' % version]
+            for name in names:
+                data = ('%s contents' % name).encode('ascii')
+                release.join(name).write_binary(data)
+                lines.append('%s  %s' % (
+                    hashlib.sha256(data).hexdigest(), name))
+            release.join('SHASUMS256.txt').write('\n'.join(lines) + '\n')
+            index.insert(0, {
+                'version': 'v%s' % version, 'lts': False,
+                'files': ['headers', 'linux-x64', 'osx-arm64-tar',
+                          'src', 'win-x64-zip', 'win-x64-msi'],
+            })
+        root.join('index.json').write(json.dumps(index))
+        with mock.patch.object(nodeenv, 'src_base_url',
+                               file_url(root.strpath)), \
+                mock.patch.object(nodeenv.logger, 'info'):
+            yield root
+
+    def test_sync(self, upstream, tmpdir):
+        dest = tmpdir.join('mirror')
+        assert nodeenv.sync_mirror(dest.strpath, '18.0.0,latest',
+                                   {'linux-x64', 'src'})
+        for version in ('18.0.0', '20.0.0'):
+            release = dest.join('v%s' % version)
+            assert sorted(os.listdir(release.strpath)) == [
+                'SHASUMS256.txt',
+                'node-v%s-linux-x64.tar.gz' % version,
+                'node-v%s.tar.gz' % version,
+            ]
+            assert release.join('SHASUMS256.txt').read() == \
+                upstream.join('v%s' % version, 'SHASUMS256.txt').read()
+        index = json.loads(dest.join('index.json').read())
+        assert [v['version'] for v in index] == ['v20.0.0', 'v18.0.0']
+        assert index[0]['files'] == ['linux-x64', 'src']
+
+    def test_windows_and_darwin_index_keys(self, upstream, tmpdir):
+        dest = tmpdir.join('mirror')
+        assert nodeenv.sync_mirror(dest.strpath, '20.0.0',
+                                   {'darwin-arm64', 'win-x64'})
+        index = json.loads(dest.join('index.json').read())
+        assert index[0]['files'] == ['osx-arm64-tar', 'win-x64-zip']
+
+    def test_incremental(self, upstream, tmpdir):
+        dest = tmpdir.join('mirror')
+        nodeenv.sync_mirror(dest.strpath, '18.0.0', {'linux-x64'})
+        archive = dest.join('v18.0.0', 'node-v18.0.0-linux-x64.tar.gz')
+        archive.write_binary(b'corrupt')
+        with mock.patch.object(nodeenv, '_download_node_file',
+                               wraps=nodeenv._download_node_file) as m_dl:
+            assert nodeenv.sync_mirror(dest.strpath, '18.0.0,20.0.0',
+                                       {'linux-x64'})
+        # the intact archive of 18.0.0 was skipped
+        assert m_dl.call_count == 2
+        assert nodeenv.logger.info.call_args[0][3:] == (2, 0)
+        assert nodeenv.sync_mirror(dest.strpath, '18.0.0,20.0.0',
+                                   {'linux-x64'})
+        assert nodeenv.logger.info.call_args[0][3:] == (0, 2)
+        assert archive.read_binary() == \
+            b'node-v18.0.0-linux-x64.tar.gz contents'
+        index = json.loads(dest.join('index.json').read())
+        assert [v['version'] for v in index] == ['v20.0.0', 'v18.0.0']
+
+    def test_checksum_mismatch(self, upstream, tmpdir):
+        upstream.join('v18.0.0', 'node-v18.0.0.tar.gz').write('tampered')
+        dest = tmpdir.join('mirror')
+        with mock.patch.object(nodeenv.logger, 'error') as m_error:
+            assert not nodeenv.sync_mirror(dest.strpath, '18.0.0', {'src'})
+        assert 'Checksum mismatch' in str(m_error.call_args[0][2])
+        assert not dest.join('index.json').exists()
+        assert os.listdir(dest.join('v18.0.0').strpath) == []
+
+    def test_install_from_synced_mirror(self, upstream, tmpdir):
+        version_dir = upstream.join('v18.0.0')
+        name = 'node-v18.0.0-linux-x64.tar.gz'
+        data = make_node_tarball()
+        version_dir.join(name).write_binary(data)
+        version_dir.join('SHASUMS256.txt').write(
+            '%s  %s\n' % (hashlib.sha256(data).hexdigest(), name))
+        dest = tmpdir.join('mirror')
+        assert nodeenv.sync_mirror(dest.strpath, '18.0.0', {'linux-x64'})
+
+        src_dir = tmpdir.join('src').strpath
+        url = file_url(dest.join('v18.0.0', name).strpath)
+        args = mock.Mock(node='18.0.0', download_segments='1',
+                         profile_extract='full')
+        nodeenv.download_node_src(url, src_dir, args)
+        assert os.path.isdir(os.path.join(src_dir, 'node-v18.0.0-linux-x64'))
+
+    def test_main_does_not_create_env(self, tmpdir):
+        argv = ['nodeenv', '--mirror-sync', tmpdir.strpath, '--node=18.0.0',
+                '--sync-platforms=linux-x64,src']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(nodeenv, 'sync_mirror',
+                                  return_value=True) as m_sync, \
+                mock.patch.object(nodeenv, 'create_environment') as m_create:
+            nodeenv.main()
+        m_sync.assert_called_once_with(
+            tmpdir.strpath, 'latest,lts', {'linux-x64', 'src'})
+        m_create.assert_not_called()
+
+
+class TestServeCache:
+    """Tests for the --serve-cache proxy"""
+
+    archive_path = '/v18.0.0/node-v18.0.0-linux-x64.tar.gz'
+
+    @pytest.fixture
+    def proxy(self, local_server, isolated_cache):
+        local_server.files[self.archive_path] = b'archive' * 1000
+        local_server.files['/index.json'] = b'[]'
+        server = nodeenv._CacheServer(('127.0.0.1', 0))
+        server.url = 'http://127.0.0.1:%d' % server.server_address[1]
+        thread = threading.Thread(target=server.serve_forever,
+                                  kwargs={'poll_interval': 0.05})
+        thread.daemon = True
+        with mock.patch.object(nodeenv, 'src_base_url', local_server.url):
+            thread.start()
+            yield server
+            server.shutdown()
+            server.server_close()
+
+    def upstream_requests(self, local_server, path):
+        return [p for p, _ in local_server.requests if p == path]
+
+    def test_miss_then_hit(self, proxy, local_server):
+        for _ in range(2):
+            response = nodeenv.urlopen(proxy.url + self.archive_path)
+            assert response.getcode() == 200
+            assert response.read() == b'archive' * 1000
+        assert len(self.upstream_requests(
+            local_server, self.archive_path)) == 1
+
+    def test_concurrent_misses_are_coalesced(self, proxy, local_server):
+        fetch = nodeenv._fetch_node_archive
+
+        def slow_fetch(*args, **kwargs):
+            time.sleep(0.2)
+            return fetch(*args, **kwargs)
+
+        results = []
+
+        def get():
+            results.append(nodeenv.urlopen(
+                proxy.url + self.archive_path).read())
+
+        with mock.patch.object(nodeenv, '_fetch_node_archive',
+                               side_effect=slow_fetch):
+            threads = [threading.Thread(target=get) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        assert results == [b'archive' * 1000] * 5
+        assert len(self.upstream_requests(
+            local_server, self.archive_path)) == 1
+
+    def test_range(self, proxy):
+        url = proxy.url + self.archive_path
+        response = nodeenv.urlopen(url, {'Range': 'bytes=7-13'})
+        assert response.getcode() == 206
+        assert response.headers['Content-Range'] == 'bytes 7-13/7000'
+        assert response.read() == b'archive'
+        with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+            nodeenv.urlopen(url, {'Range': 'bytes=7000-'})
+        assert excinfo.value.code == 416
+
+    def test_missing_upstream(self, proxy):
+        with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+            nodeenv.urlopen(proxy.url + '/v18.0.0/missing.tar.gz')
+        assert excinfo.value.code == 404
+
+    def test_path_traversal(self, proxy, local_server):
+        conn = nodeenv.httplib.HTTPConnection(*proxy.server_address)
+        conn.request('GET', '/v18.0.0/../../etc/passwd')
+        assert conn.getresponse().status == 404
+        conn.close()
+        assert local_server.requests == []
+
+    def test_index_is_refreshed(self, proxy, local_server):
+        assert nodeenv.urlopen(proxy.url + '/index.json').read() == b'[]'
+        local_server.files['/index.json'] = b'[{}]'
+        assert nodeenv.urlopen(proxy.url + '/index.json').read() == b'[]'
+        with mock.patch.object(nodeenv, 'index_ttl', -1):
+            assert nodeenv.urlopen(
+                proxy.url + '/index.json').read() == b'[{}]'
+
+    def test_checksum_mismatch(self, proxy, local_server):
+        local_server.files['/v18.0.0/SHASUMS256.txt'] = (
+            '%s  node-v18.0.0-linux-x64.tar.gz\n' % ('0' * 64)).encode()
+        with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+            nodeenv.urlopen(proxy.url + self.archive_path)
+        assert excinfo.value.code == 502
+
+    def test_file_mirror_is_not_served(self, proxy, tmpdir):
+        tmpdir.join(self.archive_path).write('archive', ensure=True)
+        with mock.patch.object(nodeenv, 'src_base_url',
+                               file_url(tmpdir.strpath)), \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=None), \
+                mock.patch.object(nodeenv.logger, 'warning'):
+            with pytest.raises(nodeenv.urllib2.HTTPError) as excinfo:
+                nodeenv.urlopen(proxy.url + self.archive_path)
+        assert excinfo.value.code == 502
+
+    def test_file_mirror(self, tmpdir):
+        argv = ['nodeenv', '--serve-cache',
+                '--mirror=%s' % file_url(tmpdir.strpath)]
+        with mock.patch.object(sys, 'argv', argv), \
+                pytest.raises(SystemExit):
+            nodeenv.parse_args()
+
+    def test_install_through_proxy(self, proxy, local_server, tmpdir):
+        local_server.files[self.archive_path] = make_node_tarball()
+        src_dir = tmpdir.join('src').strpath
+        args = mock.Mock(node='18.0.0', download_segments='1',
+                         profile_extract='full')
+        with mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(
+                proxy.url + self.archive_path, src_dir, args)
+        assert os.path.isdir(os.path.join(src_dir, 'node-v18.0.0-linux-x64'))
+
+
+class TestProgress:
+    """Tests for progress reporting"""
+
+    url = 'https://nodejs.org/download/release/v18.0.0/node.tar.gz'
+
+    @pytest.fixture
+    def events(self):
+        events = []
+        with mock.patch.object(
+                nodeenv, 'progress_callback',
+                lambda *event: events.append(event)):
+            yield events
+
+    def test_download_and_extract(self, events, tmpdir):
+        archive = make_node_tarball()
+        args = mock.Mock(node='18.0.0', download_segments='1',
+                         profile_extract='full')
+        with mock.patch.object(nodeenv, 'urlopen',
+                               side_effect=range_urlopen(archive)), \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=None), \
+                mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, tmpdir.strpath, args)
+        downloads = [e for e in events if e[0] == 'download']
+        assert downloads[-1] == ('download', 0, len(archive), len(archive))
+        assert [e[2] for e in downloads] == sorted(e[2] for e in downloads)
+        extracts = [e for e in events if e[0] == 'extract']
+        assert [e[1] for e in extracts] == list(range(1, len(extracts) + 1))
+        assert extracts[-1][2] > 0
+
+    def test_segmented_download(self, events):
+        data = b'x' * 1000
+        with mock.patch.object(nodeenv, 'SEGMENT_MIN_SIZE', 100), \
+                mock.patch.object(nodeenv, 'urlopen',
+                                  side_effect=range_urlopen(data)):
+            nodeenv._download_node_file(self.url, segments=4)
+        assert events[-1] == ('download', 0, 1000, 1000)
+
+    def test_copy(self, events, tmpdir):
+        src = tmpdir.mkdir('src').mkdir('node-v18.0.0-linux-x64')
+        src.mkdir('bin').join('node').write_binary(b'1234')
+        src.join('README.md').write_binary(b'12')
+        src.join('bin', 'npm').mksymlinkto('node')
+        env_dir = tmpdir.mkdir('env')
+        with mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.copy_node_from_prebuilt(
+                env_dir.strpath, tmpdir.join('src').strpath, '18.0.0')
+        # the symlink is not counted
+        assert len(events) == 2
+        assert events[-1] == ('copy', 2, 6, None)
+        assert env_dir.join('bin', 'npm').islink()
+
+    def test_printer_plain_lines(self):
+        stream = io.StringIO()
+        printer = nodeenv.ProgressPrinter(stream, interval=3600)
+        with mock.patch.object(nodeenv.time, 'time', return_value=100.0):
+            printer('download', 0, 1000000, 4000000)
+        with mock.patch.object(nodeenv.time, 'time', return_value=102.0):
+            printer('download', 0, 2000000, 4000000)
+            printer('extract', 10, 3000000, None)
+        with mock.patch.object(nodeenv.time, 'time', return_value=103.0):
+            printer.finish()
+        assert stream.getvalue().splitlines() == [
+            '   Downloading 2.0/4.0 MB, 0.5 MB/s, 4s left'
+            ' | Extracting 10 files, 3.0 MB',
+        ]
+
+    def test_printer_interleaved_stages(self):
+        stream = io.StringIO()
+        printer = nodeenv.ProgressPrinter(stream)
+        now = [100.0]
+        with mock.patch.object(nodeenv.time, 'time', lambda: now[0]):
+            # 12 s of a streamed install, 1 MB/s in and 2 files/s out
+            for step in range(1, 1201):
+                now[0] = 100.0 + step / 100.0
+                printer('download', 0, step * 10000, 20000000)
+                if step % 50 == 0:
+                    printer('extract', step // 50, step * 20000, None)
+            printer.finish()
+        lines = stream.getvalue().splitlines()
+        assert len(lines) == 3
+        assert lines[-1] == (
+            '   Downloading 12.0/20.0 MB, 1.0 MB/s, 8s left'
+            ' | Extracting 24 files, 24.0 MB, 2.0 MB/s')
+
+    def test_printer_reused(self):
+        stream = io.StringIO()
+        printer = nodeenv.ProgressPrinter(stream)
+        for version in range(2):
+            printer('extract', 1, 10, None)
+            printer.finish()
+        assert stream.getvalue().splitlines() == [
+            '   Extracting 1 files, 0.0 MB'] * 2
+
+    def test_printer_tty(self):
+        stream = io.StringIO()
+        stream.isatty = lambda: True
+        printer = nodeenv.ProgressPrinter(stream)
+        with mock.patch.object(nodeenv.time, 'time', return_value=100.0):
+            printer('download', 0, 0, 100)
+        with mock.patch.object(nodeenv.time, 'time', return_value=101.0):
+            printer('download', 0, 50, 100)
+            printer.finish()
+        assert stream.getvalue().startswith('\n\r   Downloading')
+        assert stream.getvalue().endswith('\x1b[K\n')
+
+    def test_main_installs_printer(self):
+        argv = ['nodeenv', '--progress', '--list']
+        with mock.patch.object(sys, 'argv', argv), \
+                mock.patch.object(nodeenv, 'print_node_versions'), \
+                mock.patch.object(nodeenv, 'get_last_stable_node_version',
+                                  return_value='18.0.0'):
+            nodeenv.main()
+        assert isinstance(nodeenv.progress_callback, nodeenv.ProgressPrinter)
+
+
+class TestExtractProfiles:
+    """Tests for --profile-extract"""
+
+    linux = [
+        'bin/node', 'bin/npm', 'bin/npx', 'bin/corepack',
+        'include/node/v8.h', 'share/doc/node/gdbinit',
+        'share/man/man1/node.1', 'README.md',
+        'lib/node_modules/npm/bin/npm-cli.js',
+        'lib/node_modules/npm/docs/output/commands/npm.html',
+        'lib/node_modules/npm/man/man1/npm.1',
+        'lib/node_modules/corepack/dist/corepack.js',
+    ]
+    windows = [
+        'node.exe', 'npm', 'npm.cmd', 'npx.ps1', 'corepack.cmd',
+        'node_modules/npm/bin/npm-cli.js', 'node_modules/npm/docs/x.html',
+        'node_modules/corepack/dist/corepack.js',
+    ]
+
+    def kept(self, profile, names, prebuilt=True):
+        args = mock.Mock(node='18.0.0', prebuilt=prebuilt,
+                         profile_extract=profile)
+        keep = nodeenv._member_filter(args)
+        top = 'node-v18.0.0-linux-x64/'
+        return [name for name in names if keep(top + name)]
+
+    def test_full(self):
+        assert self.kept('full', self.linux) == [
+            name for name in self.linux if name != 'README.md']
+        assert self.kept('full', self.windows) == self.windows
+
+    def test_runtime(self):
+        assert self.kept('runtime', self.linux) == [
+            'bin/node', 'bin/npm', 'bin/npx', 'bin/corepack',
+            'lib/node_modules/npm/bin/npm-cli.js',
+            'lib/node_modules/corepack/dist/corepack.js',
+        ]
+        assert self.kept('runtime', self.windows) == [
+            name for name in self.windows if '/docs/' not in name]
+
+    def test_minimal(self):
+        assert self.kept('minimal', self.linux) == ['bin/node']
+        assert self.kept('minimal', self.windows) == ['node.exe']
+
+    def test_sources_are_kept(self):
+        assert self.kept('minimal', ['include/node/v8.h', 'bin/npm'],
+                         prebuilt=False) == ['include/node/v8.h', 'bin/npm']
+
+    def test_extraction(self, tmpdir, isolated_cache):
+        url = ('https://nodejs.org/download/release/v18.0.0/'
+               'node-v18.0.0-linux-x64.tar.gz')
+        args = mock.Mock(node='18.0.0', prebuilt=True,
+                         profile_extract='runtime', download_segments='1')
+        with mock.patch.object(nodeenv, 'urlopen',
+                               side_effect=range_urlopen(
+                                   make_node_tarball())), \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=None), \
+                mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(url, tmpdir.strpath, args)
+        top = tmpdir.join('node-v18.0.0-linux-x64')
+        assert top.join('bin', 'node').exists()
+        assert not top.join('include').exists()
+
+    @pytest.mark.parametrize('extractor', ['python', 'system'])
+    def test_directories_left_out(self, tmpdir, extractor):
+        top = 'node-v18.0.0-linux-x64'
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for name in self.linux:
+                parts = name.split('/')
+                for i in range(1, len(parts)):
+                    info = tarfile.TarInfo('/'.join([top] + parts[:i]))
+                    if info.name not in tar.getnames():
+                        info.type = tarfile.DIRTYPE
+                        info.mode = 0o755
+                        tar.addfile(info)
+                info = tarfile.TarInfo('%s/%s' % (top, name))
+                info.mode = 0o755
+                tar.addfile(info, io.BytesIO())
+        keep = nodeenv._member_filter(mock.Mock(
+            node='18.0.0', prebuilt=True, profile_extract='minimal'))
+        with tempfile.TemporaryFile() as f:
+            f.write(buf.getvalue())
+            f.seek(0)
+            if extractor == 'system':
+                nodeenv._system_extract(f, tmpdir.strpath, keep,
+                                        ['gzip', '-dc'])
+            else:
+                nodeenv._extract_tar(f, tmpdir.strpath, lambda archive: (
+                    member for member in archive if keep(member.name)))
+        tree = sorted(
+            os.path.relpath(os.path.join(root, name), tmpdir.join(top).strpath)
+            for root, dirs, files in os.walk(tmpdir.join(top).strpath)
+            for name in dirs + files)
+        assert tree == ['bin', os.path.join('bin', 'node'), 'lib',
+                        os.path.join('lib', 'node_modules'), 'share']
+
+    @pytest.mark.parametrize('option', ['--requirements=req.txt',
+                                        '--with-npm'])
+    def test_minimal_has_no_npm(self, option):
+        argv = ['nodeenv', '--profile-extract=minimal', option, 'env']
+        with mock.patch.object(sys, 'argv', argv), \
+                pytest.raises(SystemExit):
+            nodeenv.parse_args()
+        argv[1] = '--profile-extract=runtime'
+        with mock.patch.object(sys, 'argv', argv):
+            assert nodeenv.parse_args().profile_extract == 'runtime'
+
+
+class TestDirectInstall:
+    """Tests for --install-method=direct"""
+
+    def test_movetree(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.mkdir('bin').join('node').write('new node')
+        src.join('bin', 'npm').mksymlinkto('node')
+        src.mkdir('lib').mkdir('node_modules').join('x').write('x')
+        dst = tmpdir.mkdir('dst')
+        dst.mkdir('bin').join('python').write('python')
+        dst.join('bin', 'npm').mksymlinkto('python')
+        nodeenv.movetree(src.strpath, dst.strpath)
+        assert dst.join('bin', 'node').read() == 'new node'
+        assert dst.join('bin', 'python').read() == 'python'
+        # existing links are kept (#189)
+        assert os.readlink(dst.join('bin', 'npm').strpath) == 'python'
+        assert dst.join('lib', 'node_modules', 'x').read() == 'x'
+        assert not src.join('bin', 'node').exists()
+
+    def test_movetree_is_rename(self, tmpdir):
+        src = tmpdir.mkdir('src')
+        src.join('node').write('node')
+        inode = os.stat(src.join('node').strpath).st_ino
+        dst = tmpdir.mkdir('dst')
+        nodeenv.movetree(src.strpath, dst.strpath)
+        assert os.stat(dst.join('node').strpath).st_ino == inode
+
+    @pytest.mark.skipif(nodeenv.is_WIN or nodeenv.is_CYGWIN,
+                        reason='unix layout')
+    def test_install(self, tmpdir, isolated_cache):
+        env_dir = tmpdir.join('env').strpath
+        src_dir = tmpdir.join('env', 'src').strpath
+        os.makedirs(src_dir)
+        args = mock.Mock(node='18.0.0', prebuilt=True, archive_format='gz',
+                         install_method='direct', profile_extract='full',
+                         download_segments='1')
+        url = nodeenv.get_node_bin_url('18.0.0')
+        platform_name = url.rsplit('node-v18.0.0-', 1)[1].split('.tar')[0]
+        archive = make_node_tarball(platform_name=platform_name)
+        with mock.patch.object(nodeenv, 'src_base_url',
+                               'https://nodejs.org/download/release'), \
+                mock.patch.object(nodeenv, 'urlopen',
+                                  side_effect=range_urlopen(archive)), \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=None), \
+                mock.patch.object(nodeenv, 'copytree') as m_copytree, \
+                mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.install_node_wrapped(env_dir, src_dir, args)
+        m_copytree.assert_not_called()
+        assert os.path.isfile(os.path.join(env_dir, 'bin', 'node'))
+        assert os.listdir(src_dir) == []
+
+    def test_windows_layout(self, tmpdir):
+        src_dir = tmpdir.mkdir('src')
+        src_dir.mkdir('node-v18.0.0-win-x64').join('node.exe').write('exe')
+        env_dir = tmpdir.mkdir('env')
+        with mock.patch.object(nodeenv, 'is_WIN', True), \
+                mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.move_node_from_prebuilt(
+                env_dir.strpath, src_dir.strpath, '18.0.0')
+        assert env_dir.join('Scripts', 'node.exe').read() == 'exe'
+        assert src_dir.listdir() == []
+
+
+@pytest.mark.skipif(nodeenv.is_WIN or nodeenv.is_CYGWIN, reason='unix layout')
+class TestStoreInstall:
+    """Tests for --install-method=link and symlink"""
+
+    def args(self, install_method='link'):
+        return mock.Mock(node='18.0.0', prebuilt=True, archive_format='gz',
+                         install_method=install_method,
+                         profile_extract='runtime', download_segments='1')
+
+    @pytest.fixture
+    def archive(self, isolated_cache):
+        url = nodeenv.get_node_bin_url('18.0.0')
+        platform_name = url.rsplit('node-v18.0.0-', 1)[1].split('.tar')[0]
+        archive = make_node_tarball(platform_name=platform_name)
+        with mock.patch.object(nodeenv, 'src_base_url',
+                               'https://nodejs.org/download/release'), \
+                mock.patch.object(nodeenv, 'urlopen',
+                                  side_effect=range_urlopen(archive)) as m, \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=None), \
+                mock.patch.object(nodeenv.logger, 'info'):
+            yield m
+
+    def install(self, tmpdir, name, install_method='link'):
+        env_dir = tmpdir.join(name).strpath
+        src_dir = os.path.join(env_dir, 'src')
+        os.makedirs(src_dir)
+        nodeenv.install_node_wrapped(
+            env_dir, src_dir, self.args(install_method))
+        return os.path.join(env_dir, 'bin', 'node')
+
+    def test_get_store_dir(self, isolated_cache):
+        url = 'https://x/v18.0.0/node-v18.0.0-linux-x64.tar.xz'
+        with mock.patch.object(nodeenv, 'get_expected_sha256',
+                               return_value='ab' * 32):
+            assert nodeenv.get_store_dir(url, 'full') == os.path.join(
+                isolated_cache, 'store', 'full',
+                'abababababababab-node-v18.0.0-linux-x64')
+            with mock.patch.object(nodeenv, 'cache_dir', ''):
+                assert nodeenv.get_store_dir(url, 'full') is None
+
+    def test_get_store_dir_without_shasums(self, isolated_cache):
+        with mock.patch.object(nodeenv, 'get_expected_sha256',
+                               return_value=None), \
+                mock.patch.object(nodeenv, 'mirrors',
+                                  ['https://a', 'https://b']):
+            first = nodeenv.get_store_dir(
+                'https://a/v18.0.0/node-v18.0.0-linux-x64.tar.gz', 'full')
+            second = nodeenv.get_store_dir(
+                'https://b/v18.0.0/node-v18.0.0-linux-x64.tar.gz', 'full')
+        # mirrors of the same release share the entry
+        assert first == second
+        assert first.endswith('-node-v18.0.0-linux-x64')
+
+    def test_envs_share_the_store(self, archive, tmpdir, isolated_cache):
+        with mock.patch.object(nodeenv, 'FICLONE', None):
+            first = self.install(tmpdir, 'env1')
+            second = self.install(tmpdir, 'env2')
+        assert archive.call_count == 1
+        assert os.stat(first).st_ino == os.stat(second).st_ino
+        # the store can't be changed through the links
+        assert not os.stat(first).st_mode & nodeenv.STORE_WRITE_BITS
+        # the profile was applied once, when filling the store
+        assert not os.path.exists(os.path.join(
+            tmpdir.strpath, 'env1', 'include'))
+        store = os.path.join(isolated_cache, 'store', 'runtime')
+        assert [n for n in os.listdir(store) if n.startswith('.')] == []
+
+    def test_without_cache(self, archive, tmpdir):
+        with mock.patch.object(nodeenv, 'cache_dir', ''):
+            node = self.install(tmpdir, 'env')
+        assert os.stat(node).st_nlink == 1
+        assert os.listdir(tmpdir.join('env', 'src').strpath)
+
+    def test_reflink(self, tmpdir):
+        src = tmpdir.join('src')
+        src.write('data')
+        src.chmod(0o555)
+        with mock.patch.object(nodeenv, 'FICLONE', 1), \
+                mock.patch.object(nodeenv, '_reflink',
+                                  side_effect=shutil.copyfile) as m_reflink, \
+                mock.patch.object(nodeenv.os, 'link') as m_link:
+            linker = nodeenv._StoreLinker()
+            linker(src.strpath, tmpdir.join('dst').strpath)
+        m_reflink.assert_called_once()
+        m_link.assert_not_called()
+        # a clone is private to the environment
+        assert os.stat(tmpdir.join('dst').strpath).st_mode & 0o777 == 0o755
+
+    def test_fallbacks(self, tmpdir):
+        src = tmpdir.join('src')
+        src.write('data')
+        src.chmod(0o444)
+        error = OSError(errno.EXDEV, 'cross-device link')
+        with mock.patch.object(nodeenv, 'FICLONE', 1), \
+                mock.patch.object(nodeenv, '_reflink',
+                                  side_effect=error) as m_reflink, \
+                mock.patch.object(nodeenv.os, 'link',
+                                  side_effect=error) as m_link:
+            linker = nodeenv._StoreLinker()
+            for name in ('a', 'b'):
+                linker(src.strpath, tmpdir.join(name).strpath)
+        # each method failing is only tried once
+        assert m_reflink.call_count == 1
+        assert m_link.call_count == 1
+        assert tmpdir.join('b').read() == 'data'
+        assert os.stat(tmpdir.join('b').strpath).st_mode & 0o777 == 0o644
+
+    def test_symlink(self, archive, tmpdir, isolated_cache):
+        first = self.install(tmpdir, 'env1', 'symlink')
+        second = self.install(tmpdir, 'env2', 'symlink')
+        assert archive.call_count == 1
+        store_dir, = glob.glob(os.path.join(
+            isolated_cache, 'store', 'runtime', '*-node-v18.0.0-*[!s]'))
+        assert os.path.realpath(first) == os.path.realpath(second) == \
+            os.path.join(store_dir, 'bin', 'node')
+        # bin stays a directory of the environment for the scripts
+        assert not os.path.islink(os.path.dirname(first))
+        assert os.path.islink(first)
+        assert nodeenv.get_store_refs(store_dir) == sorted(
+            [tmpdir.join('env1').strpath, tmpdir.join('env2').strpath],
+            key=lambda env_dir: hashlib.sha256(
+                env_dir.encode('utf-8')).hexdigest())
+
+        tmpdir.join('env1').remove()
+        assert nodeenv.get_store_refs(store_dir) == [
+            tmpdir.join('env2').strpath]
+        assert len(os.listdir(store_dir + '.refs')) == 1
+
+    def test_symlink_tree(self, tmpdir):
+        store = tmpdir.join('store')
+        store.join('bin', 'node').write('node', ensure=True)
+        store.join('lib', 'node_modules', 'npm', 'index.js').write(
+            'npm', ensure=True)
+        store.join('include', 'node', 'node.h').write('h', ensure=True)
+        env = tmpdir.join('env')
+        env.join('bin', 'activate').write('activate', ensure=True)
+        # left behind by an install from another entry
+        env.join('include').mksymlinkto(tmpdir)
+
+        nodeenv._symlink_tree(store.strpath, env.strpath)
+
+        for name in ('bin', 'lib', 'lib/node_modules'):
+            assert not env.join(name).islink()
+            assert env.join(name).isdir()
+        for name in ('bin/node', 'lib/node_modules/npm', 'include'):
+            assert env.join(name).readlink() == store.join(name).strpath
+        assert env.join('bin', 'activate').read() == 'activate'
+
+
+@pytest.mark.skipif(nodeenv.is_WIN, reason='needs symlinks')
+class TestCopytree:
+    """Tests for copytree()"""
+
+    @pytest.fixture
+    def tree(self, tmpdir):
+        src = tmpdir.join('src')
+        src.join('bin', 'node').write('node', ensure=True)
+        src.join('bin', 'node').chmod(0o755)
+        src.join('lib', 'node_modules', 'npm', 'cli.js').write(
+            'npm', ensure=True)
+        os.symlink('../lib/node_modules/npm/cli.js',
+                   src.join('bin', 'npm').strpath)
+        os.utime(src.join('lib').strpath, (1000000000, 1000000000))
+        return src
+
+    def test_copy(self, tree, tmpdir):
+        dst = tmpdir.join('dst')
+        nodeenv.copytree(tree.strpath, dst.strpath, True)
+        assert dst.join('bin', 'node').read() == 'node'
+        assert os.stat(dst.join('bin', 'node').strpath).st_mode & 0o777 \
+            == 0o755
+        assert dst.join('bin', 'npm').readlink() == \
+            '../lib/node_modules/npm/cli.js'
+        assert dst.join('lib', 'node_modules', 'npm', 'cli.js').read() == 'npm'
+        assert dst.join('lib').mtime() == 1000000000
+
+    def test_merge_keeps_links(self, tree, tmpdir):
+        dst = tmpdir.join('dst')
+        dst.join('bin', 'own').write('own', ensure=True)
+        dst.join('bin', 'npm').mksymlinkto('/elsewhere')
+        nodeenv.copytree(tree.strpath, dst.strpath, True)
+        # #189
+        assert dst.join('bin', 'npm').readlink() == '/elsewhere'
+        assert dst.join('bin', 'own').read() == 'own'
+        assert dst.join('bin', 'node').read() == 'node'
+
+    def test_copy_function(self, tree, tmpdir):
+        copied = []
+        nodeenv.copytree(tree.strpath, tmpdir.join('dst').strpath, True,
+                         copy_function=lambda s, d: copied.append(d))
+        assert sorted(os.path.relpath(d, tmpdir.join('dst').strpath)
+                      for d in copied) == [
+            os.path.join('bin', 'node'),
+            os.path.join('lib', 'node_modules', 'npm', 'cli.js')]
+
+    def test_copy_file_without_kernel_copy(self, tmpdir):
+        src = tmpdir.join('src')
+        src.write_binary(b'x' * 100000)
+        dst = tmpdir.join('dst')
+        dst.write('stale data longer than nothing')
+        error = OSError(errno.EXDEV, 'cross-device')
+        with mock.patch.object(nodeenv.sys, 'platform', 'linux'), \
+                mock.patch.object(nodeenv, '_kernel_copy',
+                                  side_effect=error):
+            nodeenv._copy_file(src.strpath, dst.strpath)
+        assert dst.read_binary() == b'x' * 100000
+
+    def test_kernel_copy_falls_back_to_sendfile(self, tmpdir):
+        src = tmpdir.join('src')
+        src.write_binary(b'data')
+        error = OSError(errno.ENOSYS, 'no copy_file_range')
+        with open(src.strpath, 'rb') as fin, \
+                open(tmpdir.join('dst').strpath, 'wb') as fout, \
+                mock.patch.object(nodeenv.os, 'copy_file_range',
+                                  side_effect=error, create=True), \
+                mock.patch.object(nodeenv.os, 'sendfile', create=True,
+                                  return_value=4) as m_sendfile:
+            nodeenv._kernel_copy(fin.fileno(), fout.fileno(), 4)
+            m_sendfile.assert_called_once_with(
+                fout.fileno(), fin.fileno(), 0, 4)
+
+
+@pytest.mark.skipif(nodeenv.is_WIN or nodeenv.is_CYGWIN or
+                    shutil.which('tar') is None or
+                    shutil.which('gzip') is None,
+                    reason='needs tar and gzip')
+class TestSystemExtractor:
+    """Tests for --extractor"""
+
+    url = ('https://nodejs.org/download/release/v18.0.0/'
+           'node-v18.0.0-linux-x64.tar.gz')
+
+    def keep(self, profile='runtime'):
+        return nodeenv._member_filter(mock.Mock(
+            node='18.0.0', prebuilt=True, profile_extract=profile))
+
+    def test_decompressor(self):
+        with mock.patch('shutil.which', return_value='/usr/bin/x'):
+            assert nodeenv._system_decompressor(self.url, 'auto') == \
+                ['pigz', '-dc']
+            assert nodeenv._system_decompressor(
+                self.url.replace('.gz', '.xz'), 'system') == \
+                ['xz', '-dc', '-T0']
+            assert nodeenv._system_decompressor(self.url, 'python') is None
+            assert nodeenv._system_decompressor(
+                self.url.replace('.tar.gz', '.zip'), 'system') is None
+        with mock.patch('shutil.which', return_value=None):
+            assert nodeenv._system_decompressor(self.url, 'system') is None
+
+    def test_extract(self, tmpdir):
+        tmpdir.join('node-v18.0.0-linux-x64', 'old').write('', ensure=True)
+        with tempfile.TemporaryFile() as f:
+            f.write(make_node_tarball())
+            nodeenv._system_extract(f, tmpdir.strpath, self.keep(),
+                                    ['gzip', '-dc'])
+        top = tmpdir.join('node-v18.0.0-linux-x64')
+        assert top.join('bin', 'node').read() == '#!/bin/sh\n'
+        assert not top.join('include').exists()
+        assert not top.join('README.md').exists()
+        # merged with what was there
+        assert top.join('old').exists()
+        assert sorted(tmpdir.listdir()) == [top]
+
+    def test_links_out_of_the_archive(self, tmpdir):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            info = tarfile.TarInfo('node-v18.0.0-linux-x64/bin/node')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            tar.addfile(info)
+        with tempfile.TemporaryFile() as f:
+            f.write(buf.getvalue())
+            with pytest.raises(OSError, match='links outside'):
+                nodeenv._system_extract(f, tmpdir.strpath, self.keep(),
+                                        ['gzip', '-dc'])
+        assert tmpdir.listdir() == []
+
+    def test_tar_fails(self, tmpdir):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'not an archive')
+            with pytest.raises(OSError, match='gzip failed'):
+                nodeenv._system_extract(f, tmpdir.strpath, self.keep(),
+                                        ['gzip', '-dc'])
+        assert tmpdir.listdir() == []
+
+    @pytest.mark.parametrize('extractor', ['auto', 'system'])
+    def test_download(self, tmpdir, isolated_cache, extractor):
+        args = mock.Mock(node='18.0.0', prebuilt=True, extractor=extractor,
+                         profile_extract='runtime', download_segments='1')
+        with mock.patch.object(nodeenv, 'urlopen',
+                               side_effect=range_urlopen(
+                                   make_node_tarball())), \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=None), \
+                mock.patch.object(nodeenv, '_system_decompressor',
+                                  return_value=['gzip', '-dc']), \
+                mock.patch.object(nodeenv, '_system_extract',
+                                  wraps=nodeenv._system_extract) as m, \
+                mock.patch.object(nodeenv.logger, 'info'):
+            nodeenv.download_node_src(self.url, tmpdir.strpath, args)
+            # auto streams downloads through tarfile
+            assert m.called == (extractor == 'system')
+            nodeenv.download_node_src(self.url, tmpdir.strpath, args)
+            # and uses the system tar once the archive is in the cache
+            assert m.called
+        top = tmpdir.join('node-v18.0.0-linux-x64')
+        assert top.join('bin', 'node').exists()
+        assert not top.join('include').exists()
+
+
+class TestExtractPipeline:
+    """Tests for the threaded tar extraction"""
+
+    def make_tarball(self, mode='w:gz'):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode=mode) as tar:
+            info = tarfile.TarInfo('top/lib')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.mtime = 1000000000
+            tar.addfile(info)
+            for name, data in (('top/lib/small.js', b'small'),
+                               ('top/bin/node', b'n' * 5000)):
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o755
+                info.mtime = 1000000000
+                tar.addfile(info, io.BytesIO(data))
+            info = tarfile.TarInfo('top/bin/npm')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '../lib/small.js'
+            tar.addfile(info)
+            info = tarfile.TarInfo('top/bin/nodejs')
+            info.type = tarfile.LNKTYPE
+            info.linkname = 'top/bin/node'
+            info.mode = 0o755
+            info.mtime = 1000000000
+            tar.addfile(info)
+        return buf.getvalue()
+
+    @pytest.mark.parametrize('mode', ['w:gz', 'w:xz', 'w'])
+    def test_extract(self, tmpdir, mode):
+        with mock.patch.object(nodeenv, 'EXTRACT_BUFFER_SIZE', 1000):
+            nodeenv._extract_tar(io.BytesIO(self.make_tarball(mode)),
+                                 tmpdir.strpath, iter)
+        top = tmpdir.join('top')
+        assert top.join('lib', 'small.js').read() == 'small'
+        assert top.join('bin', 'node').read() == 'n' * 5000
+        assert os.stat(top.join('bin', 'node').strpath).st_mode & 0o111
+        assert top.join('bin', 'node').mtime() == 1000000000
+        assert top.join('lib').mtime() == 1000000000
+        if not nodeenv.is_WIN:
+            assert top.join('bin', 'npm').readlink() == '../lib/small.js'
+            assert top.join('bin', 'nodejs').read() == 'n' * 5000
+
+    def test_buffered_bytes_are_bounded(self, tmpdir):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for i in range(20):
+                info = tarfile.TarInfo('top/f%d' % i)
+                info.size = 400
+                tar.addfile(info, io.BytesIO(b'x' * 400))
+        buf.seek(0)
+        lock = threading.Lock()
+        in_flight = [0]
+        peak = [0]
+        write = nodeenv._write_member
+
+        def slow_write(archive, member, target, data):
+            with lock:
+                in_flight[0] += len(data)
+                peak[0] = max(peak[0], in_flight[0])
+            time.sleep(0.01)
+            write(archive, member, target, data)
+            with lock:
+                in_flight[0] -= len(data)
+
+        with mock.patch.object(nodeenv, 'EXTRACT_BUFFER_LIMIT', 1000), \
+                mock.patch.object(nodeenv, 'COPY_JOBS', 8), \
+                mock.patch.object(nodeenv, '_write_member',
+                                  side_effect=slow_write):
+            nodeenv._extract_tar(buf, tmpdir.strpath, iter)
+        assert 400 <= peak[0] <= 800
+        assert len(tmpdir.join('top').listdir()) == 20
+
+    def test_byte_budget(self):
+        budget = nodeenv._ByteBudget(100)
+        budget.take(60)
+        taken = threading.Event()
+
+        def take():
+            budget.take(60)
+            taken.set()
+
+        thread = threading.Thread(target=take)
+        thread.start()
+        assert not taken.wait(0.05)
+        budget.give(60)
+        assert taken.wait(5)
+        thread.join()
+        # one file over the limit still goes through on its own
+        budget.give(60)
+        budget.take(500)
+
+    def test_select(self, tmpdir):
+        nodeenv._extract_tar(
+            io.BytesIO(self.make_tarball()), tmpdir.strpath,
+            lambda archive: (m for m in archive if 'node' not in m.name))
+        assert tmpdir.join('top', 'lib', 'small.js').exists()
+        assert not tmpdir.join('top', 'bin', 'node').exists()
+
+    @pytest.mark.skipif(sys.version_info < (3, 12),
+                        reason='the data filter is new in 3.12')
+    def test_data_filter(self, tmpdir):
+        buf = io.BytesIO()
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            info = tarfile.TarInfo('top/evil')
+            info.type = tarfile.SYMTYPE
+            info.linkname = '/etc/passwd'
+            tar.addfile(info)
+        buf.seek(0)
+        with pytest.raises(tarfile.FilterError):
+            nodeenv._extract_tar(buf, tmpdir.strpath, iter)
+        assert not tmpdir.join('top', 'evil').exists()
+
+    def test_read_errors(self):
+        class Broken(io.BytesIO):
+            def read(self, size=-1):
+                data = io.BytesIO.read(self, 100)
+                if not data:
+                    raise IncompleteRead(b'')
+                return data
+
+        data = self.make_tarball('w:xz')
+        reader = nodeenv._InflateReader(Broken(data))
+        with pytest.raises(IncompleteRead):
+            while reader.read(10):
+                pass
+        reader.close()
+
+    def test_close_early(self):
+        reads = []
+
+        class Endless(object):
+            def read(self, size=-1):
+                reads.append(size)
+                return b'x' * size
+
+        reader = nodeenv._InflateReader(Endless())
+        assert reader.read(5) == b'xxxxx'
+        reader.close()
+        count = len(reads)
+        time.sleep(0.05)
+        assert len(reads) == count
+
+
+@pytest.mark.skipif(nodeenv.is_WIN or nodeenv.is_CYGWIN, reason='unix layout')
+class TestSrcManifest:
+    """Tests for the manifest of the archives extracted into src/"""
+
+    def install(self, env_dir, profile='full'):
+        args = mock.Mock(node='18.0.0', prebuilt=True, archive_format='gz',
+                         install_method='copy', profile_extract=profile,
+                         download_segments='1')
+        nodeenv.install_node_wrapped(
+            env_dir.strpath, env_dir.join('src').strpath, args)
+
+    @pytest.fixture
+    def archive(self, isolated_cache):
+        url = nodeenv.get_node_bin_url('18.0.0')
+        platform_name = url.rsplit('node-v18.0.0-', 1)[1].split('.tar')[0]
+        archive = make_node_tarball(platform_name=platform_name)
+        self.sha256 = hashlib.sha256(archive).hexdigest()
+        with mock.patch.object(nodeenv, 'src_base_url',
+                               'https://nodejs.org/download/release'), \
+                mock.patch.object(nodeenv, 'cache_dir', ''), \
+                mock.patch.object(nodeenv, 'urlopen',
+                                  side_effect=range_urlopen(archive)) as m, \
+                mock.patch.object(nodeenv, 'get_expected_sha256',
+                                  return_value=self.sha256), \
+                mock.patch.object(nodeenv.logger, 'info'):
+            yield m
+
+    def test_reinstall(self, archive, tmpdir):
+        env_dir = tmpdir.join('env')
+        env_dir.join('src').ensure(dir=True)
+        self.install(env_dir)
+        manifest = json.loads(env_dir.join('src', 'manifest.json').read())
+        platform_name = nodeenv.get_host_platform()
+        assert manifest == [{
+            'node': '18.0.0', 'platform': platform_name, 'profile': 'full',
+            'url': nodeenv.get_node_bin_url('18.0.0'), 'sha256': self.sha256,
+            'dir': 'node-v18.0.0-%s' % platform_name,
+        }]
+
+        env_dir.join('bin', 'node').remove()
+        with mock.patch.object(nodeenv, 'get_node_archive_url') as m_url:
+            self.install(env_dir)
+        m_url.assert_not_called()
+        assert archive.call_count == 1
+        assert env_dir.join('bin', 'node').exists()
+
+    def test_other_profile(self, archive, tmpdir):
+        env_dir = tmpdir.join('env')
+        env_dir.join('src').ensure(dir=True)
+        self.install(env_dir)
+        self.install(env_dir, profile='runtime')
+        assert archive.call_count == 2
+        manifest = json.loads(env_dir.join('src', 'manifest.json').read())
+        assert [entry['profile'] for entry in manifest] == ['runtime']
+        # the full tree was replaced
+        entry, = manifest
+        assert not env_dir.join('src', entry['dir'], 'include').exists()
+
+    def test_removed_tree(self, archive, tmpdir):
+        env_dir = tmpdir.join('env')
+        env_dir.join('src').ensure(dir=True)
+        self.install(env_dir)
+        entry, = json.loads(env_dir.join('src', 'manifest.json').read())
+        env_dir.join('src', entry['dir']).remove()
+        args = mock.Mock(node='18.0.0', prebuilt=True, profile_extract='full')
+        assert nodeenv.src_manifest_lookup(
+            env_dir.join('src').strpath, args) is None
+        self.install(env_dir)
+        assert archive.call_count == 2
+
+
+class TestVersionCatalog:
+    releases = [
+        {'version': 'v10.1.0', 'lts': False,
+         'files': ['linux-x64', 'linux-x64-musl']},
+        {'version': 'v12.1.0', 'lts': False, 'files': ['linux-x64']},
+        {'version': 'v10.2.0', 'lts': 'Dubnium', 'files': ['linux-x64']},
+        {'version': 'v9.11.2', 'lts': False,
+         'files': ['linux-x64', 'linux-x64-musl']},
+    ]
+
+    def test_latest(self):
+        catalog = nodeenv.VersionCatalog(self.releases)
+        assert catalog.latest() == '12.1.0'
+        assert catalog.latest('10') == '10.2.0'
+        assert catalog.latest('10.1') == '10.1.0'
+        assert catalog.latest('lts') == '10.2.0'
+        assert catalog.latest('lts/dubnium') == '10.2.0'
+        assert catalog.latest('lts/Dubnium') == '10.2.0'
+        assert catalog.latest('11') is None
+        assert catalog.latest('lts/erbium') is None
+
+    def test_latest_build(self):
+        catalog = nodeenv.VersionCatalog(self.releases)
+        assert catalog.latest('', 'linux-x64-musl') == '10.1.0'
+        assert catalog.latest('9', 'linux-x64-musl') == '9.11.2'
+        assert catalog.latest('lts', 'linux-x64-musl') is None
+        assert catalog.latest('', 'linux-riscv64') is None
+
+    def test_has_file(self):
+        catalog = nodeenv.VersionCatalog(self.releases)
+        assert catalog.has_file('10.1.0', 'linux-x64-musl')
+        assert not catalog.has_file('12.1.0', 'linux-x64-musl')
+        assert not catalog.has_file('12.1.0', 'linux-riscv64')
+        assert not catalog.has_file('11.0.0', 'linux-x64')
+
+    def test_versions(self):
+        catalog = nodeenv.VersionCatalog(self.releases)
+        assert catalog.versions() == ['9.11.2', '10.1.0', '10.2.0', '12.1.0']
+
+    @pytest.mark.usefixtures('mock_host_platform')
+    def test_built_once(self):
+        with mock.patch.object(nodeenv, '_get_versions_json',
+                               return_value=self.releases) as m_index:
+            assert nodeenv.get_last_stable_node_version() == '12.1.0'
+            assert nodeenv.get_last_lts_node_version() == '10.2.0'
+            assert nodeenv.resolve_node_version('lts/dubnium') == '10.2.0'
+            assert nodeenv.get_node_versions()[0] == '9.11.2'
+        assert m_index.call_count == 1
+
+    def test_host_probed_once_per_query(self):
+        with mock.patch.object(nodeenv, '_get_versions_json',
+                               return_value=self.releases):
+            with mock.patch.object(nodeenv, 'is_x86_64_musl',
+                                   return_value=True) as m_musl:
+                assert nodeenv.get_last_stable_node_version() == '10.1.0'
+        assert m_musl.call_count == 1